@@ -1,5 +1,13 @@
-from .app import main,app
-
-main(app)
+import argparse
 
+parser = argparse.ArgumentParser(prog='python -m yarnbot')
+parser.add_argument('--async', dest='use_async', action='store_true',
+    help='Run on asyncio, with AsyncApp and an aiohttp Ravelry client')
+args = parser.parse_args()
 
+if args.use_async:
+    from . import async_app
+    async_app.main(async_app.create_app())
+else:
+    from . import app
+    app.main(app.create_app())
@@ -0,0 +1,193 @@
+'''
+Asyncio Ravelry client, used by the `async_app` entry point.
+
+The response cache, yarn catalog, search parsing and reply rendering are
+shared with `ravelry`; only the HTTP calls differ.
+'''
+
+import json
+import time
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from . import ravelry
+from .ravelry import (BaseRavelryClient, NearestYarns, RETRY_STATUSES, RAV_ACC_KEY, RAV_SEC_KEY,
+    RAV_SIMILAR_PAGES, RAV_SIMILAR_PAGE_SIZE, RAV_SIMILAR_STABLE_PAGES, cache_key, cache_ttl,
+    endpoint_name, fiber_names, pattern_search_parms, pattern_search_reply, rav_cache, rav_flight,
+    rav_stats, search_call, yarn_search_parms, yarn_search_reply)
+from .query import parse_pattern_search, parse_yarn_search
+
+class AsyncRavelryClient(BaseRavelryClient):
+    '''
+    aiohttp version of `ravelry.RavelryClient`. The session, and its pool
+    of keep-alive connections, is created on first use so that it belongs
+    to the running event loop.
+    '''
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                auth=aiohttp.BasicAuth(*self.auth) if self.auth is not None else None,
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, api_call: str, parms: Optional[Dict[str,Any]]=None) -> Any:
+        return (await self.fetch(api_call, parms))[0]
+
+    async def fetch(self, api_call: str, parms: Optional[Dict[str,Any]]=None) -> Tuple[Any,int]:
+        '''
+        Make a GET request to the API.
+
+        Returns: (decoded JSON response, size of the response body in bytes)
+        '''
+        url = self.base_url + api_call.lstrip('/')
+        endpoint = endpoint_name(api_call)
+        parms = { k: str(v) for (k,v) in parms.items() } if parms else None
+
+        attempt = 0
+        while True:
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                async with self._session().get(url, params=parms) as resp:
+                    retry = resp.status in RETRY_STATUSES
+                    if not retry or attempt >= self.max_retries:
+                        resp.raise_for_status()
+                        body = await resp.read()
+                        self.stats.record(endpoint, time.perf_counter()-start)
+                        return (json.loads(body), len(body))
+                    retry_after = resp.headers.get('Retry-After')
+                self.stats.record(endpoint, time.perf_counter()-start, error=True)
+                logging.warning('Ravelry {0} returned {1}, retrying'.format(endpoint, resp.status))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.stats.record(endpoint, time.perf_counter()-start, error=True)
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning('Ravelry {0} failed ({1}), retrying'.format(endpoint, e))
+
+            self.stats.record_retry(endpoint)
+            await asyncio.sleep(self.retry_delay(attempt, retry_after))
+            attempt += 1
+
+aio_client = AsyncRavelryClient(auth=(RAV_ACC_KEY or '', RAV_SEC_KEY or ''), stats=rav_stats)
+
+async def ravelry_api(api_call, parms, key=None):
+
+    if key is None:
+        key = cache_key(api_call, parms)
+
+    ttl = cache_ttl(api_call)
+    if ttl is None:
+        return await rav_flight.do_async(key, lambda: aio_client.get(api_call, parms))
+
+    result = rav_cache.get(key)
+    if result is None:
+        result = await rav_flight.do_async(key, lambda: fetch_and_cache(api_call, parms, key, ttl))
+
+    return result
+
+async def fetch_and_cache(api_call, parms, key, ttl):
+    # A flight for this key may have landed between the cache check and
+    # this one leading the next
+    result = rav_cache.get(key)
+    if result is not None:
+        return result
+
+    (result, size) = await aio_client.fetch(api_call, parms)
+    rav_cache.put(key, result, size, ttl)
+    if ravelry.rav_catalog is not None:
+        # SQLite; a slow write or a locked database mustn't stall the loop
+        await asyncio.to_thread(ravelry.rav_catalog.add_response, api_call, parms, result)
+    return result
+
+async def ravelry_api_yarn(rav_cmd, page_size=5, page=1):
+
+    query = parse_yarn_search(rav_cmd, page_size, page)
+    (msg, parms) = yarn_search_parms(query)
+
+    rav_result = await ravelry_api('/yarns/search.json', parms, key=query)
+
+    return (rav_result, msg, parms)
+
+async def yarn_detail(yarn_id):
+    '''
+    Async `ravelry.yarn_detail`
+    '''
+    if ravelry.rav_catalog is not None:
+        known = await asyncio.to_thread(ravelry.rav_catalog.detail, yarn_id)
+        if known is not None:
+            return known
+
+    detail = (await ravelry_api('yarns/{0}.json'.format(yarn_id), {'id': yarn_id}))['yarn']
+    return (detail, fiber_names(detail))
+
+async def search_page(query):
+    (api_call, _records, parms) = search_call(query)
+    return await ravelry_api(api_call, parms, key=query)
+
+async def search_pages(query, max_pages=None) -> AsyncGenerator[Tuple[List[Dict[str,Any]],Dict[str,Any]],None]:
+    '''
+    Async `ravelry.search_pages`
+    '''
+    records = search_call(query)[1]
+    page = query.page
+    while max_pages is None or page - query.page < max_pages:
+        try:
+            result = await search_page(query._replace(page=page))
+        except Exception as e:
+            if page == query.page:
+                raise
+            logging.warning('Ravelry search page {0} failed: {1}'.format(page, e))
+            return
+
+        paginator = result.get('paginator', {})
+        page_records = result.get(records, [])
+        yield (page_records, paginator)
+
+        if page >= paginator.get('last_page', page) or len(page_records) < query.page_size:
+            return
+        page += 1
+
+async def similar_yarns(target, fibers, weight, k=5, page_size=RAV_SIMILAR_PAGE_SIZE,
+        max_pages=RAV_SIMILAR_PAGES, stable_pages=RAV_SIMILAR_STABLE_PAGES):
+    '''
+    Async `ravelry.similar_yarns`
+    '''
+    ranking = NearestYarns(target, k)
+    pages = search_pages(parse_yarn_search(fibers + [weight], page_size), max_pages)
+    try:
+        async for (yarns, _paginator) in pages:
+            ranking.add(yarns)
+            if ranking.stable >= stable_pages:
+                break
+    finally:
+        await pages.aclose()
+    return ranking.yarns
+
+async def ravelry_yarn(rav_cmd):
+
+    (rav_result, msg, parms) = await ravelry_api_yarn(rav_cmd)
+
+    return yarn_search_reply(rav_result, msg)
+
+async def ravelry_pattern(rav_cmd):
+
+    query = parse_pattern_search(rav_cmd)
+    (msg, parms) = pattern_search_parms(query)
+
+    rav_result = await ravelry_api('/patterns/search.json', parms, key=query)
+
+    return pattern_search_reply(rav_result, msg)
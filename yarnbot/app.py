@@ -25,106 +25,149 @@ import sys
 import time
 import string
 import random
-import pickle
 import re
-import json
 import requests
+import signal
 import logging
+import threading
 
 from collections import UserDict
 
 from slack_bolt import App
 
-from .conversations import EaseConversation
-from .state import app_state
-
-from . import data, __version__
+from .conversations import Conversation, conversation_templates
+from .router import Message, Router
+from .tasks import TaskQueue
+from .ratelimit import RAVELRY_LIMIT, rate_limiter
+from .metrics import COMMAND_SECONDS, UPSTREAM_SECONDS, metrics, start_exporters
+from .render import attachments_json, card_cache, favorite_card, yarn_card
+from .replies import reload_data, static_replies
+from .sizes import needle_sizes
+from .slackcache import SLACK_PAGE_RETRIES, SLACK_PAGE_SIZE, retry_after, slack_directory
+from .state import app_state, open_session_store
+
+from . import arith, data, ravelry, __version__
+from .catalog import YarnCatalog
 from .ravelry import (ravelry_api, ravelry_api_yarn,
-    ravelry_pattern, ravelry_yarn, yarn_distance)
+    ravelry_pattern, ravelry_yarn, prefetch_yarn_details,
+    similar_yarns, weight_name, rav_cache, rav_stats)
+
+USERDB_FILENAME = 'known_users.log'
+LEGACY_USERDB_FILENAME = 'known_users.pkl'
+CATALOG_FILENAME = 'yarn_catalog.db'
+
+# Go to Ravelry for similar yarn unless the catalog has at least this many candidates
+CATALOG_MIN_CANDIDATES = 20
+
+# Number of similar-yarn targets to fetch details for
+SIMILAR_PREFETCH = 3
+
+# Ravelry commands run on their own worker threads
+RAVELRY_SUBCOMMANDS = frozenset(['yarn', 'yarns', 'search', 'favorites'])
+RAVELRY_WORKERS = 4
+RAVELRY_MAX_PENDING = 32
+RAVELRY_PLACEHOLDER = 'Asking Ravelry... :hourglass_flowing_sand:'
+RAVELRY_BUSY_REPLY = "I'm busy with a lot of Ravelry searches right now, try again in a minute."
+
+# Routes subject to the global Ravelry rate limit
+RAVELRY_ROUTES = frozenset(['cmd_ravelry'])
+THROTTLED_REPLY = "Whoa, that's a lot of messages! Give me a few seconds to catch up. :sweat_smile:"
+
+PUNC_TABLE = str.maketrans('','', string.punctuation)
+MSG_PUNC_TABLE = str.maketrans('','','.,!?:;')
 
-USERDB_FILENAME = 'known_users.pkl'
+US_SIZE_RE = re.compile('^us ([0-9]+/[0-9]+|[0-9.]+(?: +[0-9]+/[0-9]+)?)')
+UK_SIZE_RE = re.compile('^uk ([0-9.]+)')
+CROCHET_SIZE_RE = re.compile('^crochet ([a-z])')
+WELCOME_RE = re.compile('^welcome <@(u[a-z0-9]+)>')
 
-app = App(
-    token=os.environ.get("SLACK_BOT_TOKEN"),
-    signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
-)
+# Returned by a command handler to ask the caller to shut down
+QUIT = object()
+
+router = Router()
 
 def strip_punc(s):
-    return str(s).translate(str.maketrans('','', string.punctuation)).strip()
+    return str(s).translate(PUNC_TABLE).strip()
 
 
 def start_conversation(conv_name, user_id):
 
-    conv = None
-
-    if conv_name == 'ease':
-        conv = EaseConversation()
+    template = conversation_templates.get(conv_name)
 
-    if conv is None:
+    if template is None:
         return "Something funny happened trying to start a conversation :/"
 
+    conv = Conversation(template)
 
     msg = "Starting a conversation with yarnbot, just say 'cancel' to cancel\n"
-    (reply,terminal) = conv.step('')
+    step = conv.step('')
+    if step is None:
+        return msg
+
+    (reply,terminal) = step
 
     if not terminal:
-        app_state.conversations[user_id] = conv
+        app_state.conversations.put(user_id, conv)
 
     if reply is not None:
         msg += reply
 
     return msg
 
-def continue_conversation(user_id, msg):
+def continue_conversation(user_id, conv, msg):
 
     if msg == 'cancel':
-        del app_state.conversations[user_id]
+        app_state.conversations.pop(user_id)
         return 'Ok, conversation canceled'
 
-    if user_id not in app_state.conversations:
-        return 'Hmm, this conversation seems to be over :/'
+    step = conv.step(msg)
 
-    conv = app_state.conversations[user_id]
-
-    (reply,terminal) = conv.step(msg)
-
-    if reply is None or terminal:
-        del app_state.conversations[user_id]
-    
-    return reply
+    if step is None or step[1]:
+        app_state.conversations.pop(user_id)
+    else:
+        app_state.conversations.put(user_id, conv)
 
-@app.event('message')
-def proc_msg(event, say, client):
+    return step[0] if step is not None else None
 
-    reply = None
+def read_event(evt, say, client):
+    '''
+    First pass over a message event, shared by the sync and async apps.
 
-    evt = event
+    Returns: (message, reply). The message is None if there is nothing to
+        dispatch, in which case reply (if not None) should be sent as is.
+    '''
 
     logging.debug(str(evt))
 
     if 'user' not in evt:
-        return None
+        return (None, None)
 
     user_id = evt['user']
     channel_id = evt['channel']
     msg_text = evt['text']
 
     if user_id == app_state.bot_user_id:
-        return None
+        return (None, None)
     
-    app_state.message_count += 1
-
-    direct_msg = channel_id.startswith('D')
+    app_state.message_count.increment()
 
     if ':sheep:' in msg_text:
-        say("Did someone say :sheep:?")
-        return None
+        return (None, "Did someone say :sheep:?")
 
-    if user_id in app_state.conversations:
-        reply = continue_conversation(user_id, msg_text)
-        if reply is not None:
-            say(reply)
-        return None
+    conv = app_state.conversations.get(user_id)
+    if conv is not None:
+        return (None, continue_conversation(user_id, conv, msg_text))
+
+    return (parse_message(user_id, channel_id, msg_text, say, client), None)
+
+def parse_message(user_id, channel_id, msg_text, say, client):
+    '''
+    Turn message text into a `Message` for the router.
+
+    Returns: the message, or None if it isn't addressed to the bot
+    '''
+
+    direct_msg = channel_id.startswith('D')
 
     if app_state.bot_user_ref in msg_text:
         direct_msg = True
@@ -148,369 +191,538 @@ def proc_msg(event, say, client):
         return None
 
     msg_lower = msg_text.lower()
-    msg_stripped = str(msg_lower).translate(str.maketrans('','','.,!?:;'))
-
-    if 'ease' in msg_stripped and 'help' in msg_stripped:
-        reply = start_conversation('ease',user_id)
-    elif msg_stripped in data.acronyms:
-        reply = "*{0}* is {1}".format(msg_text, data.acronyms[msg_stripped]['desc'])
-        if data.acronyms[msg_stripped]['url'] != None:
-            reply += "\n<{0}|more info>".format(data.acronyms[msg_stripped]['url'])
-    elif msg_stripped == 'help':
-        reply = "I understand:\n"
-        reply += "  &lt;7 character abbreviations\n"
-        reply += "  Yarn weights\n"
-        reply += "  Needle/Hook sizes (say 'US 10', '5mm', 'Crochet L', etc)\n"
-        reply += "  Basic arithmetic expressions\n"
-        reply += "  *weights*: List all yarn weights\n"
-        reply += "  *needles* or *hooks*: List all needles/hooks\n"
-        reply += "  *ravelry favorites* &lt;Ravelry Username&gt;\n"
-        reply += "  *ravelry favorites* &lt;Ravelry Username&gt; *tagged* &lt;tag&gt;\n"
-        reply += "  *ravelry search* &lt;search terms&gt;: Search patterns\n"
-        reply += "  *ravelry yarn* &lt;search terms&gt;: Search yarn\n"
-        reply += "  *ravelry yarn similar to* &lt;search terms&gt;: Find similar yarn\n"
-        reply += "  *info*: Yarnbot info\n"
-        reply += "  *help*: This text"
-    elif msg_stripped in data.yarn_weights:
-        yarn_info = data.yarn_weights[msg_stripped]
-        reply = "*{0}* weight yarn is number {1}, typically {2} stitches per 4 in., {3}-ply, {4} wraps per inch".format(msg_stripped,
-            yarn_info['number'],
-            yarn_info['gauge'],
-            yarn_info['ply'],
-            yarn_info['wpi'])
-    elif msg_lower.startswith('us '):
-        m = re.match('^us ([0-9.]+)', msg_lower)
-        if m:
-            size = m.groups()[0]
-            if size in data.needles_by_us:
-                reply = "*US size {0}* is {1} mm, UK {2}, Crochet {3}".format(size,
-                        data.needles_by_us[size]['metric'],
-                        data.needles_by_us[size]['uk'],
-                        data.needles_by_us[size]['crochet'])
-            else:
-                reply = "US {0} doesn't seem to be a standard size.".format(size)
-    elif msg_lower.startswith('uk '):
-        m = re.match('^uk ([0-9.]+)', msg_lower)
-        if m:
-            size = m.groups()[0]
-            if size in data.needles_by_uk:
-                reply = "*UK size {0}* is {1} mm, US {2}, Crochet {3}".format(size,
-                        data.needles_by_uk[size]['metric'],
-                        data.needles_by_uk[size]['us'],
-                        data.needles_by_uk[size]['crochet'])
-            else:
-                reply = "UK {0} doesn't seem to be a standard size.".format(size)
-    elif re.match('^[0-9.]+ *mm', msg_lower):
-        m = re.match('^([0-9.]+) *mm', msg_lower)
-        if m:
-            size = "{0:.2f}".format(float(m.groups()[0]))
-            if size in data.needles_by_metric:
-                reply = "*{0} mm* needles/hooks are US {1}, UK {2}, Crochet {3}".format(size,
-                        data.needles_by_metric[size]['us'],
-                        data.needles_by_metric[size]['uk'],
-                        data.needles_by_metric[size]['crochet'])
-            else:
-                reply = "{0} mm doesn't seem to be a standard size.".format(size)
-    elif msg_lower.startswith('crochet '):
-        m = re.match('^crochet ([a-z])', msg_lower)
-        if m:
-            size = m.groups()[0].upper()
-            if size in data.needles_by_crochet:
-                reply = "*Crochet {0}* is {1} mm, US {2}, UK {3}".format(size,
-                        data.needles_by_crochet[size]['metric'],
-                        data.needles_by_crochet[size]['us'],
-                        data.needles_by_crochet[size]['uk'])
-            else:
-                reply = "Crochet {0} doesn't seem to be a standard size.".format(size)
-
-    elif msg_stripped == 'weights':
-        reply = "These are all of the yarn weights I know about:\n"
-        for w in sorted(data.yarn_weights.keys(),key=lambda x: data.yarn_weights[x]['number']):
-            reply += "  *{0}*: {1} ply, {2} wpi, {3} per 4 in. typical gauge, number {4}\n".format(w,
-                     data.yarn_weights[w]['ply'],data.yarn_weights[w]['wpi'],
-                     data.yarn_weights[w]['gauge'],data.yarn_weights[w]['number'])
-
-    elif msg_stripped == 'needles' or msg_stripped == 'hooks':
-        reply = "These are all of the needles/hooks I know about:\n"
-        for size in sorted(data.needles_by_metric.keys(),key=float):
-            reply += "*{0} mm* needles/hooks are US {1}, UK {2}, Crochet {3}\n".format(size,
-                    data.needles_by_metric[size]['us'],
-                    data.needles_by_metric[size]['uk'],
-                    data.needles_by_metric[size]['crochet'])
-
-    elif msg_lower.startswith('welcome '):
-        m = re.match('^welcome <@(u[a-z0-9]+)>', msg_lower)
-        logging.info('Got welcome command: {0} {1}'.format(msg_lower,m))
-
-        if m:
-            to_user_id = m.groups()[0].upper()
-            logging.info('welcome from {0} to {1}'.format(user_id,to_user_id))
-            welcome_msg(to_user_id, user_id)
-            reply = "Welcome message sent!"
-
-    elif msg_stripped == 'runningconversations':
-        try:
-            convs = [ u + ': ' + c.label for (u,c) in app_state.conversations.items() ]
-            reply = '\n'.join(convs)
-        except:
-            reply = "Couldn't list conversations"
+    msg_stripped = msg_lower.translate(MSG_PUNC_TABLE)
 
-    elif re.match('^[0-9+-/*. ()]+$', msg_orig.strip()):
-        try:
-            reply = '{0}'.format( eval(msg_orig.strip()) )
-        except:
-            reply = "Arithmetic evaluation error"
+    msg = Message(user_id=user_id, channel_id=channel_id, text=msg_text,
+        orig=msg_orig.strip(), lower=msg_lower, stripped=msg_stripped,
+        say=say, client=client)
 
-    # Ravelry subcommands
-    elif msg_stripped.startswith('ravelry '):
+    return msg
 
-        try:
-            rav_cmd = msg_stripped.split()
-            
-            if rav_cmd[1] in ['yarn','yarns'] and rav_cmd[2] in ['similar','comparable'] and rav_cmd[3] == 'to':
-
-                if 'force' in rav_cmd:
-                    force_search = True
-                    rav_cmd.remove('force')
-                else:
-                    force_search = False
+def rate_limit(msg, route):
+    '''
+    Apply the per-user, per-channel and Ravelry rate limits to a message
+    about to be dispatched. Only the first of a run of throttled messages
+    from a user or channel, or of Ravelry commands refused for being over
+    the global limit, gets a reply, so a flood isn't answered with one.
 
-                target_results, msg, parms = ravelry_api_yarn(rav_cmd[4:])
-
-                num_yarns = target_results['paginator']['results']
-
-                if not force_search and num_yarns > 5:
-                    reply = 'That yarn description returned {0} results, which is probably'.format(num_yarns)
-                    reply += ' too many for a good comparison. Try adding more search terms'
-                    reply += ' (especially weight and fiber), or add "force" to your search'
-                    reply += ', which will just pick the top result.'
-                    say(reply)
-                    return None
-                elif num_yarns < 1:
-                    reply = "That yarn description didn't return any results :disappointed:"
-                    say(reply)
-                    return None
-
-                target_yarn = target_results['yarns'][0]
-
-                detail_results = ravelry_api('yarns/{0}.json'.format(target_yarn['id']), {'id': target_yarn['id']})
-                target_yarn_detail = detail_results['yarn']
-                target_fibers = [ x['fiber_type']['name'].lower().replace(' ','-') for x in target_yarn_detail['yarn_fibers'] ]
-
-                target_weight = target_yarn_detail['yarn_weight']['name'].lower().replace(' ','-')
-
-                similar_results, msg, parms = ravelry_api_yarn(target_fibers + [target_weight], 50)
-
-                if similar_results['paginator']['results'] < 1:
-                    reply = 'No results.... somehow'
-                    say(reply)
-                    return None
-
-                # Sort results by yarn comparison
-                
-                similar_sorted = sorted(similar_results['yarns'], key=lambda x: yarn_distance(target_yarn, x))
-                attachments = []
-                for info in similar_sorted[0:5]:
-                    
-                    mach_wash = info['machine_washable'] if 'machine_washable' in info else None
-                    if mach_wash == None or not mach_wash:
-                        mach_wash = 'No'
-                    else:
-                        mach_wash = 'Yes'
-
-                    organic = info['organic'] if 'organic' in info else None
-                    if organic == None or not organic:
-                        organic = 'No'
-                    else:
-                        organic = 'Yes'
-
-                    description = info['yarn_weight']['name']
-                    if info['gauge_divisor'] != None:
-                        gauge_range = []
-                        if info['min_gauge'] != None:
-                            gauge_range.append(str(info['min_gauge']))
-                        if info['max_gauge'] != None:
-                            gauge_range.append(str(info['max_gauge']))
-
-                        description += ', {0} sts = {1} in'.format(' to '.join(gauge_range), info['gauge_divisor'])
-
-                    description += ', {0} g, {1} yds'.format(info['grams'],info['yardage'])
-
-                    attachment = dict()
-                    attachment['fallback'] = info['name']
-                    attachment['color'] = '#36a64f'
-                    attachment['author_name'] = info['yarn_company_name']
-                    attachment['title'] = info['name']
-                    if info['discontinued']:
-                        attachment['title'] += ':skull:'
-
-                    attachment['title_link'] = 'https://www.ravelry.com/yarns/library/' + info['permalink']
-                    attachment['text'] = description
-                    attachment['thumb_url'] = info['first_photo']['square_url']
-                    attachment['fields'] = [ {'title':'Machine Washable', 'value': mach_wash, 'short': True},
-                                             {'title':'Organic', 'value': organic, 'short': True} ]
-
-                    attachments.append( attachment )
-
-                msg = u"Yarn most similar to {0} {1} {2}-weight ({3})".format(target_yarn['yarn_company_name'],target_yarn['name'],target_weight,','.join(target_fibers))
-                attach_json = json.dumps( attachments )
-
-                send_msg(client, channel_id, msg, attach_json)
-
-                return None
-
-            elif rav_cmd[1] == 'yarn':
-
-                (msg, attach) = ravelry_yarn(rav_cmd[2:])
-
-                if msg != None:
-                    send_msg(client, channel_id, msg, attach)
-                else:
-                    say(':disappointed:')
-
-                return None
-
-
-            elif rav_cmd[1] == 'search':
-                
-                (msg, attach) = ravelry_pattern(rav_cmd[2:])
-
-                if msg != None:
-                    send_msg(client, channel_id, msg, attach)
-                else:
-                    say(':disappointed:')
-
-                return None
-
-            if rav_cmd[1] == 'favorites':
-                fav_user = rav_cmd[2]
-                parms = {'username':fav_user, 'page_size':'5'}
-                msg = u"Most recent favorites for {0}".format(fav_user)
-                if len(rav_cmd) > 3:
-                    if rav_cmd[3] == 'tagged' and len(rav_cmd) > 4:
-                        parms.update( {'tag': rav_cmd[4]} )
-                        msg += u', tagged {0}'.format(rav_cmd[4])
-                    else:
-                        query = " ".join(rav_cmd[3:])
-                        parms.update( {'query': query} )
-                        msg += u', containing {0}'.format(query) 
-                rav_result = ravelry_api('/people/{0}/favorites/list.json'.format(fav_user), parms)
-
-                if rav_result['paginator']['results'] == 0:
-                    say(':disappointed:')
-                    return None
-
-                attachments = []
-                for fav in rav_result['favorites']:
-                    
-                    attachment = dict()
-                    attachment['fallback'] = fav['favorited']['name']
-                    attachment['color'] = '#36a64f'
-                    attachment['title'] = fav['favorited']['name']
-                    attachment['title_link'] = 'https://www.ravelry.com/patterns/library/' + fav['favorited']['permalink']
-
-                    # Sometime not everything is available
-                    try:
-                        attachment['image_url'] = fav['favorited']['first_photo']['square_url']
-                    except:
-                        logging.warn(u'Ravelry result with missing info: {0}'.format(fav))
-                    try:
-                        attachment['author_name'] = fav['favorited']['designer']['name']
-                    except:
-                        logging.warn(u'Ravelry result with missing info: {0}'.format(fav))
-
-                    attachments.append( attachment )
-
-                attach_json = json.dumps( attachments )
-
-                client.chat_postMessage(channel=channel_id,
-                    as_user=True,
-                    text=msg,
-                    attachments=attach_json)
-                return None
+    Returns: (whether to dispatch it, reply to send otherwise)
+    '''
 
-        except Exception as e:
-            reply = 'Ravelry command error'
-            logging.warn('Ravelry error line {0}: {1}'.format(sys.exc_info()[2].tb_lineno,e) )
-
-    elif msg_stripped == 'hello' or msg_stripped == 'hi' or msg_stripped.startswith('hello ') or msg_stripped.startswith('hi '):
-        reply_ind = random.choice( range(len(data.greetings)) )
-        reply = data.greetings[reply_ind]
-    elif msg_stripped.startswith('good') and (msg_stripped.endswith('morning') or msg_stripped.endswith('afternoon') or msg_stripped.endswith('night') or msg_stripped.endswith('evening')):
-        reply = ':kissing_heart:'
-    elif msg_stripped == 'info':
-        reply = "I'm yarnbot {0}, started on {1}.\n".format(__version__, time.ctime(app_state.start_time))
-        reply += "I've processed {0} messages ({1} unknown).".format(app_state.message_count, app_state.unknown_count)
-    elif msg_text == 'go to sleep':
-        logging.warn('Got kill message')
-        say("Ok, bye.")
+    (limit, refused) = rate_limiter.allow(msg.user_id, msg.channel_id,
+        route is not None and route.name in RAVELRY_ROUTES)
+
+    if limit == RAVELRY_LIMIT:
+        return (False, RAVELRY_BUSY_REPLY if refused == 1 else None)
+
+    if limit is not None:
+        logging.info('Throttled {0} in {1}'.format(msg.user_id, msg.channel_id))
+        return (False, THROTTLED_REPLY if refused == 1 else None)
+
+    return (True, None)
+
+def proc_msg(event, say, client):
+
+    start = time.perf_counter()
+    (msg, reply) = read_event(event, say, client)
+    parsed = time.perf_counter()
+
+    command = 'none'
+    if msg is not None:
+        route = router.route(msg)
+        (allowed, reply) = rate_limit(msg, route)
+        if allowed and route is not None:
+            command = route.name
+            reply = route.handler(msg, route.match)
+    elif reply is not None:
+        command = 'conversation'
+
+    metrics.record(COMMAND_SECONDS, parsed-start, command=command, phase='parse')
+    metrics.record(COMMAND_SECONDS, time.perf_counter()-parsed, command=command, phase='dispatch')
+
+    if reply is QUIT:
         return 'quit'
-    elif ('love' in msg_lower) or ('cute' in msg_lower) or ('best' in msg_lower) or ('awesome' in msg_lower) or ('great' in msg_lower):
-        reply = ":blush:"
-    elif ('thank you' in msg_lower) or ('thanks' in msg_lower):
-        reply = "My pleasure!"
-    elif ('tell' in msg_lower and 'joke' in msg_lower) or ('know' in msg_lower and 'jokes' in msg_lower):
-        reply_ind = random.choice( range(len(data.jokes)) )
-        reply = data.jokes[reply_ind]
+
+    if reply is not None:
+        with metrics.timer(COMMAND_SECONDS, command=command, phase='post'):
+            say(reply)
+
+    return None
+
+@router.predicate(lambda m: 'ease' in m.stripped and 'help' in m.stripped, early=True)
+def cmd_ease(msg, _match):
+    return start_conversation('ease', msg.user_id)
+
+def render_acronym(key):
+    if key not in data.acronyms:
+        return None
+    reply = "*{0}* is {1}".format(key, data.acronyms[key]['desc'])
+    if data.acronyms[key]['url'] != None:
+        reply += "\n<{0}|more info>".format(data.acronyms[key]['url'])
+    return reply
+
+@router.exact(*data.acronyms)
+def cmd_acronym(_msg, key):
+    return static_replies.get('acronym:' + key, lambda: render_acronym(key))
+
+def render_help():
+    reply = "I understand:\n"
+    reply += "  &lt;7 character abbreviations\n"
+    reply += "  Yarn weights\n"
+    reply += "  Needle/Hook sizes (say 'US 10', '5mm', 'Crochet L', etc)\n"
+    reply += "  Basic arithmetic expressions\n"
+    reply += "  *weights*: List all yarn weights\n"
+    reply += "  *needles* or *hooks*: List all needles/hooks\n"
+    reply += "  *ravelry favorites* &lt;Ravelry Username&gt;\n"
+    reply += "  *ravelry favorites* &lt;Ravelry Username&gt; *tagged* &lt;tag&gt;\n"
+    reply += "  *ravelry search* &lt;search terms&gt;: Search patterns\n"
+    reply += "  *ravelry yarn* &lt;search terms&gt;: Search yarn\n"
+    reply += "  *ravelry yarn similar to* &lt;search terms&gt;: Find similar yarn\n"
+    reply += "  *info*: Yarnbot info\n"
+    reply += "  *info stats*: Command and Ravelry latencies\n"
+    reply += "  *help*: This text"
+    return reply
+
+@router.exact('help')
+def cmd_help(_msg, _key):
+    return static_replies.get('help', render_help)
+
+def render_yarn_weight(key):
+    if key not in data.yarn_weights:
+        return None
+    yarn_info = data.yarn_weights[key]
+    return "*{0}* weight yarn is number {1}, typically {2} stitches per 4 in., {3}-ply, {4} wraps per inch".format(key,
+        yarn_info['number'],
+        yarn_info['gauge'],
+        yarn_info['ply'],
+        yarn_info['wpi'])
+
+@router.exact(*data.yarn_weights)
+def cmd_yarn_weight(_msg, key):
+    return static_replies.get('weight:' + key, lambda: render_yarn_weight(key))
+
+@router.prefix('us ')
+def cmd_us_size(msg, _prefix):
+    m = US_SIZE_RE.match(msg.lower)
+    if not m:
+        return None
+    return needle_sizes.us_reply(m.groups()[0])
+
+@router.prefix('uk ')
+def cmd_uk_size(msg, _prefix):
+    m = UK_SIZE_RE.match(msg.lower)
+    if not m:
+        return None
+    return needle_sizes.uk_reply(m.groups()[0])
+
+@router.regex('^([0-9.]+) *mm')
+def cmd_metric_size(_msg, m):
+    return needle_sizes.metric_reply(m.groups()[0])
+
+@router.prefix('crochet ')
+def cmd_crochet_size(msg, _prefix):
+    m = CROCHET_SIZE_RE.match(msg.lower)
+    if not m:
+        return None
+    return needle_sizes.crochet_reply(m.groups()[0])
+
+def render_weights():
+    reply = "These are all of the yarn weights I know about:\n"
+    for w in sorted(data.yarn_weights.keys(),key=lambda x: data.yarn_weights[x]['number']):
+        reply += "  *{0}*: {1} ply, {2} wpi, {3} per 4 in. typical gauge, number {4}\n".format(w,
+                 data.yarn_weights[w]['ply'],data.yarn_weights[w]['wpi'],
+                 data.yarn_weights[w]['gauge'],data.yarn_weights[w]['number'])
+    return reply
+
+@router.exact('weights')
+def cmd_weights(_msg, _key):
+    return static_replies.get('weights', render_weights)
+
+@router.exact('needles', 'hooks')
+def cmd_needles(_msg, _key):
+    return static_replies.get('needles', lambda: needle_sizes.table_reply)
+
+@router.prefix('welcome ')
+def cmd_welcome(msg, _prefix):
+    m = WELCOME_RE.match(msg.lower)
+    logging.info('Got welcome command: {0} {1}'.format(msg.lower,m))
+
+    if not m:
+        return None
+
+    to_user_id = m.groups()[0].upper()
+    logging.info('welcome from {0} to {1}'.format(msg.user_id,to_user_id))
+    welcome_msg(msg.client, to_user_id, msg.user_id)
+    return "Welcome message sent!"
+
+@router.exact('runningconversations')
+def cmd_running_conversations(_msg, _key):
+    try:
+        convs = [ '{0}: {1} ({2})'.format(u, c.name, c.label) for (u,c) in app_state.conversations.items() ]
+        sessions = app_state.conversations.summary()
+        convs.append('{0} active, {1} expired, {2} evicted'.format(sessions['active'],
+            sessions['expired'], sessions['evicted']))
+        return '\n'.join(convs)
+    except:
+        return "Couldn't list conversations"
+
+@router.regex('^[0-9+-/*. ()]+$', attr='orig')
+def cmd_arithmetic(msg, _match):
+    result = arith.evaluate_cached(msg.orig)
+
+    if result is None:
+        return "Arithmetic evaluation error"
+
+    return '{0}'.format(result)
+
+def similar_target_words(rav_cmd):
+    '''
+    Returns: (yarn search words for the target yarn, whether to force the search)
+    '''
+
+    if 'force' in rav_cmd:
+        force_search = True
+        rav_cmd.remove('force')
     else:
-        reply_ind = random.choice( range(len(data.unknown_replies)) )
-        reply = data.unknown_replies[reply_ind]
-        app_state.unknown_count += 1
+        force_search = False
+
+    return (rav_cmd[4:], force_search)
+
+def similar_target_error(target_results, force_search):
+    '''
+    Returns: a reply if the target search didn't narrow things down to one
+        yarn, otherwise None
+    '''
 
-    say(reply)
+    num_yarns = target_results['paginator']['results']
+
+    if not force_search and num_yarns > 5:
+        reply = 'That yarn description returned {0} results, which is probably'.format(num_yarns)
+        reply += ' too many for a good comparison. Try adding more search terms'
+        reply += ' (especially weight and fiber), or add "force" to your search'
+        reply += ', which will just pick the top result.'
+        return reply
+    elif num_yarns < 1:
+        return "That yarn description didn't return any results :disappointed:"
 
     return None
 
-def send_msg(client, channel_id, msg, attach=None):
+def ravelry_similar(rav_cmd):
+
+    (target_words, force_search) = similar_target_words(rav_cmd)
+
+    target_results, rav_msg, parms = ravelry_api_yarn(target_words)
+
+    reply = similar_target_error(target_results, force_search)
+    if reply is not None:
+        return (reply, None)
+
+    # Fetch details for the top few targets at once; only the first is
+    # needed now, the rest are warming the cache and catalog
+    targets = target_results['yarns'][:SIMILAR_PREFETCH]
+    details = prefetch_yarn_details([ y['id'] for y in targets ])
+
+    target_yarn = targets[0]
+    (target_yarn_detail, target_fibers) = details[0].result()
+
+    target_weight = weight_name(target_yarn_detail)
+
+    # Sort results by yarn comparison, locally if we've seen enough similar yarn
+
+    similar_sorted = similar_from_catalog(target_yarn, target_weight, target_fibers)
+
+    if similar_sorted is None:
+        similar_sorted = similar_yarns(target_yarn, target_fibers, target_weight, 5)
+
+        if len(similar_sorted) < 1:
+            return ('No results.... somehow', None)
+
+    return similar_reply(target_yarn, target_weight, target_fibers, similar_sorted)
+
+def similar_from_catalog(target_yarn, target_weight, target_fibers):
+
+    if ravelry.rav_catalog is None:
+        return None
+
+    return ravelry.rav_catalog.similar(target_yarn, target_weight, target_fibers,
+        5, CATALOG_MIN_CANDIDATES)
+
+def similar_reply(target_yarn, target_weight, target_fibers, similar_sorted):
+    '''
+    Returns: (message, attachments JSON) listing similar yarn
+    '''
+
+    rav_msg = u"Yarn most similar to {0} {1} {2}-weight ({3})".format(target_yarn['yarn_company_name'],target_yarn['name'],target_weight,','.join(target_fibers))
+
+    return (rav_msg, attachments_json( yarn_card(info) for info in similar_sorted[0:5] ))
 
-    #logging.info('Sending a message to {0}: {1}'.format(channel_id, msg))
-    if attach == None:
-        client.chat_postMessage(channel=channel_id,
-            as_user=True,
-            text=msg)
+def ravelry_favorites(rav_cmd):
+
+    (fav_user, rav_msg, parms) = favorites_parms(rav_cmd)
+
+    rav_result = ravelry_api('/people/{0}/favorites/list.json'.format(fav_user), parms)
+
+    return favorites_reply(rav_result, rav_msg)
+
+def favorites_parms(rav_cmd):
+    '''
+    Returns: (Ravelry user name, description of the search, parameters)
+    '''
+
+    fav_user = rav_cmd[2]
+    parms = {'username':fav_user, 'page_size':'5'}
+    rav_msg = u"Most recent favorites for {0}".format(fav_user)
+    if len(rav_cmd) > 3:
+        if rav_cmd[3] == 'tagged' and len(rav_cmd) > 4:
+            parms.update( {'tag': rav_cmd[4]} )
+            rav_msg += u', tagged {0}'.format(rav_cmd[4])
+        else:
+            query = " ".join(rav_cmd[3:])
+            parms.update( {'query': query} )
+            rav_msg += u', containing {0}'.format(query) 
+
+    return (fav_user, rav_msg, parms)
+
+def favorites_reply(rav_result, rav_msg):
+    '''
+    Returns: (message, attachments JSON) for a user's favorites, or
+        (None, None) if there weren't any
+    '''
+
+    if rav_result['paginator']['results'] == 0:
+        return (None, None)
+
+    return (rav_msg, attachments_json( favorite_card(fav['favorited']) for fav in rav_result['favorites'] ))
+
+def ravelry_command(rav_cmd):
+    '''
+    Run a Ravelry subcommand.
+
+    Returns: (message, attachments JSON), where either can be None
+    '''
+
+    try:
+        if rav_cmd[1] in ['yarn','yarns'] and rav_cmd[2] in ['similar','comparable'] and rav_cmd[3] == 'to':
+            return ravelry_similar(rav_cmd)
+
+        elif rav_cmd[1] == 'yarn':
+            return ravelry_yarn(rav_cmd[2:])
+
+        elif rav_cmd[1] == 'search':
+            return ravelry_pattern(rav_cmd[2:])
+
+        elif rav_cmd[1] == 'favorites':
+            return ravelry_favorites(rav_cmd)
+
+    except Exception as e:
+        logging.warn('Ravelry error line {0}: {1}'.format(sys.exc_info()[2].tb_lineno,e) )
+        return ('Ravelry command error', None)
+
+    return (None, None)
+
+def ravelry_respond(client, channel_id, placeholder_ts, rav_cmd):
+    '''
+    Worker side of a Ravelry command: run it, then replace the placeholder
+    message with the results.
+    '''
+    with metrics.timer(COMMAND_SECONDS, command='cmd_ravelry', phase='worker'):
+        (rav_msg, attach) = ravelry_command(rav_cmd)
+
+    if rav_msg is None:
+        rav_msg = ':disappointed:'
+
+    if placeholder_ts is None:
+        send_msg(client, channel_id, rav_msg, attach)
     else:
-        client.chat_postMessage(channel=channel_id,
-            as_user=True,
-            text=msg,
-            attachments=attach)
+        update_msg(client, channel_id, placeholder_ts, rav_msg, attach)
 
-def send_direct_msg(client, user_id, msg):
+@router.prefix('ravelry ', attr='stripped')
+def cmd_ravelry(msg, _prefix):
 
-    #send_msg(user_id, msg)
-    #return
+    rav_cmd = msg.stripped.split()
 
-    im = client.im.open(user_id)
+    if len(rav_cmd) < 2 or rav_cmd[1] not in RAVELRY_SUBCOMMANDS:
+        return None
+
+    tasks = app_state.ravelry_tasks
+    if tasks is None:
+        # No workers started, as when yarnbot is imported rather than run
+        ravelry_respond(msg.client, msg.channel_id, None, rav_cmd)
+        return None
 
+    # Ravelry calls are slow, so answer right away and finish on a worker
+    # thread, keeping the listener free for everything else
+    if tasks.full():
+        return RAVELRY_BUSY_REPLY
+
+    placeholder = send_msg(msg.client, msg.channel_id, RAVELRY_PLACEHOLDER)
     try:
-        if not 'ok' in im or not im['ok']:
-            logging.warn('im open failed')
-            return
+        placeholder_ts = placeholder['ts']
     except:
-        logging.warn('bad im return value: {0}'.format(im))
-        return
-    
-    #logging.info('opened IM {0}'.format(im))
-    
-    im_channel = im['channel']['id']
+        logging.warn('Ravelry placeholder not posted: {0}'.format(placeholder))
+        placeholder_ts = None
+
+    if not tasks.submit(ravelry_respond, msg.client, msg.channel_id, placeholder_ts, rav_cmd):
+        if placeholder_ts is None:
+            return RAVELRY_BUSY_REPLY
+        update_msg(msg.client, msg.channel_id, placeholder_ts, RAVELRY_BUSY_REPLY)
+
+    return None
+
+@router.exact('hello', 'hi')
+@router.prefix('hello ', 'hi ', attr='stripped')
+def cmd_hello(_msg, _match):
+    return random.choice(data.greetings)
+
+@router.predicate(lambda m: m.stripped.startswith('good') and m.stripped.endswith(('morning','afternoon','night','evening')))
+def cmd_good_time_of_day(_msg, _match):
+    return ':kissing_heart:'
+
+@router.exact('info')
+def cmd_info(_msg, _key):
+    reply = "I'm yarnbot {0}, started on {1}.\n".format(__version__, time.ctime(app_state.start_time))
+    reply += "I've processed {0} messages ({1} unknown).".format(app_state.message_count, app_state.unknown_count)
+    sessions = app_state.conversations.summary()
+    reply += "\nConversations: {0} active, {1} expired, {2} evicted".format(sessions['active'],
+        sessions['expired'], sessions['evicted'])
+    for (endpoint,stats) in sorted(rav_stats.summary().items()):
+        reply += "\nRavelry {0}: {1} calls ({2} errors, {3} retries), {4:.0f} ms mean, {5:.0f} ms p99".format(endpoint,
+            stats['count'], stats['errors'], stats['retries'], stats['mean_ms'], stats['p99_ms'])
+    cache = rav_cache.summary()
+    reply += "\nRavelry cache: {0} entries ({1} KB), {2} hits, {3} misses, {4} evictions, {5} expired".format(cache['entries'],
+        cache['bytes']//1024, cache['hits'], cache['misses'], cache['evictions'], cache['expirations'])
+    details = ravelry.detail_loader.summary()
+    reply += "\nYarn details: {0} batched requests, {1} single, {2} shared in flight".format(details['batches'],
+        details['singles'], details['shared'])
+    flight = ravelry.rav_flight.summary()
+    reply += "\nRavelry calls coalesced: {0} of {1}".format(flight['shared'], flight['calls'] + flight['shared'])
+    directory = slack_directory.summary()
+    reply += "\nSlack directory: {0} users, {1} IM channels, {2} hits, {3} misses".format(directory['users']['entries'],
+        directory['ims']['entries'], directory['users']['hits'] + directory['ims']['hits'],
+        directory['users']['misses'] + directory['ims']['misses'])
+    limits = rate_limiter.summary()
+    reply += "\nThrottled: {0} by user, {1} by channel, {2} Ravelry".format(limits['users']['throttled'],
+        limits['channels']['throttled'], limits['ravelry']['throttled'])
+    replies = static_replies.summary()
+    reply += "\nStatic replies: {0} rendered, {1} hits".format(replies['entries'], replies['hits'])
+    cards = card_cache.summary()
+    reply += "\nResult cards: {0} rendered, {1} hits".format(cards['entries'], cards['hits'])
+    return reply
+
+# Order of histogram labels in `info stats`
+STATS_LABELS = ('upstream', 'endpoint', 'command', 'phase')
+
+@router.exact('info stats')
+def cmd_info_stats(_msg, _key):
+    '''
+    Median and 99th percentile latencies per command phase and upstream call.
+    '''
+    lines = []
+    for (name, labels, hist) in metrics.items():
+        snap = hist.snapshot()
+        label = ' '.join(dict(labels).get(k, '') for k in STATS_LABELS).strip()
+        lines.append('{0:<40} {1:>9.1f} {2:>9.1f} {3:>7}'.format(label[:40],
+            1e3*snap['p50'], 1e3*snap['p99'], snap['count']))
+
+    if len(lines) == 0:
+        return 'No stats yet'
+
+    header = '{0:<40} {1:>9} {2:>9} {3:>7}'.format('', 'p50 ms', 'p99 ms', 'count')
+    return '```' + '\n'.join([header] + lines) + '```'
+
+@router.predicate(lambda m: m.text == 'go to sleep')
+def cmd_sleep(msg, _match):
+    logging.warn('Got kill message')
+    msg.say("Ok, bye.")
+    return QUIT
+
+@router.predicate(lambda m: any(w in m.lower for w in ('love','cute','best','awesome','great')))
+def cmd_compliment(_msg, _match):
+    return ":blush:"
+
+@router.predicate(lambda m: 'thank you' in m.lower or 'thanks' in m.lower)
+def cmd_thanks(_msg, _match):
+    return "My pleasure!"
+
+@router.predicate(lambda m: ('tell' in m.lower and 'joke' in m.lower) or ('know' in m.lower and 'jokes' in m.lower))
+def cmd_joke(_msg, _match):
+    return random.choice(data.jokes)
+
+@router.default
+def cmd_unknown(_msg, _match):
+    app_state.unknown_count.increment()
+    return random.choice(data.unknown_replies)
+
+def send_msg(client, channel_id, msg, attach=None):
+
+    with metrics.timer(UPSTREAM_SECONDS, upstream='slack', endpoint='chat.postMessage'):
+        if attach == None:
+            return client.chat_postMessage(channel=channel_id,
+                as_user=True,
+                text=msg)
+        else:
+            return client.chat_postMessage(channel=channel_id,
+                as_user=True,
+                text=msg,
+                attachments=attach)
+
+def update_msg(client, channel_id, ts, msg, attach=None):
+
+    with metrics.timer(UPSTREAM_SECONDS, upstream='slack', endpoint='chat.update'):
+        if attach == None:
+            return client.chat_update(channel=channel_id,
+                ts=ts,
+                text=msg)
+        else:
+            return client.chat_update(channel=channel_id,
+                ts=ts,
+                text=msg,
+                attachments=attach)
+
+def send_direct_msg(client, user_id, msg):
+
+    im_channel = slack_directory.im_channel(user_id)
+
+    if im_channel is None:
+        im = client.conversations_open(users=user_id)
+
+        try:
+            if not 'ok' in im or not im['ok']:
+                logging.warn('im open failed')
+                return
+        except:
+            logging.warn('bad im return value: {0}'.format(im))
+            return
+
+        im_channel = im['channel']['id']
+        slack_directory.put_im(user_id, im_channel)
 
     send_msg(client, im_channel, msg)
 
 def welcome_msg(client, user_id, from_user_id=None):
 
     logging.info('Sending welcome message from {0} to {1}'.format(from_user_id,user_id))
-    user_info = client.user_info(user_id)
+    user = slack_directory.user(user_id)
 
-    try:
-        if not 'ok' in user_info or not user_info['ok']:
-            logging.warn('Error getting user info')
+    if user is None:
+        user_info = client.users_info(user=user_id)
+
+        try:
+            if not 'ok' in user_info or not user_info['ok']:
+                logging.warn('Error getting user info')
+                return
+        except:
+            logging.warn("user_info wasn't a dict: {0}".format(user_info))
             return
-    except:
-        logging.warn("user_info wasn't a dict: {0}".format(user_info))
-        return
 
-    #logging.info('Got user info {0}'.format(user_info))
+        user = user_info['user']
+        slack_directory.put_user(user)
+
+    user_name = user['name']
 
-    user_name = user_info['user']['name']
+    send_direct_msg(client, user_id, welcome_text(user_name, from_user_id))
+
+def welcome_text(user_name, from_user_id=None):
 
     welcome = 'Hello ' + user_name + "!\n"
 
@@ -523,74 +735,153 @@ def welcome_msg(client, user_id, from_user_id=None):
     welcome += "this direct message, or by starting a message with '@yarnbot'\n"
     welcome += "Say 'help' to get a list of things I can do."
 
-    send_direct_msg(client, user_id, welcome)
+    return welcome
 
-@app.event('team_join')
-def welcome_user(event, client):
+def new_user(user):
+    '''
+    Record a user joining the team.
+
+    Returns: True if the user should be welcomed
+    '''
 
-    user = event['user']
+    slack_directory.put_user(user)
 
     if 'is_bot' in user and user['is_bot']:
-        return
-        
-    if user['id'] not in app_state.known_users:
-        app_state.known_users.append(user['id'])
-        save_userdb()
+        return False
+
+    return app_state.known_users.add(user['id'])
+
+def welcome_user(event, client):
+
+    if new_user(event['user']):
         logging.info('Sending welcome message')
-        welcome_msg(client, user['id'])
+        welcome_msg(client, event['user']['id'])
 
+def user_changed(event):
 
-def load_userdb():
+    slack_directory.user_changed(event['user'])
+
+def slack_page(method, **kwargs):
+    '''
+    Call a Slack list method for one page, waiting as long as Slack asks
+    whenever it rate limits the call, up to SLACK_PAGE_RETRIES times.
+    '''
+
+    attempt = 0
+    while True:
+        try:
+            return method(**kwargs)
+        except Exception as e:
+            delay = retry_after(e)
+            if delay is None or attempt >= SLACK_PAGE_RETRIES:
+                raise
+            logging.info('Slack rate limited the directory warm-up, waiting {0}s'.format(delay))
+            time.sleep(delay)
+            attempt += 1
+
+def warm_directory(client):
+    '''
+    Fill the Slack user and IM channel caches, a page at a time.
+    '''
 
     try:
-        userdb_file = open(USERDB_FILENAME, 'rb')
-    except:
-        userdb_file = open(USERDB_FILENAME, 'wb')
-        pickle.dump(app_state.known_users, userdb_file)
-        userdb_file.close()
+        cursor = None
+        while True:
+            cursor = slack_directory.add_users_page(slack_page(client.users_list,
+                limit=SLACK_PAGE_SIZE, cursor=cursor))
+            if cursor is None:
+                break
+
+        while True:
+            cursor = slack_directory.add_ims_page(slack_page(client.conversations_list,
+                types='im', limit=SLACK_PAGE_SIZE, cursor=cursor))
+            if cursor is None:
+                break
+    except Exception as e:
+        logging.warning('Slack directory warm-up stopped: {0}'.format(e))
         return
 
-    try:
-        app_state.nown_users = pickle.load(userdb_file)
-    except:
-        logging.error('Malformed userdb file')
-    
-    userdb_file.close()
+    logging.info('Slack directory warmed up: {0}'.format(slack_directory.summary()))
+
 
-def save_userdb():
+def load_userdb():
+    '''
+    Read the known users log, picking up users from an old pickle file if
+    one is still around.
+    '''
 
     try:
-        userdb_file = open(USERDB_FILENAME, 'wb')
-    except:
-        logging.error("Couldn't write userdb file")
-        return
+        app_state.known_users.open(USERDB_FILENAME, legacy_filename=LEGACY_USERDB_FILENAME)
+    except OSError as e:
+        logging.error("Couldn't open userdb file: {0}".format(e))
 
-    pickle.dump(app_state.known_users, userdb_file)
-    
-    userdb_file.close()
 
+def create_app():
 
-def main(app):
+    app = App(
+        token=os.environ.get("SLACK_BOT_TOKEN"),
+        signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+    )
 
-    logging.basicConfig(filename='yarnbot.log',level=logging.INFO)
-    
-    app_state.start_time = time.time()
+    app.event('message')(proc_msg)
+    app.event('team_join')(welcome_user)
+    app.event('user_change')(user_changed)
 
-    auth_info = app.client.auth_test()
+    start_ravelry_tasks()
+
+    return app
+
+def start_ravelry_tasks():
+    '''
+    Start the worker threads that finish Ravelry commands, once.
+    '''
+    if app_state.ravelry_tasks is None:
+        app_state.ravelry_tasks = TaskQueue('ravelry', RAVELRY_WORKERS, RAVELRY_MAX_PENDING)
 
-    my_user_id = auth_info['user_id']
+def init_state(my_user_id):
+    '''
+    Set up application state once we know who we are.
+    '''
 
     logging.info('My user id is {0}'.format(my_user_id))
 
     my_user = '<@' + my_user_id + '>'
     app_state.bot_user_id = my_user_id
     app_state.bot_user_ref = my_user
-    app_state.known_users = [my_user_id]
 
     load_userdb()
+    app_state.known_users.add(my_user_id)
+
+    app_state.conversations = open_session_store()
+    app_state.conversations.start_sweeper()
+
+    ravelry.rav_catalog = YarnCatalog(CATALOG_FILENAME)
+
+def reload_on_hangup():
+    '''
+    Reload the data tables, and drop the replies rendered from them, on SIGHUP.
+    '''
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda _signum, _frame: reload_data())
+
+def main(app):
+
+    logging.basicConfig(filename='yarnbot.log',level=logging.INFO)
+    
+    app_state.start_time = time.time()
+
+    auth_info = app.client.auth_test()
+
+    init_state(auth_info['user_id'])
+
+    start_exporters()
+
+    reload_on_hangup()
+
+    threading.Thread(target=warm_directory, args=(app.client,), name='slack-warmup', daemon=True).start()
 
     app.start()
 
 if __name__ == '__main__':
-    main(app)
+    main(create_app())
 
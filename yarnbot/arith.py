@@ -0,0 +1,93 @@
+'''
+Safe evaluation of arithmetic typed at the bot, like "24 * 4 / 5".
+
+Expressions are parsed with `ast` and only numeric literals, + - * / and
+unary signs are evaluated. Length, nesting depth, operand size and
+evaluation time are all limited, so no message can tie up a worker.
+'''
+
+import ast
+import math
+import time
+import operator
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Type, Union
+
+Number = Union[int, float]
+
+MAX_LENGTH = 200
+MAX_DEPTH = 32
+MAX_MAGNITUDE = 1e15
+MAX_SECONDS = 0.05
+CACHE_SIZE = 512
+
+BINARY_OPS: Dict[Type[ast.operator],Callable[[Number,Number],Number]] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    }
+
+UNARY_OPS: Dict[Type[ast.unaryop],Callable[[Number],Number]] = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    }
+
+class ArithError(ValueError):
+    '''
+    The expression isn't allowed, or breaks one of the limits
+    '''
+
+def checked(value: Number) -> Number:
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ArithError('Result is not finite')
+    if abs(value) > MAX_MAGNITUDE:
+        raise ArithError('Number too large')
+    return value
+
+def evaluate(expr: str) -> Number:
+    '''
+    Evaluate an arithmetic expression.
+
+    Raises: ArithError if the expression isn't plain arithmetic or breaks a
+        limit, SyntaxError if it doesn't parse, ZeroDivisionError
+    '''
+    if len(expr) > MAX_LENGTH:
+        raise ArithError('Expression too long')
+
+    tree = ast.parse(expr.strip(), mode='eval')
+    deadline = time.perf_counter() + MAX_SECONDS
+
+    def walk(node: ast.AST, depth: int) -> Number:
+        if depth > MAX_DEPTH:
+            raise ArithError('Expression too deeply nested')
+        if time.perf_counter() > deadline:
+            raise ArithError('Expression took too long')
+
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value: Number = node.value  # type: ignore[assignment]
+            return checked(value)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+            left = walk(node.left, depth+1)
+            right = walk(node.right, depth+1)
+            return checked(BINARY_OPS[type(node.op)](left, right))
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPS:
+            return checked(UNARY_OPS[type(node.op)](walk(node.operand, depth+1)))
+
+        raise ArithError('Not allowed: {0}'.format(type(node).__name__))
+
+    return walk(tree.body, 0)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def evaluate_cached(expr: str) -> Optional[Number]:
+    '''
+    `evaluate`, remembering recent expressions.
+
+    Returns: the result, or None if the expression can't be evaluated
+    '''
+    try:
+        return evaluate(expr)
+    except (ArithError, SyntaxError, ZeroDivisionError, RecursionError, MemoryError):
+        return None
@@ -0,0 +1,321 @@
+'''
+Asyncio entry point for yarnbot, using Bolt's AsyncApp and the aiohttp
+Ravelry client, so that one process can have many Ravelry lookups in
+flight without a thread for each.
+
+    python -m yarnbot --async
+
+Cheap commands are dispatched through the same router and handlers as the
+sync app. Handlers that talk to Slack or Ravelry have async versions here.
+'''
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from typing import Set
+
+from slack_bolt.async_app import AsyncApp
+
+from . import aioravelry
+from .app import (QUIT, RAVELRY_SUBCOMMANDS, SIMILAR_PREFETCH, WELCOME_RE,
+    favorites_parms, favorites_reply, init_state, new_user, rate_limit, read_event,
+    reload_on_hangup, router, similar_from_catalog, similar_reply, similar_target_error,
+    similar_target_words, welcome_text)
+from .metrics import COMMAND_SECONDS, UPSTREAM_SECONDS, metrics, start_exporters
+from .ravelry import weight_name
+from .slackcache import SLACK_PAGE_RETRIES, SLACK_PAGE_SIZE, retry_after, slack_directory
+from .state import app_state
+
+# Keeps fire-and-forget tasks alive until they finish
+background_tasks: Set[asyncio.Future] = set()
+
+def run_in_background(coro):
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def proc_msg(event, say, client):
+
+    # Conversations may be kept in SQLite or Redis; keep their I/O, and
+    # handlers that start or end one, off the event loop
+    blocking = app_state.conversations.blocking
+
+    start = time.perf_counter()
+    if blocking:
+        (msg, reply) = await asyncio.to_thread(read_event, event, say, client)
+    else:
+        (msg, reply) = read_event(event, say, client)
+    parsed = time.perf_counter()
+
+    command = 'none'
+    if msg is not None:
+        route = router.route(msg)
+        (allowed, reply) = rate_limit(msg, route)
+        if allowed and route is not None:
+            command = route.name
+            handler = ASYNC_HANDLERS.get(route.name)
+            if handler is not None:
+                reply = await handler(msg, route.match)
+            elif blocking:
+                reply = await asyncio.to_thread(route.handler, msg, route.match)
+            else:
+                reply = route.handler(msg, route.match)
+    elif reply is not None:
+        command = 'conversation'
+
+    metrics.record(COMMAND_SECONDS, parsed-start, command=command, phase='parse')
+    metrics.record(COMMAND_SECONDS, time.perf_counter()-parsed, command=command, phase='dispatch')
+
+    if reply is QUIT:
+        return 'quit'
+
+    if reply is not None:
+        with metrics.timer(COMMAND_SECONDS, command=command, phase='post'):
+            await say(reply)
+
+    return None
+
+async def cmd_welcome(msg, _prefix):
+    m = WELCOME_RE.match(msg.lower)
+    logging.info('Got welcome command: {0} {1}'.format(msg.lower,m))
+
+    if not m:
+        return None
+
+    to_user_id = m.groups()[0].upper()
+    logging.info('welcome from {0} to {1}'.format(msg.user_id,to_user_id))
+    await welcome_msg(msg.client, to_user_id, msg.user_id)
+    return "Welcome message sent!"
+
+async def cmd_sleep(msg, _match):
+    logging.warn('Got kill message')
+    await msg.say("Ok, bye.")
+    return QUIT
+
+async def ravelry_similar(rav_cmd):
+
+    (target_words, force_search) = similar_target_words(rav_cmd)
+
+    target_results, rav_msg, parms = await aioravelry.ravelry_api_yarn(target_words)
+
+    reply = similar_target_error(target_results, force_search)
+    if reply is not None:
+        return (reply, None)
+
+    targets = target_results['yarns'][:SIMILAR_PREFETCH]
+    details = [ run_in_background(aioravelry.yarn_detail(y['id'])) for y in targets ]
+
+    target_yarn = targets[0]
+    (target_yarn_detail, target_fibers) = await details[0]
+
+    target_weight = weight_name(target_yarn_detail)
+
+    similar_sorted = await asyncio.to_thread(similar_from_catalog, target_yarn, target_weight, target_fibers)
+
+    if similar_sorted is None:
+        similar_sorted = await aioravelry.similar_yarns(target_yarn, target_fibers, target_weight, 5)
+
+        if len(similar_sorted) < 1:
+            return ('No results.... somehow', None)
+
+    return similar_reply(target_yarn, target_weight, target_fibers, similar_sorted)
+
+async def ravelry_favorites(rav_cmd):
+
+    (fav_user, rav_msg, parms) = favorites_parms(rav_cmd)
+
+    rav_result = await aioravelry.ravelry_api('/people/{0}/favorites/list.json'.format(fav_user), parms)
+
+    return favorites_reply(rav_result, rav_msg)
+
+async def ravelry_command(rav_cmd):
+    '''
+    Async `app.ravelry_command`
+    '''
+
+    try:
+        if rav_cmd[1] in ['yarn','yarns'] and rav_cmd[2] in ['similar','comparable'] and rav_cmd[3] == 'to':
+            return await ravelry_similar(rav_cmd)
+
+        elif rav_cmd[1] == 'yarn':
+            return await aioravelry.ravelry_yarn(rav_cmd[2:])
+
+        elif rav_cmd[1] == 'search':
+            return await aioravelry.ravelry_pattern(rav_cmd[2:])
+
+        elif rav_cmd[1] == 'favorites':
+            return await ravelry_favorites(rav_cmd)
+
+    except Exception as e:
+        logging.warn('Ravelry error line {0}: {1}'.format(sys.exc_info()[2].tb_lineno,e) )
+        return ('Ravelry command error', None)
+
+    return (None, None)
+
+async def cmd_ravelry(msg, _prefix):
+
+    rav_cmd = msg.stripped.split()
+
+    if len(rav_cmd) < 2 or rav_cmd[1] not in RAVELRY_SUBCOMMANDS:
+        return None
+
+    (rav_msg, attach) = await ravelry_command(rav_cmd)
+
+    if rav_msg is None:
+        return ':disappointed:'
+
+    await send_msg(msg.client, msg.channel_id, rav_msg, attach)
+
+    return None
+
+# Replacements for sync router handlers, by route name
+ASYNC_HANDLERS = {
+    'cmd_welcome': cmd_welcome,
+    'cmd_sleep': cmd_sleep,
+    'cmd_ravelry': cmd_ravelry,
+    }
+
+async def send_msg(client, channel_id, msg, attach=None):
+
+    with metrics.timer(UPSTREAM_SECONDS, upstream='slack', endpoint='chat.postMessage'):
+        if attach == None:
+            return await client.chat_postMessage(channel=channel_id,
+                as_user=True,
+                text=msg)
+        else:
+            return await client.chat_postMessage(channel=channel_id,
+                as_user=True,
+                text=msg,
+                attachments=attach)
+
+async def send_direct_msg(client, user_id, msg):
+
+    im_channel = slack_directory.im_channel(user_id)
+
+    if im_channel is None:
+        im = await client.conversations_open(users=user_id)
+
+        try:
+            if not 'ok' in im or not im['ok']:
+                logging.warn('im open failed')
+                return
+        except:
+            logging.warn('bad im return value: {0}'.format(im))
+            return
+
+        im_channel = im['channel']['id']
+        slack_directory.put_im(user_id, im_channel)
+
+    await send_msg(client, im_channel, msg)
+
+async def welcome_msg(client, user_id, from_user_id=None):
+
+    logging.info('Sending welcome message from {0} to {1}'.format(from_user_id,user_id))
+    user = slack_directory.user(user_id)
+
+    if user is None:
+        user_info = await client.users_info(user=user_id)
+
+        try:
+            if not 'ok' in user_info or not user_info['ok']:
+                logging.warn('Error getting user info')
+                return
+        except:
+            logging.warn("user_info wasn't a dict: {0}".format(user_info))
+            return
+
+        user = user_info['user']
+        slack_directory.put_user(user)
+
+    user_name = user['name']
+
+    await send_direct_msg(client, user_id, welcome_text(user_name, from_user_id))
+
+async def welcome_user(event, client):
+
+    if await asyncio.to_thread(new_user, event['user']):
+        logging.info('Sending welcome message')
+        await welcome_msg(client, event['user']['id'])
+
+async def user_changed(event):
+
+    slack_directory.user_changed(event['user'])
+
+async def slack_page(method, **kwargs):
+    '''
+    Async `app.slack_page`
+    '''
+
+    attempt = 0
+    while True:
+        try:
+            return await method(**kwargs)
+        except Exception as e:
+            delay = retry_after(e)
+            if delay is None or attempt >= SLACK_PAGE_RETRIES:
+                raise
+            logging.info('Slack rate limited the directory warm-up, waiting {0}s'.format(delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+async def warm_directory(client):
+    '''
+    Async `app.warm_directory`
+    '''
+
+    try:
+        cursor = None
+        while True:
+            cursor = slack_directory.add_users_page(await slack_page(client.users_list,
+                limit=SLACK_PAGE_SIZE, cursor=cursor))
+            if cursor is None:
+                break
+
+        while True:
+            cursor = slack_directory.add_ims_page(await slack_page(client.conversations_list,
+                types='im', limit=SLACK_PAGE_SIZE, cursor=cursor))
+            if cursor is None:
+                break
+    except Exception as e:
+        logging.warning('Slack directory warm-up stopped: {0}'.format(e))
+        return
+
+    logging.info('Slack directory warmed up: {0}'.format(slack_directory.summary()))
+
+def create_app():
+
+    app = AsyncApp(
+        token=os.environ.get("SLACK_BOT_TOKEN"),
+        signing_secret=os.environ.get("SLACK_SIGNING_SECRET")
+    )
+
+    app.event('message')(proc_msg)
+    app.event('team_join')(welcome_user)
+    app.event('user_change')(user_changed)
+
+    return app
+
+def main(app):
+
+    logging.basicConfig(filename='yarnbot.log',level=logging.INFO)
+
+    app_state.start_time = time.time()
+
+    auth_info = asyncio.run(app.client.auth_test())
+
+    init_state(auth_info['user_id'])
+
+    start_exporters()
+
+    reload_on_hangup()
+
+    # The Slack client opens a new HTTP session per call, so it can be used
+    # from a second event loop while the app's own loop starts up
+    threading.Thread(target=asyncio.run, args=(warm_directory(app.client),),
+        name='slack-warmup', daemon=True).start()
+
+    app.start()
@@ -0,0 +1,828 @@
+'''
+Yarnbot benchmarks.
+
+    python -m yarnbot.bench dispatch
+    python -m yarnbot.bench stress
+    python -m yarnbot.bench replay [events.jsonl]
+    python -m yarnbot.bench query
+    python -m yarnbot.bench coalesce
+    python -m yarnbot.bench sessions
+    python -m yarnbot.bench distance
+
+The dispatch benchmark times `Router.route` over a fixed mix of messages
+(exact keys, prefixes, regexes and unknown text) while growing the number of
+registered commands, to show that per-message cost stays flat.
+
+The stress check sends messages through `app.proc_msg` from many threads at
+once, as Bolt's worker pool does, and checks that the message and unknown
+counts, a bare `ShardedCounter`, the known users and every conversation
+started and cancelled come out exact, exiting non-zero if any doesn't.
+--store runs the conversations through SQLite or a local Redis stand-in.
+
+The replay benchmark feeds Slack message events, one JSON object per line
+(bare events or Events API envelopes), through `app.proc_msg`, with Ravelry
+served by a local fake with a fixed response latency. It reports latency
+and allocations per command class. Without a corpus, a built-in mix of
+commands is used; --write-corpus saves it as a starting point.
+
+The query benchmark times turning Ravelry search words into search
+parameters with `query.Vocabulary`, against the list-scanning code it
+replaced, and checks that both give the same parameters wherever the old
+code wasn't tripped up by repeated words.
+
+The coalesce check fires identical Ravelry calls at once, from threads and
+from coroutines, at the fake Ravelry, and checks that each kind of call
+reaches it exactly once and every caller gets the same answer, even when
+the coroutine leading the call is cancelled, exiting non-zero if not.
+
+The sessions check runs the conversation stores, memory, SQLite and Redis,
+through put, get, pop, items, eviction and expiry, then has several
+writers fill a shared store at once and checks that it ends up exactly at
+its limit. Redis is served by a local stand-in, `fakes.FakeRedis`.
+
+The distance check compares the vectorized `feature_distances` with
+`feature_distance`, one pair at a time, over random features that include
+missing, zero and negative values, exiting non-zero if any differ.
+'''
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tracemalloc
+import requests
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import data
+from .fakes import FakeRavelry, FakeRedis, StubClient, stub_say
+from .router import Message, Router
+
+DISPATCH_MESSAGES = [
+    'k2tog', 'help', 'dk', 'us 10', 'uk 9', '5 mm', 'crochet k',
+    'ravelry search hat', '1 + 2', 'what is the meaning of life',
+    'i have no idea what this is', 'is there a yarn for that']
+
+def _handler(_msg, _match):
+    return None
+
+def build_router(num_commands: int) -> Router:
+    '''
+    Build a router with the same shape as yarnbot's, padded out with
+    `num_commands` synthetic exact keys and prefixes.
+    '''
+    router = Router()
+
+    router.predicate(lambda m: 'ease' in m.stripped and 'help' in m.stripped, early=True)(_handler)
+    router.exact('k2tog', 'help', 'dk', 'weights', 'needles', 'info')(_handler)
+    router.prefix('us ', 'uk ', 'crochet ', 'welcome ')(_handler)
+    router.prefix('ravelry ', 'hello ', 'hi ', attr='stripped')(_handler)
+    router.regex('^([0-9.]+) *mm')(_handler)
+    router.regex('^[0-9+-/*. ()]+$', attr='orig')(_handler)
+    router.predicate(lambda m: 'thanks' in m.lower)(_handler)
+    router.default(_handler)
+
+    for i in range(num_commands):
+        router.exact('cmd{0}'.format(i))(_handler)
+        router.prefix('prefix{0} '.format(i))(_handler)
+
+    return router
+
+def _message(text: str) -> Message:
+    lower = text.lower()
+    return Message(user_id='U0', channel_id='D0', text=text, orig=text,
+        lower=lower, stripped=lower, say=print, client=None)
+
+def bench_dispatch(num_commands: int, iterations: int) -> float:
+    '''
+    Returns: mean time in microseconds to route one message
+    '''
+    router = build_router(num_commands)
+    msgs = [ _message(t) for t in DISPATCH_MESSAGES ]
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for msg in msgs:
+            router.route(msg)
+    elapsed = time.perf_counter() - start
+
+    return 1e6*elapsed/(iterations*len(msgs))
+
+# Sent in turn by each stress thread; None marks the unknown command
+STRESS_MESSAGES = ['k2tog', 'dk', 'us 8', '2 + 2', None, 'ease help', 'have', 'cancel']
+STRESS_UNKNOWN = 'qwxz'
+STRESS_NEW_USERS = 50
+
+def bench_stress(num_threads: int, rounds: int, store: str='memory') -> bool:
+    '''
+    Returns: True if every count came out exact
+    '''
+    import tempfile
+    from . import app
+    from .ratelimit import TokenBuckets, rate_limiter
+    from .state import (ShardedCounter, RedisSessionStore, RespClient, SQLiteSessionStore,
+        app_state, open_session_store)
+
+    app_state.bot_user_id = 'UBOT'
+    app_state.bot_user_ref = '<@UBOT>'
+
+    # Measure the counts, not the rate limits
+    rate_limiter.users = TokenBuckets(0, float('inf'))
+    rate_limiter.channels = TokenBuckets(0, float('inf'))
+    rate_limiter.ravelry = TokenBuckets(0, float('inf'))
+
+    tmp = tempfile.TemporaryDirectory()
+    fake = FakeRedis() if store == 'redis' else None
+    if store == 'sqlite':
+        app_state.conversations = SQLiteSessionStore(tmp.name + '/sessions.db')
+    elif fake is not None:
+        app_state.conversations = RedisSessionStore(RespClient('127.0.0.1', fake.port))
+    else:
+        app_state.conversations = open_session_store('memory')
+
+    def say(*_args, **_kwargs):
+        pass
+
+    messages_before = app_state.message_count.value
+    unknown_before = app_state.unknown_count.value
+    users_before = len(app_state.known_users)
+    welcomed = [0]*num_threads
+    # Conversations started, and cancelled, that the store saw
+    started = [0]*num_threads
+    cancelled = [0]*num_threads
+    barrier = threading.Barrier(num_threads)
+
+    def run(i):
+        user_id = 'USTRESS{0}'.format(i)
+        barrier.wait()
+        for r in range(rounds):
+            for text in STRESS_MESSAGES:
+                event = {'user': user_id, 'channel': 'D' + user_id, 'text': text or STRESS_UNKNOWN}
+                app.proc_msg(event, say, None)
+                if text == 'ease help' and app_state.conversations.get(user_id) is not None:
+                    started[i] += 1
+                elif text == 'cancel' and app_state.conversations.get(user_id) is None:
+                    cancelled[i] += 1
+            if app.new_user({'id': 'UNEW{0}'.format((i+r) % STRESS_NEW_USERS)}):
+                welcomed[i] += 1
+
+    # Bare counter increments, from waves of short-lived threads, so shards
+    # are folded in while other threads are still adding
+    counter = ShardedCounter()
+    increments = rounds*len(STRESS_MESSAGES)
+
+    def count():
+        for _ in range(increments):
+            counter.increment()
+
+    def waves():
+        for _wave in range(4):
+            wave = [ threading.Thread(target=count) for _ in range(num_threads) ]
+            for t in wave:
+                t.start()
+            for t in wave:
+                t.join()
+
+    threads = [ threading.Thread(target=run, args=(i,)) for i in range(num_threads) ]
+    threads.append( threading.Thread(target=waves) )
+    start = time.perf_counter()
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if fake is not None:
+            fake.close()
+        tmp.cleanup()
+    elapsed = time.perf_counter() - start
+
+    total = num_threads*rounds
+    new_users = len(set( (i+r) % STRESS_NEW_USERS for i in range(num_threads) for r in range(rounds) ))
+    checks = [
+        ('messages', total*len(STRESS_MESSAGES), app_state.message_count.value - messages_before),
+        ('unknown', total*STRESS_MESSAGES.count(None), app_state.unknown_count.value - unknown_before),
+        ('counter', 4*num_threads*increments, counter.value),
+        ('new users', new_users, sum(welcomed)),
+        ('known users', new_users, len(app_state.known_users) - users_before),
+        ('started', total, sum(started)),
+        ('cancelled', total, sum(cancelled)),
+        ('conversations', 0, len(app_state.conversations)),
+        ]
+
+    print('{0} threads x {1} messages in {2:.2f} s, {3} conversations'.format(num_threads,
+        rounds*len(STRESS_MESSAGES), elapsed, store))
+    print('{0:>14} {1:>10} {2:>10}'.format('', 'expected', 'actual'))
+    ok = True
+    for (name,expected,actual) in checks:
+        print('{0:>14} {1:>10} {2:>10}{3}'.format(name, expected, actual,
+            '' if expected == actual else '  MISMATCH'))
+        ok = ok and expected == actual
+
+    return ok
+
+def default_corpus() -> List[Dict[str,str]]:
+    '''
+    A mix of lookups, arithmetic, a conversation and Ravelry commands from
+    a few users.
+    '''
+    texts = ['k2tog', 'dk', 'us 8', 'uk 9', '5 mm', 'crochet k', 'weights', 'needles', 'help',
+        '2 + 2', '24 * 4 / 5', '(100 - 8) / 4',
+        'ease help', 'want', '20', '100', '30',
+        'ravelry yarn malabrigo worsted', 'ravelry search cabled hat',
+        'ravelry yarn similar to cascade 220 superwash', 'ravelry favorites someone',
+        'hello', 'thanks!', 'what is the meaning of life']
+    events = []
+    for user in range(4):
+        user_id = 'UREPLAY{0}'.format(user)
+        for text in texts:
+            events.append({'type': 'message', 'user': user_id, 'channel': 'D' + user_id, 'text': text})
+    return events
+
+def load_corpus(filename: str) -> List[Dict[str,Any]]:
+    events = []
+    with open(filename) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event = event.get('event', event)
+            if event.get('type', 'message') == 'message' and 'subtype' not in event:
+                events.append(event)
+    return events
+
+# Command classes for the replay report, by route name
+LOOKUP_ROUTES = frozenset(['cmd_acronym', 'cmd_yarn_weight', 'cmd_us_size', 'cmd_uk_size',
+    'cmd_metric_size', 'cmd_crochet_size', 'cmd_weights', 'cmd_needles', 'cmd_help',
+    'cmd_info', 'cmd_info_stats'])
+COMMAND_CLASSES = {'cmd_arithmetic': 'arithmetic', 'cmd_ease': 'conversation', 'cmd_ravelry': 'ravelry'}
+
+def command_class(app: Any, event: Dict[str,Any]) -> str:
+    '''
+    Returns: which class of command `proc_msg` will run for the event
+    '''
+    if 'user' not in event or 'text' not in event:
+        return 'ignored'
+    if app.app_state.conversations.get(event['user']) is not None:
+        return 'conversation'
+    msg = app.parse_message(event['user'], event.get('channel', ''), event['text'], stub_say, None)
+    if msg is None:
+        return 'ignored'
+    route = app.router.route(msg)
+    if route is None:
+        return 'other'
+    if route.name in LOOKUP_ROUTES:
+        return 'lookup'
+    return COMMAND_CLASSES.get(route.name, 'other')
+
+class ClassStats:
+    def __init__(self) -> None:
+        from .metrics import Histogram
+        self.latency = Histogram()
+        self.allocated: List[int] = []
+
+def replay_pass(app: Any, events: List[Dict[str,Any]], trace: bool) -> Tuple[Dict[str,ClassStats],float]:
+    '''
+    Run every event through `proc_msg` in turn, waiting for any Ravelry
+    work it queues, starting with empty caches and no conversations.
+
+    Returns: (stats by command class, elapsed seconds)
+    '''
+    from . import arith, ravelry
+    from .state import MemorySessionStore
+
+    ravelry.rav_cache.clear()
+    arith.evaluate_cached.cache_clear()
+    app.app_state.conversations = MemorySessionStore()
+    client = StubClient()
+    stats: Dict[str,ClassStats] = {}
+
+    if trace:
+        tracemalloc.start()
+
+    pass_start = time.perf_counter()
+    for event in events:
+        cls = command_class(app, event)
+        if trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        app.proc_msg(dict(event), stub_say, client)
+        app.app_state.ravelry_tasks.join()
+        elapsed = time.perf_counter() - start
+
+        entry = stats.setdefault(cls, ClassStats())
+        entry.latency.record(elapsed)
+        if trace:
+            entry.allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    pass_elapsed = time.perf_counter() - pass_start
+
+    if trace:
+        tracemalloc.stop()
+
+    return (stats, pass_elapsed)
+
+def bench_replay(events: List[Dict[str,Any]], latency: float, repeat: int, allocations: bool):
+    from . import app, ravelry
+    from .ratelimit import TokenBuckets, rate_limiter
+    from .state import app_state
+
+    app_state.bot_user_id = 'UBOT'
+    app_state.bot_user_ref = '<@UBOT>'
+    rate_limiter.users = TokenBuckets(0, float('inf'))
+    rate_limiter.channels = TokenBuckets(0, float('inf'))
+    rate_limiter.ravelry = TokenBuckets(0, float('inf'))
+    app.start_ravelry_tasks()
+
+    fake = FakeRavelry(latency)
+    ravelry.rav_client.base_url = fake.url
+    events = events*repeat
+
+    try:
+        (stats, elapsed) = replay_pass(app, events, trace=False)
+        calls = fake.calls
+        allocated = replay_pass(app, events, trace=True)[0] if allocations else {}
+    finally:
+        fake.close()
+
+    print('{0} events in {1:.2f} s ({2:.0f} events/s), {3} Ravelry calls at {4:.0f} ms'.format(
+        len(events), elapsed, len(events)/elapsed, calls, 1e3*latency))
+    print('{0:>14} {1:>7} {2:>9} {3:>9} {4:>9} {5:>10}'.format('class', 'events',
+        'mean ms', 'p50 ms', 'p99 ms', 'peak KB'))
+    for (cls, entry) in sorted(stats.items()):
+        snap = entry.latency.snapshot()
+        traced = allocated[cls].allocated if cls in allocated else []
+        peak = '{0:.1f}'.format(sum(traced)/len(traced)/1024) if traced else '-'
+        print('{0:>14} {1:>7} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>10}'.format(cls, snap['count'],
+            1e3*snap['sum']/snap['count'], 1e3*snap['p50'], 1e3*snap['p99'], peak))
+
+QUERY_SEARCHES = [
+    ('yarn', 'malabrigo worsted'),
+    ('yarn', 'cascade 220 superwash wool worsted weight'),
+    ('yarn', 'silk and merino fingering or light-fingering'),
+    ('yarn', 'alpaca silk blend with color changes'),
+    ('pattern', 'cabled hat'),
+    ('pattern', 'free knit dk weight sweater'),
+    ('pattern', 'crochet blanket using worsted or aran yarn'),
+    ('pattern', 'free crochet amigurumi pattern'),
+    ('pattern', 'knit socks with fingering'),
+    ]
+
+def legacy_yarn_search_parms(rav_cmd, page_size=5, page=1):
+    '''
+    Yarn search parsing as it was before `query`, for comparison
+
+    Returns: (description of the search, parameters)
+    '''
+
+    filtered_words = ['or','and','pattern',
+        'patterns','with','using',
+        'weight','weights','color']
+    for w in filtered_words:
+        if w in rav_cmd:
+            rav_cmd.remove(w)
+
+    parms = {'photo':'yes', 'page_size':str(page_size), 'sort':'projects'}
+    if page > 1:
+        parms['page'] = str(page)
+    msg = u'Yarn search results for:'
+    
+    filter_weight = []
+    for w in data.yarn_weights.keys():
+        s = w.lower().replace(' ','-')
+        if s in rav_cmd:
+            filter_weight.append(s)
+            rav_cmd.remove(s)
+
+    filter_fiber = []
+    for f in data.yarn_fibers:
+        if f in rav_cmd:
+            filter_fiber.append(f)
+            rav_cmd.remove(f)
+
+
+    if len(filter_weight) > 0:
+        parms.update({'weight': '|'.join(filter_weight)})
+        msg += u' {0} weight'.format( ' or '.join(filter_weight) )
+
+    if len(filter_fiber) > 0:
+        parms.update({'fiber': '+'.join(filter_fiber)})
+        msg += u' with {0} fiber'.format( ' and '.join(filter_fiber) )
+
+    parms.update({'query':' '.join(rav_cmd)})
+    msg += u' containing "{0}"'.format(' '.join(rav_cmd))
+
+    return (msg, parms)
+
+def legacy_pattern_search_parms(rav_cmd):
+    '''
+    Pattern search parsing as it was before `query`, for comparison
+
+    Returns: (description of the search, parameters)
+    '''
+
+    filtered_words = ['or','and','pattern',
+        'patterns','with','using','yarn',
+        'weight','weights','color']
+    for w in filtered_words:
+        if w in rav_cmd:
+            rav_cmd.remove(w)
+
+    parms = {'photo':'yes', 'page_size':'5', 'sort':'best'}
+    msg = u'Pattern search results for:'
+    
+    filter_free = 'free' in rav_cmd
+    if filter_free:
+        rav_cmd.remove('free')
+        msg += u' free'
+
+    filter_craft = []
+    if 'knit' in rav_cmd or 'knitting' in rav_cmd:
+        filter_craft.append('knitting')
+        try:
+            rav_cmd.remove('knit')
+            rav_cmd.remove('knitting')
+        except:
+            pass
+    if 'crochet' in rav_cmd:
+        filter_craft.append('crochet')
+        rav_cmd.remove('crochet')
+    
+    filter_weight = []
+    for w in data.yarn_weights.keys():
+        s = w.lower().replace(' ','-')
+        if s in rav_cmd:
+            filter_weight.append(s)
+            rav_cmd.remove(s)
+
+    if filter_free:
+        parms.update({'availability':'free'})
+    if len(filter_craft) > 0:
+        parms.update({'craft': '|'.join(filter_craft)})
+        msg += u' {0}'.format( ' or '.join(filter_craft) )
+
+    if len(filter_weight) > 0:
+        parms.update({'weight': '|'.join(filter_weight)})
+        msg += u' with {0} yarn'.format( ' or '.join(filter_weight) )
+
+    parms.update({'query':' '.join(rav_cmd)})
+    msg += u' containing "{0}"'.format(' '.join(rav_cmd))
+
+    search_query = '&'.join([ k + '=' + requests.utils.quote(v) for (k,v) in parms.items() if k != 'page_size'])
+    search_url = 'http://www.ravelry.com/patterns/search#' + search_query
+
+    msg += u'\n(<{0}|search on ravelry>)'.format(search_url)
+
+    return (msg, parms)
+
+def bench_query(iterations: int) -> bool:
+    from .query import YARN_SEARCH, vocabulary
+    from .ravelry import pattern_search_parms, yarn_search_parms
+
+    def new_parms(kind, words):
+        query = vocabulary.parse(kind, words)
+        return yarn_search_parms(query) if kind == YARN_SEARCH else pattern_search_parms(query)
+
+    def old_parms(kind, words):
+        return (legacy_yarn_search_parms if kind == YARN_SEARCH else legacy_pattern_search_parms)(list(words))
+
+    searches = [ (kind, text.split()) for (kind, text) in QUERY_SEARCHES ]
+
+    ok = True
+    for (kind, words) in searches:
+        (new, old) = (new_parms(kind, words), old_parms(kind, words))
+        if new != old:
+            print('MISMATCH {0} {1}: {2} != {3}'.format(kind, ' '.join(words), new, old))
+            ok = False
+
+    print('{0:>10} {1:>14} {2:>14}'.format('', 'parse us', 'parse+parms us'))
+    for (name, parms) in [ ('old', old_parms), ('new', new_parms) ]:
+        parse_only = None
+        if name == 'new':
+            start = time.perf_counter()
+            for _ in range(iterations):
+                for (kind, words) in searches:
+                    vocabulary.parse(kind, words)
+            parse_only = 1e6*(time.perf_counter() - start)/(iterations*len(searches))
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for (kind, words) in searches:
+                parms(kind, words)
+        elapsed = 1e6*(time.perf_counter() - start)/(iterations*len(searches))
+
+        print('{0:>10} {1:>14} {2:>14.2f}'.format(name,
+            '{0:.2f}'.format(parse_only) if parse_only is not None else '-', elapsed))
+
+    return ok
+
+def bench_coalesce(callers: int, latency: float) -> bool:
+    '''
+    Returns: True if, for each kind of call, from threads and from
+        coroutines, every caller got the same answer from exactly one
+        upstream call
+    '''
+    import asyncio
+    from . import aioravelry, ravelry
+
+    fake = FakeRavelry(latency)
+    ravelry.rav_client.base_url = fake.url
+    aioravelry.aio_client.base_url = fake.url
+
+    favorites = ('people/someone/favorites/list.json', {'types': 'pattern', 'page_size': '10'})
+    calls = {
+        'search (cached)': (lambda: ravelry.ravelry_api_yarn(['malabrigo', 'worsted']),
+            lambda: aioravelry.ravelry_api_yarn(['malabrigo', 'worsted'])),
+        'favorites (uncached)': (lambda: ravelry.ravelry_api(*favorites),
+            lambda: aioravelry.ravelry_api(*favorites)),
+        }
+
+    ok = True
+    try:
+        for (name, (call, async_call)) in calls.items():
+            ravelry.rav_cache.clear()
+            fake.calls = 0
+            barrier = threading.Barrier(callers)
+            results: List[Any] = []
+
+            def run(call=call, barrier=barrier, results=results):
+                barrier.wait()
+                results.append(call())
+
+            threads = [ threading.Thread(target=run) for _ in range(callers) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            ok &= report_coalesce('threads, ' + name, callers, results, fake.calls)
+
+            async def run_async(async_call=async_call):
+                try:
+                    return await asyncio.gather(*[ async_call() for _ in range(callers) ])
+                finally:
+                    await aioravelry.aio_client.close()
+
+            ravelry.rav_cache.clear()
+            fake.calls = 0
+            ok &= report_coalesce('coroutines, ' + name, callers, asyncio.run(run_async()), fake.calls)
+
+        async def run_cancelled(async_call=calls['favorites (uncached)'][1]):
+            # The first caller leads the call, then gives up on it
+            try:
+                tasks = [ asyncio.ensure_future(async_call()) for _ in range(callers) ]
+                await asyncio.sleep(latency/2)
+                tasks[0].cancel()
+                return await asyncio.gather(*tasks[1:])
+            finally:
+                await aioravelry.aio_client.close()
+
+        ravelry.rav_cache.clear()
+        fake.calls = 0
+        ok &= report_coalesce('coroutines, leader cancelled', callers - 1,
+            asyncio.run(run_cancelled()), fake.calls)
+    finally:
+        fake.close()
+
+    flight = ravelry.rav_flight.summary()
+    print('{0} calls made, {1} shared'.format(flight['calls'], flight['shared']))
+    return ok
+
+def report_coalesce(name: str, callers: int, results: List[Any], upstream: int) -> bool:
+    answered = sum( 1 for r in results if r is not None )
+    same = all( r == results[0] for r in results )
+    ok = answered == callers and same and upstream == 1
+    print('{0:<36} {1:>4} callers {2:>4} answered{3} {4:>3} upstream calls  {5}'.format(name,
+        callers, answered, '' if same else ' (differently)', upstream, 'ok' if ok else 'MISMATCH'))
+    return ok
+
+SESSION_THREADS = 8
+SESSION_USERS = 50
+
+def session_conversation(i: int) -> Any:
+    from .conversations import Conversation, conversation_templates
+    conv = Conversation(conversation_templates['ease'])
+    conv.data['n'] = i
+    return conv
+
+def check_session_store(name: str, open_store, ttl: float) -> bool:
+    '''
+    Check get/put/pop/items, LRU eviction and expiry on one store, then that
+    concurrent writers, each with its own store as separate processes would
+    have, evict exactly down to the limit. `open_store(ttl, max_sessions)`
+    opens a store on the shared backend.
+
+    Returns: True if every check passed
+    '''
+    checks: List[Tuple[str,Any,Any]] = []
+    store = open_store(ttl, 3)
+    for i in range(1, 6):
+        store.put('U{0}'.format(i), session_conversation(i))
+    got = store.get('U5')
+    checks += [
+        ('evicted to limit', 3, len(store)),
+        ('evicted oldest', [None, None], [store.get('U1'), store.get('U2')]),
+        ('round trip', ('ease', {'n': 5}), (got.name, got.data) if got is not None else None),
+        ('items', ['U3', 'U4', 'U5'], sorted(u for (u,_conv) in store.items())),
+        ]
+    popped = store.pop('U4')
+    checks += [
+        ('pop', 4, popped.data['n'] if popped is not None else None),
+        ('popped gone', None, store.get('U4')),
+        ]
+    time.sleep(ttl*1.5)
+    checks += [
+        ('expired', None, store.get('U5')),
+        ('expired items', [], store.items()),
+        ('expired not counted', 0, len(store)),
+        ]
+    store.sweep()
+    checks.append( ('swept', 0, len(store)) )
+    store.close()
+
+    limit = SESSION_THREADS*SESSION_USERS//2
+    stores = [ open_store(60, limit) for _ in range(SESSION_THREADS) ]
+    barrier = threading.Barrier(SESSION_THREADS)
+
+    def run(i):
+        barrier.wait()
+        for u in range(SESSION_USERS):
+            stores[i].put('UT{0}-{1}'.format(i, u), session_conversation(u))
+
+    threads = [ threading.Thread(target=run, args=(i,)) for i in range(SESSION_THREADS) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    checks += [
+        ('concurrent puts', limit, len(stores[0])),
+        ('concurrent items', limit, len(stores[0].items())),
+        ('concurrent evicted', SESSION_THREADS*SESSION_USERS - limit,
+            sum(st.evicted for st in { id(st): st for st in stores }.values())),
+        ]
+    for st in stores:
+        st.close()
+
+    ok = True
+    for (check,expected,actual) in checks:
+        passed = expected == actual
+        ok = ok and passed
+        if not passed:
+            print('{0:>8} {1:<20} expected {2!r}, got {3!r}'.format(name, check, expected, actual))
+    print('{0:>8} {1} checks  {2}'.format(name, len(checks), 'ok' if ok else 'MISMATCH'))
+    return ok
+
+def check_sessions(ttl: float) -> bool:
+    '''
+    Run `check_session_store` on each backend, with Redis served by
+    `FakeRedis`.
+
+    Returns: True if every check passed
+    '''
+    import os
+    import tempfile
+    from .state import MemorySessionStore, RedisSessionStore, RespClient, SQLiteSessionStore
+
+    shared: Dict[Tuple[float,int],MemorySessionStore] = {}
+
+    def memory(ttl, max_sessions):
+        # One store in one process, shared by the threads
+        return shared.setdefault( (ttl, max_sessions), MemorySessionStore(ttl, max_sessions) )
+
+    ok = check_session_store('memory', memory, ttl)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        databases = iter(range(1000))
+        filenames: Dict[Tuple[float,int],str] = {}
+
+        def sqlite(ttl, max_sessions):
+            filename = filenames.setdefault( (ttl, max_sessions),
+                os.path.join(tmp, 'sessions{0}.db'.format(next(databases))) )
+            return SQLiteSessionStore(filename, ttl, max_sessions)
+
+        ok &= check_session_store('sqlite', sqlite, ttl)
+
+    fake = FakeRedis()
+    try:
+        def redis(ttl, max_sessions):
+            prefix = 'check:{0}:{1}:'.format(ttl, max_sessions)
+            return RedisSessionStore(RespClient('127.0.0.1', fake.port), prefix, ttl, max_sessions)
+
+        ok &= check_session_store('redis', redis, ttl)
+
+        # Every session key left is in the index, and the other way round
+        with fake.lock:
+            keys = set( k for k in list(fake.strings) if fake._get(k) is not None )
+            indexed = set( 'check:60:{0}:'.format(SESSION_THREADS*SESSION_USERS//2) + u
+                for u in fake.zsets.get('check:60:{0}:index'.format(SESSION_THREADS*SESSION_USERS//2), {}) )
+        stray = len(keys ^ indexed)
+        print('{0:>8} {1} keys out of step with the index  {2}'.format('redis', stray, 'ok' if stray == 0 else 'MISMATCH'))
+        ok &= stray == 0
+    finally:
+        fake.close()
+
+    return ok
+
+DISTANCE_VALUES: List[Optional[float]] = [None, 0, 0., -1, -2.5, 0.5, 1, 2, 4, 8, 12.5, 100]
+
+def check_distance(rows: int, seed: int) -> bool:
+    '''
+    Returns: True if `feature_distances` agrees with `feature_distance` for
+        every target and row
+    '''
+    from .ravelry import YarnFeatures, feature_distance, feature_distances, feature_matrix
+
+    rnd = random.Random(seed)
+    features: List[YarnFeatures] = [ (rnd.choice(DISTANCE_VALUES), rnd.choice(DISTANCE_VALUES),
+        rnd.choice(DISTANCE_VALUES), rnd.choice(DISTANCE_VALUES)) for _ in range(rows) ]
+    matrix = feature_matrix(features)
+
+    mismatches = 0
+    for target in features:
+        distances = feature_distances(target, matrix)
+        for (f, d) in zip(features, distances):
+            expected = feature_distance(target, f)
+            if abs(d - expected) > 1e-9:
+                if mismatches < 10:
+                    print('MISMATCH {0} to {1}: {2} != {3}'.format(target, f, d, expected))
+                mismatches += 1
+
+    print('{0} pairs, {1} mismatches  {2}'.format(rows*rows, mismatches, 'ok' if mismatches == 0 else 'MISMATCH'))
+    return mismatches == 0
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m yarnbot.bench')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    dispatch = sub.add_parser('dispatch', help='Router dispatch cost vs. number of commands')
+    dispatch.add_argument('--iterations', type=int, default=2000)
+    dispatch.add_argument('--commands', type=int, nargs='+', default=[0, 10, 100, 1000, 10000])
+
+    stress = sub.add_parser('stress', help='Hammer proc_msg from many threads and check the counts')
+    stress.add_argument('--threads', type=int, default=32)
+    stress.add_argument('--rounds', type=int, default=200)
+    stress.add_argument('--store', choices=['memory', 'sqlite', 'redis'], default='memory',
+        help='Where conversations are kept; redis uses a local stand-in')
+
+    replay = sub.add_parser('replay', help='Replay Slack message events through proc_msg')
+    replay.add_argument('corpus', nargs='?', help='JSONL file of message events (default: built-in mix)')
+    replay.add_argument('--latency', type=float, default=0.05, help='Fake Ravelry latency in seconds')
+    replay.add_argument('--repeat', type=int, default=1, help='Times to replay the corpus')
+    replay.add_argument('--no-allocations', dest='allocations', action='store_false',
+        help='Skip the allocation tracing pass')
+    replay.add_argument('--write-corpus', metavar='FILE', help='Write the built-in corpus to FILE and exit')
+
+    query = sub.add_parser('query', help='Search word parsing, against the code it replaced')
+    query.add_argument('--iterations', type=int, default=5000)
+
+    sessions = sub.add_parser('sessions', help='Check the conversation stores, with a local stand-in for Redis')
+    sessions.add_argument('--ttl', type=float, default=0.5, help='Conversation TTL for the expiry checks')
+
+    coalesce = sub.add_parser('coalesce', help='Check that identical concurrent Ravelry calls are made once')
+    coalesce.add_argument('--callers', type=int, default=32)
+    coalesce.add_argument('--latency', type=float, default=0.2, help='Fake Ravelry latency in seconds')
+
+    distance = sub.add_parser('distance', help='Check vectorized yarn distances against the scalar ones')
+    distance.add_argument('--rows', type=int, default=300)
+    distance.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.bench == 'dispatch':
+        print('{0:>10} {1:>12}'.format('commands', 'us/message'))
+        for n in args.commands:
+            print('{0:>10} {1:>12.2f}'.format(n, bench_dispatch(n, args.iterations)))
+
+    elif args.bench == 'stress':
+        if not bench_stress(args.threads, args.rounds, args.store):
+            sys.exit(1)
+
+    elif args.bench == 'replay':
+        if args.write_corpus:
+            with open(args.write_corpus, 'w') as f:
+                for event in default_corpus():
+                    f.write(json.dumps(event) + '\n')
+            return
+
+        events = load_corpus(args.corpus) if args.corpus else default_corpus()
+        bench_replay(events, args.latency, args.repeat, args.allocations)
+
+    elif args.bench == 'query':
+        if not bench_query(args.iterations):
+            sys.exit(1)
+
+    elif args.bench == 'sessions':
+        if not check_sessions(args.ttl):
+            sys.exit(1)
+
+    elif args.bench == 'coalesce':
+        if not bench_coalesce(args.callers, args.latency):
+            sys.exit(1)
+
+    elif args.bench == 'distance':
+        if not check_distance(args.rows, args.seed):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
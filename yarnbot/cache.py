@@ -0,0 +1,76 @@
+'''
+Expiring LRU cache, shared by the Ravelry responses and the Slack directory.
+'''
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+class ResponseCache:
+    '''
+    Thread-safe LRU cache of API responses with per-entry expiry. The cache
+    is bounded both by number of entries and by total response size.
+
+    Cached responses are shared between callers, so they must be treated
+    as read-only.
+    '''
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (expiry time, size, value), least recently used first
+        self.entries: 'OrderedDict[Hashable,Tuple[float,int,Any]]' = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, value: Any, size: int, ttl: float):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic()+ttl, size, value)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, key: Hashable):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key: Hashable):
+        (_expiry,size,_value) = self.entries.pop(key)
+        self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def summary(self) -> Dict[str,int]:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
@@ -0,0 +1,189 @@
+'''
+Local catalog of yarn records fetched from Ravelry.
+
+Every yarn the bot sees in a search result or detail response is kept in a
+SQLite database along with its comparison features (see
+`ravelry.yarn_features`), indexed by weight and fiber. This lets "similar
+to" queries be answered without another round trip to Ravelry once the
+catalog has seen enough yarn.
+'''
+
+import json
+import time
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .ravelry import (YarnFeatures, feature_distances, feature_matrix,
+    fiber_names, nearest, weight_name, yarn_features)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS yarns (
+    id INTEGER PRIMARY KEY,
+    weight TEXT,
+    density REAL,
+    wpi REAL,
+    min_gauge REAL,
+    max_gauge REAL,
+    listed INTEGER NOT NULL DEFAULT 0,
+    detailed INTEGER NOT NULL DEFAULT 0,
+    record TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS yarns_weight ON yarns (weight, listed);
+CREATE TABLE IF NOT EXISTS yarn_fibers (
+    fiber TEXT NOT NULL,
+    yarn_id INTEGER NOT NULL,
+    PRIMARY KEY (fiber, yarn_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS yarn_fibers_yarn ON yarn_fibers (yarn_id);
+'''
+
+class YarnCatalog:
+    '''
+    SQLite-backed yarn catalog. A single connection is shared between
+    threads and serialized with a lock.
+
+    Records from search results are "listed": they have everything needed
+    to show them in a reply, so only those are returned as candidates.
+    Detail records contribute complete fiber lists.
+    '''
+
+    def __init__(self, filename: str) -> None:
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM yarns').fetchone()[0]
+
+    def add(self, yarns: Iterable[Dict[str,Any]], fibers: Iterable[str]=(), detailed: bool=False):
+        '''
+        Add or update yarn records.
+
+        Parameters:
+            yarns: Yarn records from Ravelry
+            fibers: Fibers known to be in every one of the yarns, such as
+                the fiber filter of the search that returned them
+            detailed: Whether these are detail records, with complete fiber lists
+        '''
+        now = time.time()
+        fibers = list(fibers)
+
+        with self.lock, self.conn:
+            for yarn in yarns:
+                if 'id' not in yarn:
+                    continue
+                yarn_id = yarn['id']
+
+                row = self.conn.execute('SELECT record, listed FROM yarns WHERE id = ?', (yarn_id,)).fetchone()
+                record = json.loads(row[0]) if row is not None else dict()
+                record.update(yarn)
+                listed = int(not detailed or (row is not None and row[1]))
+
+                (density, wpi, min_gauge, max_gauge) = yarn_features(record)
+                self.conn.execute('''INSERT INTO yarns
+                        (id, weight, density, wpi, min_gauge, max_gauge, listed, detailed, record, fetched)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        weight = excluded.weight, density = excluded.density, wpi = excluded.wpi,
+                        min_gauge = excluded.min_gauge, max_gauge = excluded.max_gauge,
+                        listed = excluded.listed, detailed = MAX(detailed, excluded.detailed),
+                        record = excluded.record, fetched = excluded.fetched''',
+                    (yarn_id, weight_name(record), density, wpi, min_gauge, max_gauge,
+                        listed, int(detailed), json.dumps(record), now))
+
+                yarn_fibers = fibers
+                if detailed:
+                    yarn_fibers = fiber_names(yarn)
+                    self.conn.execute('DELETE FROM yarn_fibers WHERE yarn_id = ?', (yarn_id,))
+                self.conn.executemany('INSERT OR IGNORE INTO yarn_fibers (fiber, yarn_id) VALUES (?, ?)',
+                    [ (f, yarn_id) for f in yarn_fibers ])
+
+    def add_response(self, api_call: str, parms: Optional[Dict[str,Any]], result: Any):
+        '''
+        Add any yarn records found in a Ravelry API response.
+        '''
+        if not isinstance(result, dict):
+            return
+        try:
+            if isinstance(result.get('yarns'), list):
+                fibers = parms.get('fiber', '').split('+') if parms else []
+                self.add(result['yarns'], fibers=[ f for f in fibers if f ])
+            elif isinstance(result.get('yarn'), dict) and api_call.strip('/').startswith('yarns/'):
+                self.add([result['yarn']], detailed=True)
+        except sqlite3.Error as e:
+            logging.warning('Yarn catalog error: {0}'.format(e))
+
+    def detail(self, yarn_id: int) -> Optional[Tuple[Dict[str,Any],List[str]]]:
+        '''
+        Returns: (record, fibers) for a yarn whose detail record has been
+            seen, otherwise None
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT record FROM yarns WHERE id = ? AND detailed = 1', (yarn_id,)).fetchone()
+            if row is None:
+                return None
+            fibers = [ f for (f,) in self.conn.execute(
+                'SELECT fiber FROM yarn_fibers WHERE yarn_id = ? ORDER BY fiber', (yarn_id,)) ]
+        return (json.loads(row[0]), fibers)
+
+    def candidates(self, weight: Optional[str], fibers: List[str]) -> List[Tuple[int,YarnFeatures]]:
+        '''
+        Returns: (id, features) for every listed yarn of the given weight
+            that contains all of the given fibers
+        '''
+        fibers = sorted(set(fibers))
+        query = 'SELECT id, density, wpi, min_gauge, max_gauge FROM yarns WHERE listed = 1'
+        args: List[Any] = []
+        if weight is not None:
+            query += ' AND weight = ?'
+            args.append(weight)
+        if len(fibers) > 0:
+            query += ''' AND id IN (SELECT yarn_id FROM yarn_fibers WHERE fiber IN ({0})
+                GROUP BY yarn_id HAVING COUNT(*) = ?)'''.format(','.join('?'*len(fibers)))
+            args.extend(fibers)
+            args.append(len(fibers))
+
+        with self.lock:
+            rows = self.conn.execute(query, args).fetchall()
+
+        return [ (row[0], (row[1], row[2], row[3], row[4])) for row in rows ]
+
+    def records(self, yarn_ids: List[int]) -> List[Dict[str,Any]]:
+        '''
+        Returns: stored records for the given ids, in the same order
+        '''
+        if len(yarn_ids) == 0:
+            return []
+        with self.lock:
+            rows = self.conn.execute('SELECT id, record FROM yarns WHERE id IN ({0})'.format(
+                ','.join('?'*len(yarn_ids))), yarn_ids).fetchall()
+        by_id = { yarn_id: json.loads(record) for (yarn_id,record) in rows }
+        return [ by_id[i] for i in yarn_ids if i in by_id ]
+
+    def similar(self, target: Dict[str,Any], weight: Optional[str], fibers: List[str],
+            count: int=5, min_candidates: int=0) -> Optional[List[Dict[str,Any]]]:
+        '''
+        Find the yarns in the catalog most similar to `target`, among those
+        with the given weight and fibers.
+
+        Returns: up to `count` records, most similar first, or None if there
+            are fewer than `min_candidates` candidates to choose from
+        '''
+        candidates = self.candidates(weight, fibers)
+        if len(candidates) == 0 or len(candidates) < min_candidates:
+            return None
+
+        distances = feature_distances(yarn_features(target),
+            feature_matrix([ features for (_yarn_id,features) in candidates ]))
+
+        return self.records([ candidates[i][0] for i in nearest(distances, count) ])
@@ -21,28 +21,41 @@
 '''
 
 import re
-from typing import (Any, Callable, Dict, List, Optional,
-    Tuple, TypeVar, TypedDict)
+import json
+from typing import (Any, Callable, Dict, Iterable, List, NamedTuple,
+    Optional, Tuple, TypeVar)
 
 T = TypeVar('T')
 U = TypeVar('U')
 
 ExtractionFn = Callable[[Dict[str,T],str], U]
-AcceptFn = Callable[[str], bool]
-Transition = TypedDict('Transition', {'state': 'State', 'accept': AcceptFn})
 
-# Accept functions
-def accept_string(s: str) -> AcceptFn:
-    return lambda m: s.lower() in m.lower()
+class Keywords(NamedTuple):
+    '''
+    Transition test: lowercase keywords to look for in a response. Any of
+    them must appear, or all of them if `require_all` is set. A test with
+    no keywords accepts everything.
+    '''
+    words: Tuple[str,...]
+    require_all: bool = False
+
+    def accepts(self, lower: str) -> bool:
+        if self.require_all:
+            return all(w in lower for w in self.words)
+        return len(self.words) == 0 or any(w in lower for w in self.words)
+
+# Accept tests
+def accept_string(s: str) -> Keywords:
+    return Keywords((s.lower(),))
 
-def accept_any_strings(*ss: str) -> AcceptFn:
-    return lambda m: any(s.lower() in m.lower() for s in ss)
+def accept_any_strings(*ss: str) -> Keywords:
+    return Keywords(tuple(s.lower() for s in ss))
 
-def accept_all_strings(*ss: str) -> AcceptFn:
-    return lambda m: all(s.lower() in m.lower() for s in ss)
+def accept_all_strings(*ss: str) -> Keywords:
+    return Keywords(tuple(s.lower() for s in ss), True)
 
-def accept() -> AcceptFn:
-    return lambda _: True
+def accept() -> Keywords:
+    return Keywords(())
 
 # Extract functions
 def extract_integer(_data: Dict[str,T], msg: str) -> Optional[int]:
@@ -63,11 +76,15 @@ def extract_numeric(_data: Dict[str,T], msg: str) -> Optional[float]:
 
 class State:
     '''
-    A single state within a state machine.
+    A single state within a state machine. States belong to a
+    `ConversationTemplate`, and are shared by every conversation using it,
+    so they hold no per-conversation data.
     '''
 
+    __slots__ = ('label', 'msg', 'extract_dict', 'trans', 'terminal')
+
     def __init__(self, label: str, msg:Optional[str]=None,
-            extract_dict:Optional[Dict[str,ExtractionFn]]=None):
+            extract_dict:Optional[Dict[str,ExtractionFn]]=None) -> None:
         '''
         Parameters:
             label: State name
@@ -77,33 +94,16 @@ class State:
         '''
         self.label = label
         self.msg = msg if msg is not None else ''
-        self.trans: List[Transition] = []
+        # (test, index of destination state), filled in by the template
+        self.trans: Tuple[Tuple[Keywords,int],...] = ()
 
         self.terminal = True
 
         if extract_dict is None:
-            self.extract_dict = dict()
+            self.extract_dict: Dict[str,ExtractionFn] = dict()
         else:
             self.extract_dict = extract_dict
 
-    def set_message(self, msg: str):
-        '''
-        The emit message can be altered, or set if not set during state construction.
-        '''
-        self.msg = msg
-
-    def add_trans(self, to_state: 'State', accept_fn: AcceptFn):
-        '''
-        Create a transition from this state to another.
-
-        Parameters:
-            to_state: Destination state object
-            accept_fn: Function that accepts a string and returns True
-                if this transition should be taken.
-        '''
-        self.trans.append( {'state':to_state, 'accept':accept_fn} )
-        self.terminal = False
-
     def extract(self, data: Dict[str,T], resp: str):
         '''
         Given response text, extract data from it and update the provided
@@ -119,28 +119,22 @@ class State:
 
         data.update(extracted_data)
 
-    def enter(self, data: Dict[str,T]) -> Tuple[str,Dict[str,T]]:
+    def enter(self, data: Dict[str,T]) -> str:
         '''
         Enter a state. Upon entering, the state message is emitted.
 
         Parameters:
-            data: Dictionary containing conversation data
+            data: Dictionary containing conversation data, which is updated
+                in the case that the state is terminal
 
-        Returns: tuple containing emitted message and potentially updated data
-            (updated in the cases that the state is terminal)
+        Returns: emitted message
         '''
-        #print(f'>>>>> Entering {self.label} with {data}')
         if self.terminal:
             self.extract(data,'')
-            msg = self.msg.format(**data)
-            return (msg,data)
 
-        prompt = self.msg.format(**data)
+        return self.msg.format(**data)
 
-        #print(f'>>>>> Responding with {prompt}')
-        return (prompt,data)
-
-    def process(self, resp: str, data: Dict[str,T]) -> Dict[str,T]:
+    def process(self, resp: Optional[str], data: Dict[str,T]) -> Dict[str,T]:
         '''
         Process the response message.
 
@@ -150,166 +144,211 @@ class State:
 
         Returns: Updated data
         '''
-        #print(f'***** Processing {self.label} with {resp}')
         if resp is None:
             return data
 
         self.extract(data,resp)
 
-        #print(f'***** Extracted {data}')
         return data
 
-    def exit(self, resp: str) -> Optional['State']:
+    def exit(self, lower: str) -> Optional[int]:
         '''
-        Given response text, choose next state.
-
-        Parameters:
-            resp: Response text
+        Given lowercased response text, choose next state.
 
-        Returns: Next state
+        Returns: Index of the next state in the template, or None if no
+            single transition accepts the response
         '''
-        #print(f'<<<<< Exiting {self.label} with {resp}')
-        if resp is None:
-            return self
-
-        accepted = [ t['state'] for t in self.trans if t['accept'](resp) ]
+        accepted = [ to for (test,to) in self.trans if test.accepts(lower) ]
 
         if len(accepted) != 1:
             return None
 
-        state = accepted[0]
-        #print(f'<<<<< Transition to {state.label}')
-        return state
+        return accepted[0]
 
-class Conversation:
+class ConversationTemplate:
     '''
-    A conversation is a state machine in which states emit a message upon entering,
-    process a response to that message, and then choose an appropriate next state.
-
-    To define the state machine for a conversation, provide a dictionary of states
-    in `self.state` containing State objects, with one special state called 'init'.
-    State transitions are provided using the `State.add_trans` method. See `State`
-    for more details. For instance:
-
-    self.states = {'init':State('init','Welcome to this state machine'},
-                   'A',State('A','This is state A, enter a number',{'num':extract_numeric})}
-                   'end',State('end','You said {num}. Bye.')}
-    self.states['init'].add_trans(self.states['A'],accept())
-    self.states['A'].add_trans(self.states['end'],accept())
+    The state machine for one kind of conversation, built once and shared by
+    every `Conversation` of that kind. States emit a message upon entering,
+    process a response to that message, and then choose an appropriate
+    next state.
+
+    States are given as a dictionary, with one special state called 'init',
+    and transitions as (from, to, test) triples naming states by their keys.
+    See `State` and `Keywords` for more details. For instance:
+
+    ConversationTemplate('example',
+        {'init': State('init','Welcome to this state machine'),
+         'A': State('A','This is state A, enter a number',{'num':extract_numeric}),
+         'end': State('end','You said {num}. Bye.')},
+        [('init','A',accept()),
+         ('A','end',accept())])
 
     Running this state machine will first print the welcome message, transition to
     'A', extract a number from response text, then transition to end. When finished,
-    `self.data` will contain a value for the key 'num'. Any enter message can contain
-    references to `self.data` as if being passed to `str.format` (which it is).
+    the conversation data will contain a value for the key 'num'. Any enter message
+    can contain references to the data as if being passed to `str.format` (which it is).
     '''
 
-    def __init__(self, name: str):
+    __slots__ = ('name', 'states', 'init')
+
+    def __init__(self, name: str, states: Dict[str,State],
+            transitions: Iterable[Tuple[str,str,Keywords]], init: str='init') -> None:
         self.name = name
-        self.states = {'init': State('init', 'Subclass to have a real conversation')}
-        self.current_state: Optional[State] = self.states['init']
+
+        keys = list(states)
+        index = { key: i for (i,key) in enumerate(keys) }
+
+        trans: Dict[str,List[Tuple[Keywords,int]]] = { key: [] for key in keys }
+        for (from_key,to_key,test) in transitions:
+            trans[from_key].append( (test, index[to_key]) )
+
+        for key in keys:
+            states[key].trans = tuple(trans[key])
+            states[key].terminal = len(trans[key]) == 0
+
+        self.states: Tuple[State,...] = tuple(states[key] for key in keys)
+        self.init = index[init]
+
+class Conversation:
+    '''
+    One user's progress through a `ConversationTemplate`: just the current
+    state and the data collected so far.
+    '''
+
+    __slots__ = ('template', 'state_id', 'data')
+
+    def __init__(self, template: ConversationTemplate) -> None:
+        self.template = template
+        self.state_id = template.init
         self.data: Dict[str,Any] = dict()
 
+    @property
+    def name(self) -> str:
+        return self.template.name
+
+    @property
+    def label(self) -> str:
+        '''
+        Label of the current state
+        '''
+        return self.template.states[self.state_id].label
+
     def step(self, input_msg: str) -> Optional[Tuple[str,bool]]:
         '''
-        Run the machine to the next sttate. `input_msg` is passed to both
+        Run the machine to the next state. `input_msg` is passed to both
         `State.process` and `State.exit`.
 
-        Returns: None if the current state is None or terminal, otherwise
+        Returns: None if the current state is terminal, otherwise
             a (String,Bool) pair containing an output message and whether
             the state is terminal.
         '''
 
-        if self.current_state is None or self.current_state.terminal:
+        states = self.template.states
+        state = states[self.state_id]
+
+        if state.terminal:
             return None
 
-        self.data = self.current_state.process(input_msg, self.data)
+        state.process(input_msg, self.data)
 
-        last_state = self.current_state
-        self.current_state = self.current_state.exit(input_msg)
+        next_id = state.exit(input_msg.lower())
 
         extra_msg = ''
-        if self.current_state is None:
-            self.current_state = last_state
+        if next_id is None:
+            next_id = self.state_id
             extra_msg = "Sorry, I didn't understand that. "
 
-        (output_msg,self.data) = self.current_state.enter(self.data)
+        self.state_id = next_id
+        state = states[next_id]
 
-        return (extra_msg+output_msg, self.current_state.terminal)
+        return (extra_msg+state.enter(self.data), state.terminal)
 
-class EaseConversation(Conversation):
+# Ease calculations
+def calc_sts(data: Dict[str,float], _msg: str) -> float:
     '''
-    Have a conversation about ease, gauge, and number of stitches, based
-    on variations of the formula:
-
-        ease = stitches/(gauge/4-measurement)
-
-    Depending on the conversation, the result can be any of ease, gauge,
-    or number of stitches.
-
-    The conversation data dictionary (depending on the conversation) contains keys:
-    - gauge
-    - meas
-    - ease
-    - stitches
+    Calculate number of stitches using values for gauge, pattern measurement and ease.
+    sts = (gauge/4)*(meas+ease)
     '''
+    return (data['gauge']/4.)*(data['meas']+data['ease'])
 
-    # Ease calculations
-    @staticmethod
-    def calc_sts(data: Dict[str,float], _msg: str) -> float:
-        '''
-        Calculate number of stitches using values for gauge, pattern measurement and ease.
-        sts = (gauge/4)*(meas+ease)
-        '''
-        return (data['gauge']/4.)*(data['meas']+data['ease'])
+def calc_gauge(data: Dict[str,float], _msg: str) -> float:
+    '''
+    Calculate gauge using values for stitches, pattern measurement and ease.
+    gauge = (4*sts)/(meas+ease)
+    '''
+    return 4.0*float(data['stitches'])/(data['meas']+data['ease'])
 
-    @staticmethod
-    def calc_gauge(data: Dict[str,float], _msg: str) -> float:
-        '''
-        Calculate gauge using values for stitches, pattern measurement and ease.
-        gauge = (4*sts)/(meas+ease)
-        '''
-        return 4.0*float(data['stitches'])/(data['meas']+data['ease'])
+def calc_ease(data: Dict[str,float], _msg: str) -> float:
+    '''
+    Calculate ease using values for stitches, pattern measurement and gauge.
+    ease = sts/(gauge/4-meas)
+    '''
+    return float(data['stitches'])/(data['gauge']/4.) - data['meas']
+
+# Have a conversation about ease, gauge, and number of stitches, based
+# on variations of the formula:
+#
+#     ease = stitches/(gauge/4-measurement)
+#
+# Depending on the conversation, the result can be any of ease, gauge,
+# or number of stitches. The conversation data dictionary contains
+# (depending on the conversation) gauge, meas, ease and stitches.
+EASE_CONVERSATION = ConversationTemplate('ease', {
+        'init': State('init', 'Do you have your ease or want to find it?'),
+        'have': State('have', 'Great, what is it in inches?', {'ease':extract_numeric}),
+        'got_ease': State('got_ease', 'Are you interested in figuring out gauge or number of stitches?'),
+        'want_gauge': State('want_gauge', 'How many stitches are in the row with that ease?', {'stitches':extract_integer}),
+        'want_sts': State('want_sts', 'What is your gauge in stitches per 4 inches?', {'gauge':extract_integer}),
+        'want': State('want', "Ok, we'll need to know gauge, number of stitches, and pattern measurement. Let's start with gauge, how many stitches per 4 inches?", {'gauge':extract_integer}),
+        'need_sts': State('need_stitches', 'How many stitches are in the row you need ease for?', {'stitches':extract_integer}),
+        'need_meas_sts': State('need_meas_sts', 'What is the measurement according to the pattern?', {'meas':extract_numeric}),
+        'need_meas': State('need_meas', 'Lastly, what is the measurement according to the pattern?', {'meas':extract_numeric}),
+        'need_gauge_meas': State('need_gauge_meas', 'What is the measurement according to the pattern?', {'meas':extract_numeric}),
+        'answer_stitches': State('answer_stitches', 'Your row length (or cast on) should be {gauge}/4*({meas} + {ease}) = {stitches:.0f} sts', {'stitches':calc_sts}),
+        'answer_gauge': State('answer_gauge', 'Your gauge should be 4*{stitches}/({meas} + {ease}) = {gauge:.0f} sts/4 in.', {'gauge':calc_gauge}),
+        'answer_ease': State('answer_ease', 'Your ease is {stitches}/({gauge}/4) - {meas} = {ease:.1f} in.', {'ease':calc_ease})
+    }, [
+        ('init', 'have', accept_string('have')),
+        ('init', 'want', accept_any_strings('want','find')),
+        ('have', 'got_ease', accept()),
+        ('got_ease', 'want_gauge', accept_string('gauge')),
+        ('got_ease', 'want_sts', accept_string('stitches')),
+        ('want', 'need_sts', accept()),
+        ('need_sts', 'need_meas', accept()),
+        ('need_meas', 'answer_ease', accept()),
+        ('want_gauge', 'need_gauge_meas', accept()),
+        ('want_sts', 'need_meas_sts', accept()),
+        ('need_meas_sts', 'answer_stitches', accept()),
+        ('need_gauge_meas', 'answer_gauge', accept()),
+    ])
+
+# Conversations that can be started, by name
+conversation_templates = {
+    'ease': EASE_CONVERSATION,
+    }
+
+def dump_conversation(conv: Conversation) -> str:
+    '''
+    Serialize a conversation as JSON: [template name, state index, data]
+    '''
+    return json.dumps([conv.name, conv.state_id, conv.data], separators=(',',':'))
 
-    @staticmethod
-    def calc_ease(data: Dict[str,float], _msg: str) -> float:
-        '''
-        Calculate ease using values for stitches, pattern measurement and gauge.
-        ease = sts/(gauge/4-meas)
-        '''
-        return float(data['stitches'])/(data['gauge']/4.) - data['meas']
-
-    def __init__(self):
-        super().__init__('ease')
-
-        self.states = {
-            'init': State('init', 'Do you have your ease or want to find it?'),
-            'have': State('have', 'Great, what is it in inches?', {'ease':extract_numeric}),
-            'got_ease': State('got_ease', 'Are you interested in figuring out gauge or number of stitches?'),
-            'want_gauge': State('want_gauge', 'How many stitches are in the row with that ease?', {'stitches':extract_integer}),
-            'want_sts': State('want_sts', 'What is your gauge in stitches per 4 inches?', {'gauge':extract_integer}),
-            'want': State('want', "Ok, we'll need to know gauge, number of stitches, and pattern measurement. Let's start with gauge, how many stitches per 4 inches?", {'gauge':extract_integer}),
-            'need_sts': State('need_stitches', 'How many stitches are in the row you need ease for?', {'stitches':extract_integer}),
-            'need_meas_sts': State('need_meas_sts', 'What is the measurement according to the pattern?', {'meas':extract_numeric}),
-            'need_meas': State('need_meas', 'Lastly, what is the measurement according to the pattern?', {'meas':extract_numeric}),
-            'need_gauge_meas': State('need_gauge_meas', 'What is the measurement according to the pattern?', {'meas':extract_numeric}),
-            'answer_stitches': State('answer_stitches', 'Your row length (or cast on) should be {gauge}/4*({meas} + {ease}) = {stitches:.0f} sts', {'stitches':EaseConversation.calc_sts}),
-            'answer_gauge': State('answer_gauge', 'Your gauge should be 4*{stitches}/({meas} + {ease}) = {gauge:.0f} sts/4 in.', {'gauge':EaseConversation.calc_gauge}),
-            'answer_ease': State('answer_ease', 'Your ease is {stitches}/({gauge}/4) - {meas} = {ease:.1f} in.', {'ease':EaseConversation.calc_ease})
-            }
-
-        self.states['init'].add_trans(self.states['have'], accept_string('have'))
-        self.states['init'].add_trans(self.states['want'], accept_any_strings('want','find'))
-        self.states['have'].add_trans(self.states['got_ease'], accept())
-        self.states['got_ease'].add_trans(self.states['want_gauge'], accept_string('gauge'))
-        self.states['got_ease'].add_trans(self.states['want_sts'], accept_string('stitches'))
-        self.states['want'].add_trans(self.states['need_sts'], accept())
-        self.states['need_sts'].add_trans(self.states['need_meas'], accept())
-        self.states['need_meas'].add_trans(self.states['answer_ease'], accept())
-        self.states['want_gauge'].add_trans(self.states['need_gauge_meas'], accept())
-        self.states['want_sts'].add_trans(self.states['need_meas_sts'], accept())
-        self.states['need_meas_sts'].add_trans(self.states['answer_stitches'], accept())
-        self.states['need_gauge_meas'].add_trans(self.states['answer_gauge'], accept())
-
-        self.current_state = self.states['init']
+def load_conversation(dumped: str) -> Optional[Conversation]:
+    '''
+    Inverse of `dump_conversation`.
 
+    Returns: the conversation, or None if it can't be restored, such as
+        when its template no longer exists
+    '''
+    try:
+        (name, state_id, data) = json.loads(dumped)
+        template = conversation_templates[name]
+        if not 0 <= state_id < len(template.states):
+            return None
+    except (ValueError, TypeError, KeyError):
+        return None
 
+    conv = Conversation(template)
+    conv.state_id = state_id
+    conv.data = data
+    return conv
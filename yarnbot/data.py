@@ -117,88 +117,34 @@ yarn_fibers = [
     'yak'
     ]
 
-needles_by_us = {
-    '0': {'metric': '2.0', 'uk': '14', 'crochet': '-'},
-    '1': {'metric': '2.25', 'uk': '13', 'crochet': 'B'},
-    '2': {'metric': '2.75', 'uk': '12', 'crochet': 'C'},
-    '3': {'metric': '3.0', 'uk': '11', 'crochet': '-'},
-    '3': {'metric': '3.25', 'uk': '10', 'crochet': 'D'},
-    '4': {'metric': '3.5', 'uk': '9', 'crochet': 'E'},
-    '5': {'metric': '3.75', 'uk': '9', 'crochet': 'F'},
-    '6': {'metric': '4.0', 'uk': '8', 'crochet': 'G'},
-    '7': {'metric': '4.5', 'uk': '7', 'crochet': '-'},
-    '8': {'metric': '5.0', 'uk': '6', 'crochet': 'H'},
-    '9': {'metric': '5.5', 'uk': '5', 'crochet': 'I'},
-    '10': {'metric': '6.0', 'uk': '4', 'crochet': 'J'},
-    '10.5': {'metric': '6.5', 'uk': '3', 'crochet': 'K'},
-    '10 1/2': {'metric': '6.5', 'uk': '3', 'crochet': 'K'},
-    '11': {'metric': '8.0', 'uk': '0', 'crochet': 'L'},
-    '13': {'metric': '9.0', 'uk': '00', 'crochet': '-'},
-    '15': {'metric': '10.0', 'uk': '000', 'crochet': '-'},
-    '17': {'metric': '12.0', 'uk': '-', 'crochet': '-'},
-    '19': {'metric': '15.0', 'uk': '-', 'crochet': '-'},
-    '35': {'metric': '20.0', 'uk': '-', 'crochet': '-'},
-    '50': {'metric': '50.0', 'uk': '-', 'crochet': '-'},
-    }
-needles_by_metric = {
-    '2.00': {'us': '0', 'uk': '14', 'crochet': '-'},
-    '2.25': {'us': '1', 'uk': '13', 'crochet': 'B'},
-    '2.50': {'us': '-', 'uk': '12', 'crochet': '-'},
-    '2.75': {'us': '2', 'uk': '12', 'crochet': 'C'},
-    '3.00': {'us': '3', 'uk': '11', 'crochet': '-'},
-    '3.25': {'us': '3', 'uk': '10', 'crochet': 'D'},
-    '3.50': {'us': '4', 'uk': '9', 'crochet': 'E'},
-    '3.75': {'us': '5', 'uk': '9', 'crochet': 'F'},
-    '4.00': {'us': '6', 'uk': '8', 'crochet': 'G'},
-    '4.50': {'us': '7', 'uk': '7', 'crochet': '-'},
-    '5.00': {'us': '8', 'uk': '6', 'crochet': 'H'},
-    '5.50': {'us': '9', 'uk': '5', 'crochet': 'I'},
-    '6.00': {'us': '10', 'uk': '4', 'crochet': 'J'},
-    '6.50': {'us': '10.5', 'uk': '3', 'crochet': 'K'},
-    '7.00': {'us': '-', 'uk': '2', 'crochet': '-'},
-    '7.50': {'us': '-', 'uk': '1', 'crochet': '-'},
-    '8.00': {'us': '11', 'uk': '0', 'crochet': 'L'},
-    '9.00': {'us': '13', 'uk': '00', 'crochet': '-'},
-    '10.00': {'us': '15', 'uk': '000', 'crochet': '-'},
-    '12.00': {'us': '17', 'uk': '-', 'crochet': '-'},
-    '15.00': {'us': '19', 'uk': '-', 'crochet': '-'},
-    '20.00': {'us': '35', 'uk': '-', 'crochet': '-'},
-    '50.00': {'us': '50', 'uk': '-', 'crochet': '-'},
-    }
-needles_by_crochet = {
-    'B': {'us': '1', 'uk': '13', 'metric': '2.25'},
-    'C': {'us': '2', 'uk': '12', 'metric': '2.75'},
-    'D': {'us': '3', 'uk': '10', 'metric': '3.25'},
-    'E': {'us': '4', 'uk': '9', 'metric': '3.5'},
-    'F': {'us': '5', 'uk': '9', 'metric': '3.75'},
-    'G': {'us': '6', 'uk': '8', 'metric': '4.0'},
-    'H': {'us': '8', 'uk': '6', 'metric': '5.0'},
-    'I': {'us': '9', 'uk': '5', 'metric': '5.5'},
-    'J': {'us': '10', 'uk': '4', 'metric': '6.0'},
-    'K': {'us': '10.5', 'uk': '3', 'metric': '6.5'},
-    'L': {'us': '11', 'uk': '0', 'metric': '8.0'}
-    }
-needles_by_uk = {
-    '14': {'us': '0', 'crochet': '-', 'metric': '2.0'},
-    '13': {'us': '1', 'crochet': 'B', 'metric': '2.25'},
-    '12': {'us': '-', 'crochet': '-', 'metric': '2.5'},
-    '12': {'us': '2', 'crochet': 'C', 'metric': '2.75'},
-    '11': {'us': '3', 'crochet': '-', 'metric': '3.0'},
-    '10': {'us': '3', 'crochet': 'D', 'metric': '3.25'},
-    '9': {'us': '4', 'crochet': 'E', 'metric': '3.5'},
-    '9': {'us': '5', 'crochet': 'F', 'metric': '3.75'},
-    '8': {'us': '6', 'crochet': 'G', 'metric': '4.0'},
-    '7': {'us': '7', 'crochet': '-', 'metric': '4.5'},
-    '6': {'us': '8', 'crochet': 'H', 'metric': '5.0'},
-    '5': {'us': '9', 'crochet': 'I', 'metric': '5.5'},
-    '4': {'us': '10', 'crochet': 'J', 'metric': '6.0'},
-    '3': {'us': '10.5', 'crochet': 'K', 'metric': '6.5'},
-    '2': {'us': '-', 'crochet': '-', 'metric': '7.0'},
-    '1': {'us': '-', 'crochet': '-', 'metric': '7.5'},
-    '0': {'us': '11', 'crochet': 'L', 'metric': '8.0'},
-    '00': {'us': '13', 'crochet': '-', 'metric': '9.0'},
-    '000': {'us': '15', 'crochet': '-', 'metric': '10.0'},
-    }
+# Every needle/hook size: metric (mm), US, UK, crochet, with '-' where a
+# system has no equivalent. The lookups by each system are built from this
+# in `sizes`, so this is the only place to add or correct a size.
+needle_sizes = [
+    (2.0, '0', '14', '-'),
+    (2.25, '1', '13', 'B'),
+    (2.5, '-', '12', '-'),
+    (2.75, '2', '12', 'C'),
+    (3.0, '3', '11', '-'),
+    (3.25, '3', '10', 'D'),
+    (3.5, '4', '9', 'E'),
+    (3.75, '5', '9', 'F'),
+    (4.0, '6', '8', 'G'),
+    (4.5, '7', '7', '-'),
+    (5.0, '8', '6', 'H'),
+    (5.5, '9', '5', 'I'),
+    (6.0, '10', '4', 'J'),
+    (6.5, '10.5', '3', 'K'),
+    (7.0, '-', '2', '-'),
+    (7.5, '-', '1', '-'),
+    (8.0, '11', '0', 'L'),
+    (9.0, '13', '00', '-'),
+    (10.0, '15', '000', '-'),
+    (12.0, '17', '-', '-'),
+    (15.0, '19', '-', '-'),
+    (20.0, '35', '-', '-'),
+    (50.0, '50', '-', '-'),
+    ]
 
 jokes = [
     "Why did the pig farmer give up knitting?\n\nHe didn't want to cast his purls before swine.",
@@ -0,0 +1,340 @@
+'''
+Local stand-ins for the services yarnbot talks to, for the benchmarks and
+checks in `bench`: the Ravelry API over HTTP, with synthetic yarn and
+patterns, Redis over its protocol, and a Slack client that does nothing.
+'''
+
+import json
+import time
+import zlib
+import random
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from .state import RespError
+
+FAKE_FIBERS = ['wool', 'silk', 'alpaca', 'cotton', 'acrylic']
+FAKE_WEIGHTS = ['Fingering', 'DK', 'Worsted', 'Bulky']
+FAKE_YARNS = 2000
+
+def fake_yarn(yarn_id: int, detail: bool=False) -> Dict[str,Any]:
+    r = random.Random(yarn_id)
+    yarn: Dict[str,Any] = {'id': yarn_id, 'name': 'Yarn {0}'.format(yarn_id),
+        'permalink': 'yarn-{0}'.format(yarn_id),
+        'yarn_company_name': 'Company {0}'.format(yarn_id % 17),
+        'yarn_weight': {'name': FAKE_WEIGHTS[yarn_id % len(FAKE_WEIGHTS)]},
+        'grams': r.choice([50, 100]), 'yardage': r.randint(80, 450),
+        'wpi': r.choice([None, 9, 11, 12, 14]), 'min_gauge': r.choice([None, 16, 18, 20, 22]),
+        'max_gauge': r.choice([None, 24, 28]), 'gauge_divisor': 4,
+        'discontinued': yarn_id % 13 == 0, 'machine_washable': yarn_id % 2 == 0,
+        'organic': yarn_id % 7 == 0, 'rating_average': r.uniform(3, 5),
+        'first_photo': {'square_url': 'https://example.com/{0}.jpg'.format(yarn_id)}}
+    if detail:
+        yarn['yarn_fibers'] = [ {'fiber_type': {'name': f}, 'percentage': 100//len(fake_fibers(yarn_id))}
+            for f in fake_fibers(yarn_id) ]
+    return yarn
+
+def fake_fibers(yarn_id: int) -> List[str]:
+    fibers = [FAKE_FIBERS[yarn_id % len(FAKE_FIBERS)]]
+    if yarn_id % 3 == 0:
+        fibers.append(FAKE_FIBERS[(yarn_id+1) % len(FAKE_FIBERS)])
+    return fibers
+
+def fake_page(items: List[Any], parms: Dict[str,str]) -> Tuple[List[Any],Dict[str,int]]:
+    page_size = int(parms.get('page_size', '20'))
+    page = int(parms.get('page', '1'))
+    last_page = max(1, (len(items)+page_size-1)//page_size)
+    return (items[(page-1)*page_size:page*page_size],
+        {'results': len(items), 'page': page, 'page_size': page_size,
+            'page_count': last_page, 'last_page': last_page})
+
+class FakeRavelry:
+    '''
+    Local stand-in for the Ravelry API, with synthetic yarn and patterns,
+    answering each request after `latency` seconds.
+    '''
+
+    def __init__(self, latency: float=0.0) -> None:
+        self.latency = latency
+        self.calls = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake.calls += 1
+                time.sleep(fake.latency)
+                parts = urlsplit(self.path)
+                (status, result) = fake.respond(parts.path, dict(parse_qsl(parts.query)))
+                body = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, name='fake-ravelry', daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, path: str, parms: Dict[str,str]) -> Tuple[int,Any]:
+        if path == '/yarns/search.json':
+            ids = list(range(1, FAKE_YARNS+1))
+            if 'weight' in parms:
+                weights = parms['weight'].split('|')
+                ids = [ i for i in ids if FAKE_WEIGHTS[i % len(FAKE_WEIGHTS)].lower() in weights ]
+            if 'fiber' in parms:
+                fibers = parms['fiber'].split('+')
+                ids = [ i for i in ids if all(f in fake_fibers(i) for f in fibers) ]
+            # Each search term narrows the results, picked stably by the query
+            words = parms.get('query', '').split()
+            if len(words) > 0:
+                count = max(1, 200 >> 2*len(words))
+                first = zlib.crc32(' '.join(words).encode()) % max(1, len(ids))
+                ids = (ids[first:] + ids[:first])[:count]
+            (page, paginator) = fake_page(ids, parms)
+            return (200, {'yarns': [ fake_yarn(i) for i in page ], 'paginator': paginator})
+
+        if path.startswith('/yarns/') and path[len('/yarns/'):-len('.json')].isdigit():
+            return (200, {'yarn': fake_yarn(int(path[len('/yarns/'):-len('.json')]), detail=True)})
+
+        if path == '/yarns.json':
+            ids = [ int(i) for i in parms.get('ids', '').replace('+', ' ').split() ]
+            return (200, {'yarns': { str(i): fake_yarn(i, detail=True) for i in ids }})
+
+        if path == '/patterns/search.json':
+            patterns = [ {'id': i, 'name': 'Pattern {0}'.format(i), 'permalink': 'pattern-{0}'.format(i),
+                    'designer': {'name': 'Designer {0}'.format(i % 11)},
+                    'first_photo': {'square_url': 'https://example.com/p{0}.jpg'.format(i)}}
+                for i in range(1, 101) ]
+            (page, paginator) = fake_page(patterns, parms)
+            return (200, {'patterns': page, 'paginator': paginator})
+
+        if path.startswith('/people/') and path.endswith('/favorites/list.json'):
+            favorites = [ {'favorited': {'name': 'Pattern {0}'.format(i), 'permalink': 'pattern-{0}'.format(i),
+                    'designer': {'name': 'Designer {0}'.format(i % 11)},
+                    'first_photo': {'square_url': 'https://example.com/p{0}.jpg'.format(i)}}}
+                for i in range(1, 31) ]
+            (page, paginator) = fake_page(favorites, parms)
+            return (200, {'favorites': page, 'paginator': paginator})
+
+        return (404, {})
+
+class RespStatus(str):
+    '''
+    Simple string reply, e.g. +OK
+    '''
+
+class FakeRedis:
+    '''
+    Local stand-in for Redis, in process, speaking its protocol: strings
+    with expiry, sorted sets and MULTI/EXEC transactions with WATCH, enough
+    for `state.RedisSessionStore`. Transactions run under one lock, so they
+    are atomic, as in Redis.
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # key -> (value, expiry time or None); key -> {member: score}
+        self.strings: Dict[str,Tuple[str,Optional[float]]] = {}
+        self.zsets: Dict[str,Dict[str,float]] = {}
+        # Bumped on every write to a key, for WATCH
+        self.versions: Dict[str,int] = {}
+        self.commands = 0
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self) -> None:
+                reply: Any
+                queued: Optional[List[List[str]]] = None
+                watched: Dict[str,int] = {}
+                while True:
+                    try:
+                        args = fake.read_command(self.rfile)
+                    except EOFError:
+                        return
+                    name = args[0].upper()
+                    if name == 'MULTI':
+                        (queued, reply) = ([], RespStatus('OK'))
+                    elif name == 'WATCH':
+                        with fake.lock:
+                            watched.update( (k, fake.versions.get(k, 0)) for k in args[1:] )
+                        reply = RespStatus('OK')
+                    elif name == 'UNWATCH':
+                        (watched, reply) = ({}, RespStatus('OK'))
+                    elif name == 'DISCARD':
+                        (queued, watched, reply) = (None, {}, RespStatus('OK'))
+                    elif name == 'EXEC':
+                        with fake.lock:
+                            if queued is None:
+                                reply = RespError('ERR EXEC without MULTI')
+                            elif any( fake.versions.get(k, 0) != v for (k,v) in watched.items() ):
+                                reply = None
+                            else:
+                                reply = [ fake.run(c) for c in queued ]
+                        (queued, watched) = (None, {})
+                    elif queued is not None:
+                        queued.append(args)
+                        reply = RespStatus('QUEUED')
+                    else:
+                        with fake.lock:
+                            reply = fake.run(args)
+                    self.wfile.write(fake.encode(reply))
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='fake-redis', daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def read_command(rfile) -> List[str]:
+        line = rfile.readline()
+        if not line.startswith(b'*'):
+            raise EOFError()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(rfile.readline()[1:])
+            args.append(rfile.read(size+2)[:-2].decode())
+        return args
+
+    def encode(self, reply: Any) -> bytes:
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, RespError):
+            return b'-%s\r\n' % str(reply).encode()
+        if isinstance(reply, RespStatus):
+            return b'+%s\r\n' % reply.encode()
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, list):
+            return b'*%d\r\n' % len(reply) + b''.join(self.encode(r) for r in reply)
+        data = str(reply).encode()
+        return b'$%d\r\n%s\r\n' % (len(data), data)
+
+    def _touch(self, key: str):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _get(self, key: str) -> Optional[str]:
+        entry = self.strings.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            del self.strings[key]
+            self._touch(key)
+            return None
+        return entry[0]
+
+    def _ranked(self, key: str) -> List[str]:
+        zset = self.zsets.get(key, {})
+        return sorted(zset, key=lambda m: (zset[m], m))
+
+    @staticmethod
+    def _span(members: List[str], start: str, stop: str) -> List[str]:
+        (first, last) = (int(start), int(stop))
+        first = max(0, first + len(members) if first < 0 else first)
+        last = last + len(members) if last < 0 else last
+        return members[first:last+1] if last >= 0 else []
+
+    @staticmethod
+    def _in_range(score: float, low: str, high: str) -> bool:
+        def bound(text: str) -> Tuple[float,bool]:
+            return (float(text[1:]), True) if text.startswith('(') else (float(text), False)
+        ((lo, lo_open), (hi, hi_open)) = (bound(low), bound(high))
+        return (score > lo if lo_open else score >= lo) and (score < hi if hi_open else score <= hi)
+
+    def _zremove(self, key: str, members: List[str]) -> int:
+        zset = self.zsets.get(key, {})
+        removed = [ m for m in members if zset.pop(m, None) is not None ]
+        if removed:
+            self._touch(key)
+        return len(removed)
+
+    def run(self, args: List[str]) -> Any:
+        '''
+        Returns: the reply to one command; the caller holds the lock
+        '''
+        self.commands += 1
+        (name, args) = (args[0].upper(), args[1:])
+        if name in ('PING', 'AUTH', 'SELECT'):
+            return RespStatus('PONG' if name == 'PING' else 'OK')
+        if name == 'GET':
+            return self._get(args[0])
+        if name == 'MGET':
+            return [ self._get(k) for k in args ]
+        if name == 'SET':
+            expiry = time.time() + int(args[3])/1000 if len(args) > 3 and args[2].upper() == 'PX' else None
+            self.strings[args[0]] = (args[1], expiry)
+            self._touch(args[0])
+            return RespStatus('OK')
+        if name == 'DEL':
+            deleted = [ k for k in args if self._get(k) is not None or k in self.zsets ]
+            for k in deleted:
+                self.strings.pop(k, None)
+                self.zsets.pop(k, None)
+                self._touch(k)
+            return len(deleted)
+        if name == 'ZADD':
+            zset = self.zsets.setdefault(args[0], {})
+            added = 0
+            for i in range(1, len(args), 2):
+                added += args[i+1] not in zset
+                zset[args[i+1]] = float(args[i])
+            self._touch(args[0])
+            return added
+        if name == 'ZCARD':
+            return len(self.zsets.get(args[0], {}))
+        if name == 'ZSCORE':
+            score = self.zsets.get(args[0], {}).get(args[1])
+            return repr(score) if score is not None else None
+        if name == 'ZCOUNT':
+            return sum( 1 for s in self.zsets.get(args[0], {}).values() if self._in_range(s, args[1], args[2]) )
+        if name == 'ZRANGE':
+            return self._span(self._ranked(args[0]), args[1], args[2])
+        if name == 'ZRANGEBYSCORE':
+            zset = self.zsets.get(args[0], {})
+            return [ m for m in self._ranked(args[0]) if self._in_range(zset[m], args[1], args[2]) ]
+        if name == 'ZREM':
+            return self._zremove(args[0], args[1:])
+        if name == 'ZREMRANGEBYRANK':
+            return self._zremove(args[0], self._span(self._ranked(args[0]), args[1], args[2]))
+        if name == 'ZREMRANGEBYSCORE':
+            zset = self.zsets.get(args[0], {})
+            return self._zremove(args[0], [ m for m in list(zset) if self._in_range(zset[m], args[1], args[2]) ])
+        return RespError('ERR unknown command {0!r}'.format(name))
+
+class StubClient:
+    '''
+    Slack Web API client that answers without doing anything.
+    '''
+
+    def chat_postMessage(self, channel, **_kwargs):
+        return {'ok': True, 'channel': channel, 'ts': '1.000000'}
+
+    def chat_update(self, channel, ts, **_kwargs):
+        return {'ok': True, 'channel': channel, 'ts': ts}
+
+    def users_info(self, user):
+        return {'ok': True, 'user': {'id': user, 'name': user.lower()}}
+
+    def conversations_open(self, users):
+        return {'ok': True, 'channel': {'id': 'D' + users}}
+
+def stub_say(*_args, **_kwargs):
+    pass
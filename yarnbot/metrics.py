@@ -0,0 +1,219 @@
+'''
+Latency histograms for commands and upstream calls.
+
+Each histogram has fixed-size log-linear buckets in the style of HDR
+histograms: values are recorded in microseconds, exactly below 64 us and
+otherwise to within about 3%, up to a maximum of `MAX_SECONDS`. Recording
+is O(1) and memory doesn't grow with the number of samples.
+
+Histograms can be shown by the `info stats` command, written to a file in
+the Prometheus text format (METRICS_FILE, every METRICS_INTERVAL seconds),
+or served for Prometheus to scrape (METRICS_PORT).
+'''
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', '60'))
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+
+MAX_SECONDS = 120
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Buckets per doubling of the recorded value is 2**(SUB_BITS-1)
+SUB_BITS = 6
+HALF = 1 << (SUB_BITS-1)
+
+def bucket_index(micros: int) -> int:
+    if micros < 2*HALF:
+        return micros
+    shift = micros.bit_length() - SUB_BITS
+    return shift*HALF + (micros >> shift)
+
+def bucket_value(index: int) -> int:
+    '''
+    Returns: the midpoint of the values counted in a bucket, in microseconds
+    '''
+    if index < 2*HALF:
+        return index
+    shift = index//HALF - 1
+    low = (index - shift*HALF) << shift
+    return low + ((1 << shift) >> 1)
+
+MAX_MICROS = int(MAX_SECONDS*1e6)
+NUM_BUCKETS = bucket_index(MAX_MICROS) + 1
+
+class Histogram:
+    '''
+    Thread-safe latency histogram, see the module docstring.
+    '''
+
+    __slots__ = ('lock', 'counts', 'count', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counts = [0]*NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        index = bucket_index(min(MAX_MICROS, max(0, int(seconds*1e6))))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantiles(self, qs: Tuple[float,...]=QUANTILES) -> List[float]:
+        '''
+        Returns: the value in seconds at each quantile, 0 if empty
+        '''
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+
+        results = []
+        seen = 0
+        index = 0
+        for q in sorted(qs):
+            rank = max(1, q*count)
+            while index < len(counts) and seen + counts[index] < rank:
+                seen += counts[index]
+                index += 1
+            results.append(bucket_value(index)/1e6 if count > 0 else 0)
+        return results
+
+    def snapshot(self) -> Dict[str,float]:
+        (p50, p90, p99) = self.quantiles( (0.5, 0.9, 0.99) )
+        with self.lock:
+            return {'count': self.count, 'sum': self.total, 'max': self.max,
+                'p50': p50, 'p90': p90, 'p99': p99}
+
+Labels = Tuple[Tuple[str,str],...]
+
+class Metrics:
+    '''
+    Histograms by metric name and labels.
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms: Dict[str,Dict[Labels,Histogram]] = {}
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            by_labels = self.histograms.setdefault(name, {})
+            hist = by_labels.get(key)
+            if hist is None:
+                hist = by_labels[key] = Histogram()
+        return hist
+
+    def record(self, name: str, seconds: float, **labels: str):
+        self.histogram(name, **labels).record(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter()-start, **labels)
+
+    def items(self) -> List[Tuple[str,Labels,Histogram]]:
+        with self.lock:
+            return [ (name, labels, hist) for (name,by_labels) in sorted(self.histograms.items())
+                for (labels,hist) in sorted(by_labels.items()) ]
+
+    def prometheus_text(self) -> str:
+        '''
+        Returns: every histogram as a Prometheus summary, in the text
+            exposition format
+        '''
+        lines = []
+        last_name = None
+        for (name, labels, hist) in self.items():
+            if name != last_name:
+                lines.append('# TYPE {0} summary'.format(name))
+                last_name = name
+            label_text = ','.join('{0}="{1}"'.format(k, v.replace('\\','\\\\').replace('"','\\"'))
+                for (k,v) in labels)
+            sep = ',' if label_text else ''
+            for (q,value) in zip(QUANTILES, hist.quantiles(QUANTILES)):
+                lines.append('{0}{{{1}{2}quantile="{3}"}} {4:.6f}'.format(name, label_text, sep, q, value))
+            snap = hist.snapshot()
+            braces = '{{{0}}}'.format(label_text) if label_text else ''
+            lines.append('{0}_sum{1} {2:.6f}'.format(name, braces, snap['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, braces, snap['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename: str):
+        '''
+        Write `prometheus_text` to a file, replacing it atomically, e.g. for
+        the node exporter's textfile collector.
+        '''
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_filename, filename)
+
+    def start_dumper(self, filename: str, interval: float=METRICS_INTERVAL):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(filename)
+                except OSError as e:
+                    logging.warning('Failed to write metrics: {0}'.format(e))
+
+        threading.Thread(target=run, name='metrics-dump', daemon=True).start()
+
+    def serve(self, port: int, host: str='127.0.0.1') -> ThreadingHTTPServer:
+        '''
+        Serve `prometheus_text` over HTTP at /metrics, from a daemon thread.
+        '''
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
+
+def start_exporters(filename: Optional[str]=METRICS_FILE, port: int=METRICS_PORT):
+    '''
+    Start writing and/or serving metrics, as configured.
+    '''
+    if filename:
+        metrics.start_dumper(filename)
+    if port:
+        metrics.serve(port)
+
+# Time spent per command in each phase: parse, dispatch, post, worker
+COMMAND_SECONDS = 'yarnbot_command_seconds'
+# Time per upstream call: Ravelry endpoints, Slack methods
+UPSTREAM_SECONDS = 'yarnbot_upstream_seconds'
+
+metrics = Metrics()
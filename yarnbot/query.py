@@ -0,0 +1,113 @@
+'''
+Parsing of Ravelry search words into structured queries.
+
+Each word is classified with a single dict lookup, as a stopword, yarn
+weight, fiber, craft, the "free" filter, or free text, so parsing is one
+pass over the words. The lookup tables are built from `data`.
+
+Queries are hashable and normalized, with filters de-duplicated and in
+table order, so searches that differ only in word order or repeated
+filters share a cached Ravelry response.
+'''
+
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from . import data
+
+YARN_SEARCH = 'yarn'
+PATTERN_SEARCH = 'pattern'
+
+# Token classes
+STOPWORD = 'stopword'
+WEIGHT = 'weight'
+FIBER = 'fiber'
+CRAFT = 'craft'
+FREE = 'free'
+TEXT = 'text'
+
+STOPWORDS = frozenset(['or', 'and', 'pattern', 'patterns', 'with', 'using',
+    'weight', 'weights', 'color'])
+PATTERN_STOPWORDS = STOPWORDS | frozenset(['yarn'])
+
+# Craft words, and the Ravelry craft each means, in the order they're listed
+CRAFTS = {'knit': 'knitting', 'knitting': 'knitting', 'crochet': 'crochet'}
+
+class SearchQuery(NamedTuple):
+    kind: str
+    # Free text, in the order given
+    words: Tuple[str,...] = ()
+    weights: Tuple[str,...] = ()
+    fibers: Tuple[str,...] = ()
+    crafts: Tuple[str,...] = ()
+    free: bool = False
+    page_size: int = 5
+    page: int = 1
+
+    @property
+    def text(self) -> str:
+        return ' '.join(self.words)
+
+class Vocabulary:
+    '''
+    Token lookup tables for yarn and pattern searches.
+    '''
+
+    def __init__(self) -> None:
+        self.load()
+
+    def load(self) -> None:
+        '''
+        (Re)build the tables from `data`.
+        '''
+        # Where each filter value is listed in `data`, to order them by
+        self.ranks: Dict[str,Dict[str,int]] = {WEIGHT: {}, FIBER: {}, CRAFT: {}, FREE: {'free': 0}}
+        yarn_tokens: Dict[str,Tuple[str,str]] = {}
+        pattern_tokens: Dict[str,Tuple[str,str]] = {}
+
+        for (rank,name) in enumerate(data.yarn_weights):
+            token = name.lower().replace(' ', '-')
+            self.ranks[WEIGHT][token] = rank
+            yarn_tokens[token] = pattern_tokens[token] = (WEIGHT, token)
+        for (rank,fiber) in enumerate(data.yarn_fibers):
+            self.ranks[FIBER][fiber] = rank
+            yarn_tokens[fiber] = (FIBER, fiber)
+        for (rank,(token,craft)) in enumerate(CRAFTS.items()):
+            self.ranks[CRAFT].setdefault(craft, rank)
+            pattern_tokens[token] = (CRAFT, craft)
+        pattern_tokens['free'] = (FREE, 'free')
+
+        # Stopwords win, as they did when filters were removed after them
+        yarn_tokens.update( (w, (STOPWORD, w)) for w in STOPWORDS )
+        pattern_tokens.update( (w, (STOPWORD, w)) for w in PATTERN_STOPWORDS )
+
+        self.tokens = {YARN_SEARCH: yarn_tokens, PATTERN_SEARCH: pattern_tokens}
+
+    def parse(self, kind: str, words: Iterable[str], page_size: int=5, page: int=1) -> SearchQuery:
+        '''
+        Classify search words, without changing them.
+        '''
+        tokens = self.tokens[kind]
+        text = []
+        found: Dict[str,List[str]] = {WEIGHT: [], FIBER: [], CRAFT: [], FREE: []}
+
+        for word in words:
+            entry = tokens.get(word)
+            if entry is None:
+                text.append(word)
+            elif entry[0] != STOPWORD and entry[1] not in found[entry[0]]:
+                found[entry[0]].append(entry[1])
+
+        for (token_class, values) in found.items():
+            if len(values) > 1:
+                values.sort(key=self.ranks[token_class].__getitem__)
+
+        return SearchQuery(kind, tuple(text), tuple(found[WEIGHT]), tuple(found[FIBER]),
+            tuple(found[CRAFT]), len(found[FREE]) > 0, page_size, page)
+
+vocabulary = Vocabulary()
+
+def parse_yarn_search(words: Iterable[str], page_size: int=5, page: int=1) -> SearchQuery:
+    return vocabulary.parse(YARN_SEARCH, words, page_size, page)
+
+def parse_pattern_search(words: Iterable[str]) -> SearchQuery:
+    return vocabulary.parse(PATTERN_SEARCH, words)
@@ -0,0 +1,160 @@
+'''
+Token bucket rate limiting, applied to messages before they are dispatched.
+'''
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+# Sustained rate in commands per second, and burst size, per user, per
+# channel, and across everyone for commands that call Ravelry
+RATE_USER = float(os.environ.get('RATE_USER', '0.5'))
+RATE_USER_BURST = float(os.environ.get('RATE_USER_BURST', '10'))
+RATE_CHANNEL = float(os.environ.get('RATE_CHANNEL', '1'))
+RATE_CHANNEL_BURST = float(os.environ.get('RATE_CHANNEL_BURST', '20'))
+RATE_RAVELRY = float(os.environ.get('RATE_RAVELRY', '1'))
+RATE_RAVELRY_BURST = float(os.environ.get('RATE_RAVELRY_BURST', '10'))
+RATE_MAX_BUCKETS = int(os.environ.get('RATE_MAX_BUCKETS', '10000'))
+
+# Which limit refused a command
+USER_LIMIT = 'user'
+CHANNEL_LIMIT = 'channel'
+RAVELRY_LIMIT = 'ravelry'
+
+class Bucket:
+    __slots__ = ('tokens', 'stamp', 'refused')
+
+    def __init__(self, tokens: float, stamp: float) -> None:
+        self.tokens = tokens
+        self.stamp = stamp
+        # Refusals since the last command allowed
+        self.refused = 0
+
+class TokenBuckets:
+    '''
+    Thread-safe table of token buckets, one per key, each holding up to
+    `burst` tokens and refilling at `rate` tokens per second.
+
+    A bucket left idle long enough to refill completely is the same as a
+    new one, so such buckets are dropped, least recently used first. The
+    table never holds more than `max_buckets`; past that, the least recently
+    used bucket is dropped even if it isn't full, which only ever errs on
+    the side of allowing a command.
+    '''
+
+    def __init__(self, rate: float, burst: float, max_buckets: int=RATE_MAX_BUCKETS) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.idle = burst/rate if rate > 0 else float('inf')
+        self.lock = threading.Lock()
+        self.buckets: 'OrderedDict[Hashable,Bucket]' = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+
+    def take(self, key: Hashable, cost: float=1) -> int:
+        '''
+        Take `cost` tokens from the key's bucket, if it has them.
+
+        Returns: 0 if allowed, otherwise the number of refusals in a row,
+            so callers can tell the first refusal from the rest
+        '''
+        return self.take_bucket(key, cost)[0]
+
+    def take_bucket(self, key: Hashable, cost: float=1) -> Tuple[int,Bucket]:
+        '''
+        `take`, also returning the bucket the tokens came from, to `refund`
+        them to later.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = Bucket(self.burst, now)
+                self.buckets[key] = bucket
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.stamp)*self.rate)
+                bucket.stamp = now
+                self.buckets.move_to_end(key)
+
+            self._evict(now)
+
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                bucket.refused = 0
+                self.allowed += 1
+                return (0, bucket)
+
+            bucket.refused += 1
+            self.throttled += 1
+            return (bucket.refused, bucket)
+
+    def refund(self, key: Hashable, bucket: Bucket, cost: float=1):
+        '''
+        Give back tokens taken from `bucket` for a command that another limit
+        then refused. Nothing is given back if the bucket has been dropped
+        since: the key's new bucket never had them taken.
+        '''
+        with self.lock:
+            if self.buckets.get(key) is bucket:
+                bucket.tokens = min(self.burst, bucket.tokens + cost)
+                self.allowed -= 1
+
+    def _evict(self, now: float):
+        while len(self.buckets) > self.max_buckets:
+            self.buckets.popitem(last=False)
+        while len(self.buckets) > 1:
+            (key, oldest) = next(iter(self.buckets.items()))
+            if now - oldest.stamp < self.idle:
+                break
+            del self.buckets[key]
+
+    def summary(self) -> Dict[str,int]:
+        with self.lock:
+            return {'buckets': len(self.buckets), 'allowed': self.allowed, 'throttled': self.throttled}
+
+class RateLimiter:
+    '''
+    Per-user, per-channel and global Ravelry limits together.
+    '''
+
+    def __init__(self) -> None:
+        self.users = TokenBuckets(RATE_USER, RATE_USER_BURST)
+        self.channels = TokenBuckets(RATE_CHANNEL, RATE_CHANNEL_BURST)
+        self.ravelry = TokenBuckets(RATE_RAVELRY, RATE_RAVELRY_BURST, max_buckets=1)
+
+    def allow(self, user_id: str, channel_id: str, ravelry: bool=False) -> Tuple[Optional[str],int]:
+        '''
+        Take a token for a command from the user's and channel's buckets, and
+        the Ravelry one if it calls Ravelry. A command is charged only if
+        every limit allows it: tokens already taken when a later limit
+        refuses are given back.
+
+        Returns: (None, 0) if allowed, otherwise (the limit that refused it,
+            refusals in a row from that limit)
+        '''
+        (refused, user) = self.users.take_bucket(user_id)
+        if refused:
+            return (USER_LIMIT, refused)
+
+        (refused, channel) = self.channels.take_bucket(channel_id)
+        if refused:
+            self.users.refund(user_id, user)
+            return (CHANNEL_LIMIT, refused)
+
+        if ravelry:
+            refused = self.ravelry.take(None)
+            if refused:
+                self.users.refund(user_id, user)
+                self.channels.refund(channel_id, channel)
+                return (RAVELRY_LIMIT, refused)
+
+        return (None, 0)
+
+    def summary(self) -> Dict[str,Dict[str,int]]:
+        return {'users': self.users.summary(), 'channels': self.channels.summary(),
+            'ravelry': self.ravelry.summary()}
+
+rate_limiter = RateLimiter()
@@ -1,268 +1,863 @@
 import os
+import re
 import json
+import time
+import random
+import asyncio
+import logging
+import threading
 import requests
+import numpy as np
+
+from collections import deque
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (TYPE_CHECKING, Any, Awaitable, Callable, Dict, Generator, Hashable,
+    List, Optional, Sequence, Set, Tuple)
+
+from requests.adapters import HTTPAdapter
 
 from . import data
+from .cache import ResponseCache
+from .metrics import UPSTREAM_SECONDS, metrics
+from .query import YARN_SEARCH, parse_pattern_search, parse_yarn_search
+from .render import attachments_json, pattern_card, yarn_card
+
+if TYPE_CHECKING:
+    from .catalog import YarnCatalog
 
 RAV_ACC_KEY = os.environ.get('RAV_ACC_KEY')
 RAV_SEC_KEY = os.environ.get('RAV_SEC_KEY')
 
-def yarn_distance(yarn1, yarn2):
-
-    mass1 = yarn1['grams']
-    mass2 = yarn2['grams']
-    yards1 = yarn1['yardage']
-    yards2 = yarn2['yardage']
-    wpi1 = yarn1['wpi']
-    wpi2 = yarn1['wpi']
-    min_gauge1 = yarn1['min_gauge']
-    min_gauge2 = yarn2['min_gauge']
-    max_gauge1 = yarn1['max_gauge']
-    max_gauge2 = yarn2['max_gauge']
-    gauge_div1 = yarn1['gauge_divisor']
-    gauge_div2 = yarn2['gauge_divisor']
+RAV_API_URL = 'https://api.ravelry.com/'
+RAV_POOL_SIZE = int(os.environ.get('RAV_POOL_SIZE', '10'))
+RAV_CONNECT_TIMEOUT = float(os.environ.get('RAV_CONNECT_TIMEOUT', '3.05'))
+RAV_READ_TIMEOUT = float(os.environ.get('RAV_READ_TIMEOUT', '10'))
+RAV_MAX_RETRIES = int(os.environ.get('RAV_MAX_RETRIES', '2'))
+
+RAV_SEARCH_TTL = float(os.environ.get('RAV_SEARCH_TTL', '600'))
+RAV_DETAIL_TTL = float(os.environ.get('RAV_DETAIL_TTL', '86400'))
+RAV_CACHE_ENTRIES = int(os.environ.get('RAV_CACHE_ENTRIES', '2000'))
+RAV_CACHE_BYTES = int(os.environ.get('RAV_CACHE_BYTES', str(32*1024*1024)))
+
+# Yarn details asked for within RAV_DETAIL_WINDOW seconds are fetched
+# together, up to RAV_DETAIL_BATCH per request
+RAV_DETAIL_WINDOW = float(os.environ.get('RAV_DETAIL_WINDOW', '0.005'))
+RAV_DETAIL_BATCH = int(os.environ.get('RAV_DETAIL_BATCH', '20'))
+RAV_DETAIL_WORKERS = int(os.environ.get('RAV_DETAIL_WORKERS', '4'))
+# Similar yarn is ranked across up to RAV_SIMILAR_PAGES result pages,
+# stopping once the top matches hold for RAV_SIMILAR_STABLE_PAGES pages
+RAV_SIMILAR_PAGES = int(os.environ.get('RAV_SIMILAR_PAGES', '2'))
+RAV_SIMILAR_PAGE_SIZE = int(os.environ.get('RAV_SIMILAR_PAGE_SIZE', '50'))
+RAV_SIMILAR_STABLE_PAGES = int(os.environ.get('RAV_SIMILAR_STABLE_PAGES', '1'))
+
+# Responses worth another try
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+ID_RE = re.compile('/[0-9]+(?=[/.])')
+# User names in paths, e.g. /people/{username}/favorites/list.json
+USERNAME_RE = re.compile(r'^/people/[^/]+?(?=/|\.json$)')
+DETAIL_RE = re.compile(r'^/yarns/[0-9]+\.json$')
+
+def endpoint_name(api_call: str) -> str:
+    '''
+    Normalized endpoint, with numeric ids replaced by {id} and user names
+    by {username}, e.g. 'yarns/1234.json' -> '/yarns/{id}.json', so there
+    is one per kind of call
+    '''
+    endpoint = USERNAME_RE.sub('/people/{username}', '/' + api_call.lstrip('/'))
+    return ID_RE.sub('/{id}', endpoint)
+
+class LatencyStats:
+    '''
+    Thread-safe per-endpoint call statistics. Keeps running totals, and the
+    most recent `window` latencies for percentiles. Latencies also go to
+    the `upstream` histograms in `metrics`.
+    '''
+
+    def __init__(self, window: int=1000, upstream: str='ravelry') -> None:
+        self.window = window
+        self.upstream = upstream
+        self.lock = threading.Lock()
+        self.calls: Dict[str,Dict[str,Any]] = {}
+
+    def _entry(self, endpoint: str) -> Dict[str,Any]:
+        if endpoint not in self.calls:
+            self.calls[endpoint] = {'count': 0, 'errors': 0, 'retries': 0,
+                'total': 0.0, 'max': 0.0, 'recent': deque(maxlen=self.window)}
+        return self.calls[endpoint]
+
+    def record(self, endpoint: str, elapsed: float, error: bool=False):
+        metrics.record(UPSTREAM_SECONDS, elapsed, upstream=self.upstream, endpoint=endpoint)
+        with self.lock:
+            entry = self._entry(endpoint)
+            entry['count'] += 1
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            entry['recent'].append(elapsed)
+            if error:
+                entry['errors'] += 1
+
+    def record_retry(self, endpoint: str):
+        with self.lock:
+            self._entry(endpoint)['retries'] += 1
+
+    def summary(self) -> Dict[str,Dict[str,float]]:
+        '''
+        Returns: per-endpoint dictionary of call counts and latencies in ms
+        '''
+        result = dict()
+        with self.lock:
+            for (endpoint,entry) in self.calls.items():
+                recent = sorted(entry['recent'])
+                n = len(recent)
+                result[endpoint] = {
+                    'count': entry['count'],
+                    'errors': entry['errors'],
+                    'retries': entry['retries'],
+                    'mean_ms': 1000*entry['total']/entry['count'] if entry['count'] else 0.,
+                    'p50_ms': 1000*recent[n//2] if n else 0.,
+                    'p99_ms': 1000*recent[min(n-1, (99*n)//100)] if n else 0.,
+                    'max_ms': 1000*entry['max']}
+        return result
+
+class BaseRavelryClient:
+    '''
+    Settings, statistics and retry policy shared by the Ravelry clients.
+    '''
+
+    def __init__(self, base_url: str=RAV_API_URL,
+            auth: Optional[Tuple[str,str]]=None,
+            pool_size: int=RAV_POOL_SIZE,
+            connect_timeout: float=RAV_CONNECT_TIMEOUT,
+            read_timeout: float=RAV_READ_TIMEOUT,
+            max_retries: int=RAV_MAX_RETRIES,
+            backoff: float=0.5, max_backoff: float=5.0,
+            stats: Optional[LatencyStats]=None) -> None:
+        '''
+        Parameters:
+            base_url: API root, requests are made relative to it
+            auth: (user, password) pair for HTTP basic auth
+            pool_size: Maximum number of open connections
+            connect_timeout, read_timeout: Timeouts in seconds
+            max_retries: Retries after the first attempt
+            backoff: Base of the exponential backoff, in seconds
+            max_backoff: Upper bound for any single wait, in seconds
+            stats: Where to record call statistics
+        '''
+        self.base_url = base_url
+        self.auth = auth
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = stats if stats is not None else LatencyStats()
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str]=None) -> float:
+        '''
+        Seconds to wait before retrying: the server's Retry-After if given,
+        otherwise a random ("full jitter") exponential backoff.
+        '''
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff*2**attempt, self.max_backoff))
+
+class RavelryClient(BaseRavelryClient):
+    '''
+    Ravelry API client sharing one pooled, keep-alive HTTP session between
+    threads. Requests time out, and 429/5xx responses and connection errors
+    are retried a bounded number of times with jittered exponential backoff.
+    '''
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        # pool_block keeps the number of connections bounded when more
+        # threads than pool_size are making calls at once
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, api_call: str, parms: Optional[Dict[str,Any]]=None) -> Any:
+        '''
+        Make a GET request to the API and return the decoded JSON response.
+        Raises `requests.RequestException` if all attempts fail.
+        '''
+        return self.fetch(api_call, parms)[0]
+
+    def fetch(self, api_call: str, parms: Optional[Dict[str,Any]]=None) -> Tuple[Any,int]:
+        '''
+        Same as `get`, but also returns the size of the response body in bytes.
+        '''
+        url = self.base_url + api_call.lstrip('/')
+        endpoint = endpoint_name(api_call)
+
+        attempt = 0
+        while True:
+            resp = None
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(url, params=parms, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.stats.record(endpoint, time.perf_counter()-start, error=True)
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning('Ravelry {0} failed ({1}), retrying'.format(endpoint, e))
+            else:
+                retry = resp.status_code in RETRY_STATUSES
+                self.stats.record(endpoint, time.perf_counter()-start, error=retry)
+                if not retry or attempt >= self.max_retries:
+                    resp.raise_for_status()
+                    return (resp.json(), len(resp.content))
+                logging.warning('Ravelry {0} returned {1}, retrying'.format(endpoint, resp.status_code))
+
+            self.stats.record_retry(endpoint)
+            time.sleep(self.retry_delay(attempt, resp.headers.get('Retry-After') if resp is not None else None))
+            attempt += 1
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent calls: while a call for a key is in
+    flight, later callers with the same key wait for its result instead of
+    making their own. Works for threads (`do`) and for coroutines
+    (`do_async`), which are tracked separately, per event loop.
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable,Future] = {}
+        self.async_calls: Dict[Hashable,'asyncio.Future[Any]'] = {}
+        # Calls made, and calls that waited on one of those instead
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, func: Callable[[],Any]) -> Any:
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.shared += 1
+            else:
+                self.leaders += 1
+                self.calls[key] = Future()
+
+        if future is not None:
+            return future.result()
 
+        try:
+            result = func()
+        except BaseException as e:
+            self._finish(self.calls, key).set_exception(e)
+            raise
+        self._finish(self.calls, key).set_result(result)
+        return result
+
+    async def do_async(self, key: Hashable, func: Callable[[],Awaitable[Any]]) -> Any:
+        key = (id(asyncio.get_running_loop()), key)
+        with self.lock:
+            future = self.async_calls.get(key)
+            if future is not None:
+                self.shared += 1
+            else:
+                self.leaders += 1
+                self.async_calls[key] = asyncio.get_running_loop().create_future()
+
+        if future is None:
+            # The call runs in its own task, so the first caller giving up
+            # doesn't cancel it for everyone else either
+            future = self.async_calls[key]
+            task = asyncio.ensure_future(func())
+            task.add_done_callback(lambda done: self._settle(key, done))
+
+        # A caller giving up mustn't cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def _settle(self, key: Hashable, task: 'asyncio.Future[Any]') -> None:
+        future = self._finish(self.async_calls, key)
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+            # Retrieved, so there's no warning if nobody else was waiting
+            future.exception()
+        else:
+            future.set_result(task.result())
+
+    def _finish(self, calls: Dict[Hashable,Any], key: Hashable) -> Any:
+        with self.lock:
+            return calls.pop(key)
+
+    def summary(self) -> Dict[str,int]:
+        with self.lock:
+            return {'calls': self.leaders, 'shared': self.shared}
+
+def cache_key(api_call: str, parms: Optional[Dict[str,Any]]) -> Hashable:
+    '''
+    Cache key for an API call: the path and the parameters, with values
+    normalized to stripped strings and sorted by name.
+    '''
+    items = parms.items() if parms else []
+    return ('/' + api_call.strip('/'),
+        tuple(sorted( (k,str(v).strip()) for (k,v) in items )))
+
+def cache_ttl(api_call: str) -> Optional[float]:
+    '''
+    Returns: how long responses from this API call may be cached, or None
+        if they shouldn't be
+    '''
+    endpoint = endpoint_name(api_call)
+    if endpoint.endswith('/search.json'):
+        return RAV_SEARCH_TTL
+    if DETAIL_RE.match('/' + api_call.lstrip('/')):
+        return RAV_DETAIL_TTL
+    return None
+
+# Shared by the sync and async clients
+rav_stats = LatencyStats()
+rav_flight = SingleFlight()
+
+rav_client = RavelryClient(auth=(RAV_ACC_KEY or '', RAV_SEC_KEY or ''), stats=rav_stats)
+rav_cache = ResponseCache(RAV_CACHE_ENTRIES, RAV_CACHE_BYTES)
+
+# Set by the application to record every yarn fetched
+rav_catalog: Optional['YarnCatalog'] = None
+
+def weight_name(yarn: Dict[str,Any]) -> Optional[str]:
+    '''
+    Weight of a yarn record in search form, e.g. 'light-fingering'
+    '''
+    weight = yarn.get('yarn_weight')
+    if not weight or not weight.get('name'):
+        return None
+    return weight['name'].lower().replace(' ','-')
+
+def fiber_names(yarn: Dict[str,Any]) -> List[str]:
+    '''
+    Fibers of a yarn detail record in search form, e.g. 'plant-fiber'
+    '''
+    return [ x['fiber_type']['name'].lower().replace(' ','-') for x in yarn.get('yarn_fibers', []) ]
+
+YarnFeatures = Tuple[Optional[float],Optional[float],Optional[float],Optional[float]]
+
+def yarn_features(yarn) -> YarnFeatures:
+    '''
+    Numeric features used to compare yarns: density (grams per yard), wraps
+    per inch, and minimum and maximum gauge normalized to stitches per inch.
+    Missing values are None.
+    '''
+    mass = yarn.get('grams')
+    yards = yarn.get('yardage')
+    wpi = yarn.get('wpi')
+    min_gauge = yarn.get('min_gauge')
+    max_gauge = yarn.get('max_gauge')
+    gauge_div = yarn.get('gauge_divisor')
 
     # Density
-    if mass1 != None and yards1 != None:
-        density1 = float(mass1)/float(yards1)
-    else:
-        density1 = None
-
-    if mass2 != None and yards2 != None:
-        density2 = float(mass2)/float(yards2)
+    if mass != None and yards:
+        density = float(mass)/float(yards)
     else:
-        density2 = None
+        density = None
 
     # Gauge
-    if gauge_div1 != None and min_gauge1 != None:
-        min_gauge_norm1 = min_gauge1/gauge_div1
-    else:
-        min_gauge_norm1 = None
-    if gauge_div1 != None and max_gauge1 != None:
-        max_gauge_norm1 = max_gauge1/gauge_div1
-    else:
-        max_gauge_norm1 = None
-
-    if gauge_div2 != None and min_gauge2 != None:
-        min_gauge_norm2 = min_gauge2/gauge_div2
+    if gauge_div and min_gauge != None:
+        min_gauge_norm = float(min_gauge)/gauge_div
     else:
-        min_gauge_norm2 = None
-    if gauge_div2 != None and max_gauge2 != None:
-        max_gauge_norm2 = max_gauge2/gauge_div2
+        min_gauge_norm = None
+    if gauge_div and max_gauge != None:
+        max_gauge_norm = float(max_gauge)/gauge_div
     else:
-        max_gauge_norm2 = None
+        max_gauge_norm = None
 
+    return (density, float(wpi) if wpi != None else None, min_gauge_norm, max_gauge_norm)
 
-    # Distance measures
-
-    dist = lambda x,y: float(abs(x-y))/(x+y)
+def feature_distance(features1: YarnFeatures, features2: YarnFeatures) -> float:
+    '''
+    Sum over features of the relative difference |x-y|/(x+y), with a penalty
+    of 0.5 for each feature missing from either yarn.
+    '''
     d = 0.
-
-    if density1 != None and density2 != None:
-        d += dist(density1,density2)
-    else:
-        d += 0.5
-
-    if wpi1 != None and wpi2 != None:
-        d += dist(wpi1,wpi2)
-    else:
-        d += 0.5
-
-    if min_gauge_norm1 != None and min_gauge_norm2 != None:
-        d += dist(min_gauge_norm1,min_gauge_norm1)
-    else:
-        d += 0.5
-    if max_gauge_norm1 != None and max_gauge_norm2 != None:
-        d += dist(max_gauge_norm1,max_gauge_norm1)
-    else:
-        d += 0.5
+    for (x,y) in zip(features1, features2):
+        if x != None and y != None:
+            d += float(abs(x-y))/(x+y) if x+y > 0 else 0.
+        else:
+            d += 0.5
 
     return d
 
-def ravelry_api(api_call, parms):
-
-    req = requests.get('https://api.ravelry.com/' + api_call, auth=(RAV_ACC_KEY,RAV_SEC_KEY), params=parms)
-
-    return req.json()
-
-def ravelry_api_yarn(rav_cmd, page_size=5):
-
-
-    filtered_words = ['or','and','pattern',
-        'patterns','with','using',
-        'weight','weights','color']
-    for w in filtered_words:
-        if w in rav_cmd:
-            rav_cmd.remove(w)
+def yarn_distance(yarn1, yarn2):
 
-    parms = {'photo':'yes', 'page_size':str(page_size), 'sort':'projects'}
+    return feature_distance(yarn_features(yarn1), yarn_features(yarn2))
+
+def feature_matrix(features: Sequence[YarnFeatures]) -> np.ndarray:
+    '''
+    Pack feature tuples into an (N,4) float array, with NaN for missing values.
+    '''
+    if len(features) == 0:
+        return np.empty((0,4))
+    return np.array([ [ np.nan if x is None else x for x in f ] for f in features ], dtype=float)
+
+def feature_distances(target: YarnFeatures, matrix: np.ndarray) -> np.ndarray:
+    '''
+    Vectorized `feature_distance` from one target to every row of a
+    feature matrix.
+    '''
+    t = np.array([ np.nan if x is None else x for x in target ], dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = matrix + t
+        # As in `feature_distance`, no difference unless the total is positive
+        rel = np.where(total > 0, np.abs(matrix - t)/total, 0.)
+    rel[np.isnan(total)] = 0.5
+
+    return rel.sum(axis=1)
+
+def nearest(distances: np.ndarray, k: int) -> List[int]:
+    '''
+    Returns: indices of the k smallest distances, smallest first. Ties keep
+        their original order, as with a stable sort.
+    '''
+    n = len(distances)
+    if k < n:
+        kth = np.partition(distances, k-1)[k-1]
+        idx = np.flatnonzero(distances <= kth)
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(distances[idx], kind='stable')][:k].tolist()
+
+def yarn_distances(target, yarns) -> np.ndarray:
+    '''
+    Batch `yarn_distance` from one target yarn to each of a list of yarns.
+    '''
+    matrix = feature_matrix([ yarn_features(y) for y in yarns ])
+    return feature_distances(yarn_features(target), matrix)
+
+def ravelry_api(api_call, parms, key=None):
+    '''
+    Call the Ravelry API, through the response cache if the call's responses
+    are cacheable. `key` identifies the response, by default the call and
+    its parameters: identical calls already in flight are waited for rather
+    than repeated.
+    '''
+
+    if key is None:
+        key = cache_key(api_call, parms)
+
+    ttl = cache_ttl(api_call)
+    if ttl is None:
+        return rav_flight.do(key, lambda: rav_client.get(api_call, parms))
+
+    result = rav_cache.get(key)
+    if result is None:
+        result = rav_flight.do(key, lambda: fetch_and_cache(api_call, parms, key, ttl))
+
+    return result
+
+def fetch_and_cache(api_call, parms, key, ttl):
+    # A flight for this key may have landed between the cache check and
+    # this one leading the next
+    result = rav_cache.get(key)
+    if result is not None:
+        return result
+
+    (result, size) = rav_client.fetch(api_call, parms)
+    rav_cache.put(key, result, size, ttl)
+    if rav_catalog is not None:
+        rav_catalog.add_response(api_call, parms, result)
+    return result
+
+def yarn_search_parms(query):
+    '''
+    Turn a parsed yarn search into Ravelry search parameters.
+
+    Returns: (description of the search, parameters)
+    '''
+
+    parms = {'photo':'yes', 'page_size':str(query.page_size), 'sort':'projects'}
+    if query.page > 1:
+        parms['page'] = str(query.page)
     msg = u'Yarn search results for:'
-    
-    filter_weight = []
-    for w in data.yarn_weights.keys():
-        s = w.lower().replace(' ','-')
-        if s in rav_cmd:
-            filter_weight.append(s)
-            rav_cmd.remove(s)
 
-    filter_fiber = []
-    for f in data.yarn_fibers:
-        if f in rav_cmd:
-            filter_fiber.append(f)
-            rav_cmd.remove(f)
+    if len(query.weights) > 0:
+        parms.update({'weight': '|'.join(query.weights)})
+        msg += u' {0} weight'.format( ' or '.join(query.weights) )
+
+    if len(query.fibers) > 0:
+        parms.update({'fiber': '+'.join(query.fibers)})
+        msg += u' with {0} fiber'.format( ' and '.join(query.fibers) )
 
+    parms.update({'query':query.text})
+    msg += u' containing "{0}"'.format(query.text)
 
-    if len(filter_weight) > 0:
-        parms.update({'weight': '|'.join(filter_weight)})
-        msg += u' {0} weight'.format( ' or '.join(filter_weight) )
+    return (msg, parms)
 
-    if len(filter_fiber) > 0:
-        parms.update({'fiber': '+'.join(filter_fiber)})
-        msg += u' with {0} fiber'.format( ' and '.join(filter_fiber) )
+def ravelry_api_yarn(rav_cmd, page_size=5, page=1):
 
-    parms.update({'query':' '.join(rav_cmd)})
-    msg += u' containing "{0}"'.format(' '.join(rav_cmd))
+    query = parse_yarn_search(rav_cmd, page_size, page)
+    (msg, parms) = yarn_search_parms(query)
 
-    rav_result = ravelry_api('/yarns/search.json', parms)
+    rav_result = ravelry_api('/yarns/search.json', parms, key=query)
     
     return (rav_result, msg, parms)
 
-
-def ravelry_yarn(rav_cmd):
-
-    (rav_result, msg, parms) = ravelry_api_yarn(rav_cmd)
-
-    if rav_result['paginator']['results'] == 0:
-        return (None,None)
-
-    attachments = []
-    for info in rav_result['yarns']:
-        
-        mach_wash = info['machine_washable'] if 'machine_washable' in info else None
-        if mach_wash == None or not mach_wash:
-            mach_wash = 'No'
+def detail_key(yarn_id) -> Hashable:
+    '''
+    Cache key of a yarn's detail response, as `ravelry_api` would make it
+    '''
+    return cache_key('yarns/{0}.json'.format(yarn_id), {'id': yarn_id})
+
+class DetailLoader:
+    '''
+    Batches yarn detail requests. Ids asked for within `window` seconds of
+    each other, up to `batch` of them, are fetched together with the
+    multi-id form of the API, `yarns.json?ids=1+2+3`. Yarns missing from its
+    response, or every yarn if the form fails, are fetched one at a time on
+    the loader's own bounded pool. Each detail is merged into the response
+    cache and catalog as if it had been fetched on its own.
+
+    An id already being fetched isn't fetched again: callers asking for it
+    get the same future.
+    '''
+
+    def __init__(self, window: float=RAV_DETAIL_WINDOW, batch: int=RAV_DETAIL_BATCH,
+            workers: int=RAV_DETAIL_WORKERS) -> None:
+        self.window = window
+        self.batch = batch
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ravelry-detail')
+        self.lock = threading.Lock()
+        # Futures of ids queued or being fetched
+        self.pending: Dict[int,Future] = {}
+        self.queue: List[int] = []
+        self.timer: Optional[threading.Timer] = None
+        # Cleared if the API turns out not to have the multi-id form
+        self.multi = True
+        self.batches = 0
+        self.singles = 0
+        self.shared = 0
+
+    def load(self, yarn_id: int) -> Future:
+        '''
+        Returns: a future resolving to the yarn's detail response,
+            {'yarn': record}
+        '''
+        cached = rav_cache.get(detail_key(yarn_id))
+        if cached is not None:
+            done: Future = Future()
+            done.set_result(cached)
+            return done
+
+        with self.lock:
+            future = self.pending.get(yarn_id)
+            if future is not None:
+                self.shared += 1
+                return future
+
+            future = self.pending[yarn_id] = Future()
+            self.queue.append(yarn_id)
+            if len(self.queue) >= self.batch:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return future
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        (ids, self.queue) = (self.queue, [])
+        if len(ids) == 1 or (ids and not self.multi):
+            for yarn_id in ids:
+                self.singles += 1
+                self.pool.submit(self._fetch_one, yarn_id)
+        elif ids:
+            self.batches += 1
+            self.pool.submit(self._fetch_many, ids)
+
+    def _resolve(self, yarn_id: int, result: Any=None, error: Optional[Exception]=None):
+        with self.lock:
+            future = self.pending.pop(yarn_id)
+        if error is not None:
+            future.set_exception(error)
         else:
-            mach_wash = 'Yes'
+            future.set_result(result)
 
-        organic = info['organic'] if 'organic' in info else None
-        if organic == None or not organic:
-            organic = 'No'
+    def _fetch_one(self, yarn_id: int):
+        try:
+            result = ravelry_api('yarns/{0}.json'.format(yarn_id), {'id': yarn_id})
+        except Exception as e:
+            self._resolve(yarn_id, error=e)
         else:
-            organic = 'Yes'
+            self._resolve(yarn_id, result)
 
-        if 'yarn_weight' in info:
-            description = info['yarn_weight']['name']
+    def _fetch_many(self, ids: List[int]):
+        try:
+            (result, _size) = rav_client.fetch('yarns.json', {'ids': ' '.join(str(i) for i in ids)})
+            details = result.get('yarns') or {}
+            if not isinstance(details, dict):
+                raise ValueError('unexpected yarns in response: {0}'.format(type(details).__name__))
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in (400, 404):
+                logging.warning('Ravelry multi-id yarn details unavailable ({0}), fetching one at a time'.format(e))
+                self.multi = False
+            details = {}
+        except Exception as e:
+            logging.warning('Ravelry multi-id yarn details failed: {0}'.format(e))
+            details = {}
+
+        for yarn_id in ids:
+            # Every id must be resolved, or its callers wait forever
+            try:
+                detail = details.get(str(yarn_id))
+                if detail is None:
+                    with self.lock:
+                        self.singles += 1
+                    self.pool.submit(self._fetch_one, yarn_id)
+                    continue
+                response = {'yarn': detail}
+            except Exception as e:
+                self._resolve(yarn_id, error=e)
+                continue
+            self._resolve(yarn_id, response)
+            self._store(yarn_id, response)
+
+    def _store(self, yarn_id: int, response: Dict[str,Any]):
+        '''
+        Merge a detail from a multi-id response into the cache and catalog,
+        as if it had been fetched on its own. Callers already have it, so
+        failing here only costs a later fetch.
+        '''
+        try:
+            rav_cache.put(detail_key(yarn_id), response, len(json.dumps(response['yarn'])), RAV_DETAIL_TTL)
+            if rav_catalog is not None:
+                rav_catalog.add_response('yarns/{0}.json'.format(yarn_id), {'id': yarn_id}, response)
+        except Exception as e:
+            logging.warning('Failed to store Ravelry yarn detail {0}: {1}'.format(yarn_id, e))
+
+    def summary(self) -> Dict[str,int]:
+        with self.lock:
+            return {'batches': self.batches, 'singles': self.singles, 'shared': self.shared}
+
+detail_loader = DetailLoader()
+
+def yarn_detail(yarn_id):
+    '''
+    Returns: (detail record, fibers) for a yarn, from the catalog if it has
+        seen the detail record before
+    '''
+    return yarn_detail_future(yarn_id).result()
+
+def yarn_detail_future(yarn_id) -> Future:
+    '''
+    Returns: a future resolving to the result of `yarn_detail`
+    '''
+    if rav_catalog is not None:
+        known = rav_catalog.detail(yarn_id)
+        if known is not None:
+            done: Future = Future()
+            done.set_result(known)
+            return done
+
+    def detail(response: Future) -> Tuple[Dict[str,Any],List[str]]:
+        record = response.result()['yarn']
+        return (record, fiber_names(record))
+
+    return chain_future(detail_loader.load(yarn_id), detail)
+
+def chain_future(future: Future, func) -> Future:
+    '''
+    Returns: a future for `func(future)`, run when `future` is done
+    '''
+    chained: Future = Future()
+
+    def done(f: Future):
+        try:
+            chained.set_result(func(f))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+def prefetch_yarn_details(yarn_ids) -> List[Future]:
+    '''
+    Start fetching detail records for several yarns at once, in one
+    request where possible.
+
+    Returns: a future for each yarn, resolving to the result of `yarn_detail`
+    '''
+    return [ yarn_detail_future(yarn_id) for yarn_id in yarn_ids ]
+
+def search_call(query):
+    '''
+    Returns: (API call, key of the records in the response, parameters)
+        for a parsed search
+    '''
+    if query.kind == YARN_SEARCH:
+        return ('/yarns/search.json', 'yarns', yarn_search_parms(query)[1])
+    return ('/patterns/search.json', 'patterns', pattern_search_parms(query)[1])
+
+def search_page(query):
+    (api_call, _records, parms) = search_call(query)
+    return ravelry_api(api_call, parms, key=query)
+
+def search_pages(query, max_pages=None) -> Generator[Tuple[List[Dict[str,Any]],Dict[str,Any]],None,None]:
+    '''
+    Lazily page through a search, from `query.page` on. Each page is only
+    requested once the caller asks for it, so a caller that stops early
+    costs no more calls. Stops after the last page, a short page,
+    `max_pages` pages, or a page that fails after the first.
+
+    Yields: (records, paginator) for each page
+    '''
+    records = search_call(query)[1]
+    page = query.page
+    while max_pages is None or page - query.page < max_pages:
+        try:
+            result = search_page(query._replace(page=page))
+        except Exception as e:
+            if page == query.page:
+                raise
+            logging.warning('Ravelry search page {0} failed: {1}'.format(page, e))
+            return
+
+        paginator = result.get('paginator', {})
+        page_records = result.get(records, [])
+        yield (page_records, paginator)
+
+        if page >= paginator.get('last_page', page) or len(page_records) < query.page_size:
+            return
+        page += 1
+
+class NearestYarns:
+    '''
+    The k yarns nearest a target so far, fed candidates a page at a time.
+    Only the current best are kept, so any number of pages can be ranked.
+    '''
+
+    def __init__(self, target, k: int) -> None:
+        self.target = yarn_features(target)
+        self.k = k
+        self.yarns: List[Dict[str,Any]] = []
+        self.distances = np.empty(0)
+        self.seen: Set[int] = set()
+        # Pages in a row that didn't change the top k
+        self.stable = 0
+
+    def add(self, yarns: List[Dict[str,Any]]):
+        fresh = [ y for y in yarns if y['id'] not in self.seen ]
+        self.seen.update( y['id'] for y in fresh )
+
+        before = [ y['id'] for y in self.yarns ]
+        if fresh:
+            # Current best first, so ties still go to the earlier result
+            distances = np.concatenate([self.distances,
+                feature_distances(self.target, feature_matrix([ yarn_features(y) for y in fresh ]))])
+            candidates = self.yarns + fresh
+            idx = nearest(distances, self.k)
+            self.yarns = [ candidates[i] for i in idx ]
+            self.distances = distances[idx]
+
+        if [ y['id'] for y in self.yarns ] == before:
+            self.stable += 1
         else:
-            description = u'roving?'
+            self.stable = 0
+
+def similar_yarns(target, fibers, weight, k=5, page_size=RAV_SIMILAR_PAGE_SIZE,
+        max_pages=RAV_SIMILAR_PAGES, stable_pages=RAV_SIMILAR_STABLE_PAGES):
+    '''
+    Search for yarn with the given fibers and weight, ranking each result
+    page against the target. Stops early once the top k has held for
+    `stable_pages` pages.
+
+    Returns: the k most similar yarns, most similar first
+    '''
+    ranking = NearestYarns(target, k)
+    with closing(search_pages(parse_yarn_search(fibers + [weight], page_size), max_pages)) as pages:
+        for (yarns, _paginator) in pages:
+            ranking.add(yarns)
+            if ranking.stable >= stable_pages:
+                break
+    return ranking.yarns
+
+def ravelry_yarn(rav_cmd):
+
+    (rav_result, msg, parms) = ravelry_api_yarn(rav_cmd)
 
-        if info['gauge_divisor'] != None:
-            gauge_range = []
-            if info['min_gauge'] != None:
-                gauge_range.append(str(info['min_gauge']))
-            if info['max_gauge'] != None:
-                gauge_range.append(str(info['max_gauge']))
+    return yarn_search_reply(rav_result, msg)
 
-            description += u', {0} sts = {1} in'.format(' to '.join(gauge_range), info['gauge_divisor'])
+def yarn_search_reply(rav_result, msg):
+    '''
+    Returns: (message, attachments JSON) for yarn search results, or
+        (None, None) if there weren't any
+    '''
 
-        description += u', {0} g, {1} yds'.format(info['grams'],info['yardage'])
+    if rav_result['paginator']['results'] == 0:
+        return (None,None)
 
-        attachment = dict()
-        attachment['fallback'] = info['name']
-        attachment['color'] = '#36a64f'
-        attachment['author_name'] = info['yarn_company_name']
-        attachment['title'] = info['name']
-        if info['discontinued']:
-            attachment['title'] += ':skull:'
+    return (msg, attachments_json( yarn_card(info) for info in rav_result['yarns'] ))
 
-        attachment['title_link'] = 'https://www.ravelry.com/yarns/library/' + info['permalink']
-        attachment['text'] = description
-        attachment['thumb_url'] = info['first_photo']['square_url']
-        attachment['fields'] = [ {'title':'Machine Washable', 'value': mach_wash, 'short': True},
-                                 {'title':'Organic', 'value': organic, 'short': True} ]
+def ravelry_pattern(rav_cmd):
 
-        attachments.append( attachment )
+    query = parse_pattern_search(rav_cmd)
+    (msg, parms) = pattern_search_parms(query)
 
-    attach_json = json.dumps( attachments )
+    rav_result = ravelry_api('/patterns/search.json', parms, key=query)
 
-    return (msg, attach_json)
+    return pattern_search_reply(rav_result, msg)
 
-def ravelry_pattern(rav_cmd):
+def pattern_search_parms(query):
+    '''
+    Turn a parsed pattern search into Ravelry search parameters.
 
-    filtered_words = ['or','and','pattern',
-        'patterns','with','using','yarn',
-        'weight','weights','color']
-    for w in filtered_words:
-        if w in rav_cmd:
-            rav_cmd.remove(w)
+    Returns: (description of the search, parameters)
+    '''
 
-    parms = {'photo':'yes', 'page_size':'5', 'sort':'best'}
+    parms = {'photo':'yes', 'page_size':str(query.page_size), 'sort':'best'}
+    if query.page > 1:
+        parms['page'] = str(query.page)
     msg = u'Pattern search results for:'
-    
-    filter_free = 'free' in rav_cmd
-    if filter_free:
-        rav_cmd.remove('free')
-        msg += u' free'
 
-    filter_craft = []
-    if 'knit' in rav_cmd or 'knitting' in rav_cmd:
-        filter_craft.append('knitting')
-        try:
-            rav_cmd.remove('knit')
-            rav_cmd.remove('knitting')
-        except:
-            pass
-    if 'crochet' in rav_cmd:
-        filter_craft.append('crochet')
-        rav_cmd.remove('crochet')
-    
-    filter_weight = []
-    for w in data.yarn_weights.keys():
-        s = w.lower().replace(' ','-')
-        if s in rav_cmd:
-            filter_weight.append(s)
-            rav_cmd.remove(s)
-
-    if filter_free:
+    if query.free:
         parms.update({'availability':'free'})
-    if len(filter_craft) > 0:
-        parms.update({'craft': '|'.join(filter_craft)})
-        msg += u' {0}'.format( ' or '.join(filter_craft) )
+        msg += u' free'
 
-    if len(filter_weight) > 0:
-        parms.update({'weight': '|'.join(filter_weight)})
-        msg += u' with {0} yarn'.format( ' or '.join(filter_weight) )
+    if len(query.crafts) > 0:
+        parms.update({'craft': '|'.join(query.crafts)})
+        msg += u' {0}'.format( ' or '.join(query.crafts) )
 
-    parms.update({'query':' '.join(rav_cmd)})
-    msg += u' containing "{0}"'.format(' '.join(rav_cmd))
+    if len(query.weights) > 0:
+        parms.update({'weight': '|'.join(query.weights)})
+        msg += u' with {0} yarn'.format( ' or '.join(query.weights) )
+
+    parms.update({'query':query.text})
+    msg += u' containing "{0}"'.format(query.text)
 
     search_query = '&'.join([ k + '=' + requests.utils.quote(v) for (k,v) in parms.items() if k != 'page_size'])
     search_url = 'http://www.ravelry.com/patterns/search#' + search_query
 
     msg += u'\n(<{0}|search on ravelry>)'.format(search_url)
 
+    return (msg, parms)
 
-    rav_result = ravelry_api('/patterns/search.json', parms)
+def pattern_search_reply(rav_result, msg):
+    '''
+    Returns: (message, attachments JSON) for pattern search results, or
+        (None, None) if there weren't any
+    '''
 
     if rav_result['paginator']['results'] == 0:
         return (None,None)
 
-    attachments = []
-    for pat in rav_result['patterns']:
-        
-        attachment = dict()
-        attachment['fallback'] = pat['name']
-        attachment['color'] = '#36a64f'
-        attachment['author_name'] = pat['designer']['name']
-        attachment['title'] = pat['name']
-        attachment['title_link'] = 'https://www.ravelry.com/patterns/library/' + pat['permalink']
-        attachment['image_url'] = pat['first_photo']['square_url']
-
-        attachments.append( attachment )
-
-
-    attach_json = json.dumps( attachments )
-
-    return (msg,attach_json)
+    return (msg, attachments_json( pattern_card(pat) for pat in rav_result['patterns'] ))
 
 
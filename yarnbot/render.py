@@ -0,0 +1,150 @@
+'''
+Slack attachments for Ravelry yarn and pattern records.
+
+Yarn search, similar yarn, pattern search and favorites replies all show
+the same cards. Each card is rendered and serialized to JSON once per
+version of its record, keyed by kind, id and `updated_at`, so a reply is
+just its cards' JSON fragments joined into a list, and a popular yarn's
+card is built once.
+'''
+
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable
+
+RENDER_CACHE_ENTRIES = int(os.environ.get('RENDER_CACHE_ENTRIES', '5000'))
+
+CARD_COLOR = '#36a64f'
+
+class CardCache:
+    '''
+    Thread-safe LRU of serialized cards.
+    '''
+
+    def __init__(self, max_entries: int=RENDER_CACHE_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.cards: 'OrderedDict[Hashable,str]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def card(self, kind: str, record: Dict[str,Any], render: Callable[[Dict[str,Any]],Dict[str,Any]]) -> str:
+        '''
+        Returns: `render(record)` as JSON, from the cache if this version of
+            the record was rendered before
+        '''
+        if 'id' not in record:
+            return json.dumps(render(record))
+
+        key = (kind, record['id'], record.get('updated_at'))
+        with self.lock:
+            card = self.cards.get(key)
+            if card is not None:
+                self.cards.move_to_end(key)
+                self.hits += 1
+                return card
+
+        card = json.dumps(render(record))
+
+        with self.lock:
+            self.misses += 1
+            self.cards[key] = card
+            while len(self.cards) > self.max_entries:
+                self.cards.popitem(last=False)
+        return card
+
+    def clear(self):
+        with self.lock:
+            self.cards.clear()
+
+    def summary(self) -> Dict[str,int]:
+        with self.lock:
+            return {'entries': len(self.cards), 'hits': self.hits, 'misses': self.misses}
+
+def yes_no(value: Any) -> str:
+    return 'Yes' if value else 'No'
+
+def render_yarn(info: Dict[str,Any]) -> Dict[str,Any]:
+
+    if info.get('yarn_weight'):
+        description = info['yarn_weight']['name']
+    else:
+        description = u'roving?'
+
+    if info['gauge_divisor'] != None:
+        gauge_range = []
+        if info['min_gauge'] != None:
+            gauge_range.append(str(info['min_gauge']))
+        if info['max_gauge'] != None:
+            gauge_range.append(str(info['max_gauge']))
+
+        description += u', {0} sts = {1} in'.format(' to '.join(gauge_range), info['gauge_divisor'])
+
+    description += u', {0} g, {1} yds'.format(info['grams'],info['yardage'])
+
+    attachment: Dict[str,Any] = dict()
+    attachment['fallback'] = info['name']
+    attachment['color'] = CARD_COLOR
+    attachment['author_name'] = info['yarn_company_name']
+    attachment['title'] = info['name']
+    if info['discontinued']:
+        attachment['title'] += ':skull:'
+
+    attachment['title_link'] = 'https://www.ravelry.com/yarns/library/' + info['permalink']
+    attachment['text'] = description
+    attachment['thumb_url'] = info['first_photo']['square_url']
+    attachment['fields'] = [ {'title':'Machine Washable', 'value': yes_no(info.get('machine_washable')), 'short': True},
+                             {'title':'Organic', 'value': yes_no(info.get('organic')), 'short': True} ]
+
+    return attachment
+
+def render_pattern(pat: Dict[str,Any]) -> Dict[str,Any]:
+
+    attachment: Dict[str,Any] = dict()
+    attachment['fallback'] = pat['name']
+    attachment['color'] = CARD_COLOR
+    attachment['title'] = pat['name']
+    attachment['title_link'] = 'https://www.ravelry.com/patterns/library/' + pat['permalink']
+
+    # Sometimes not everything is available, in favorites
+    try:
+        attachment['author_name'] = pat['designer']['name']
+    except (KeyError, TypeError):
+        logging.warning(u'Ravelry pattern with missing designer: {0}'.format(pat.get('id')))
+    try:
+        attachment['image_url'] = pat['first_photo']['square_url']
+    except (KeyError, TypeError):
+        logging.warning(u'Ravelry pattern with missing photo: {0}'.format(pat.get('id')))
+
+    return attachment
+
+def yarn_card(info: Dict[str,Any]) -> str:
+    '''
+    Returns: the JSON attachment for a yarn record
+    '''
+    return card_cache.card('yarn', info, render_yarn)
+
+def pattern_card(pat: Dict[str,Any]) -> str:
+    '''
+    Returns: the JSON attachment for a pattern record
+    '''
+    return card_cache.card('pattern', pat, render_pattern)
+
+def favorite_card(pat: Dict[str,Any]) -> str:
+    '''
+    Returns: the JSON attachment for a favorited pattern, which is cached
+        apart from search results as it may be missing the designer or photo
+    '''
+    return card_cache.card('favorite', pat, render_pattern)
+
+def attachments_json(cards: Iterable[str]) -> str:
+    '''
+    Returns: a JSON list of serialized cards, the same as `json.dumps` of
+        the list of attachments
+    '''
+    return '[' + ', '.join(cards) + ']'
+
+card_cache = CardCache()
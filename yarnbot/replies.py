@@ -0,0 +1,96 @@
+'''
+Replies that depend only on the tables in `data`, rendered once.
+
+Commands like help, weights, needles and the acronyms are asked constantly
+and always get the same answer, so each is rendered the first time it is
+asked, as a Slack message payload with both the text and Block Kit blocks,
+and kept until the data is reloaded. `say` posts a payload as is.
+'''
+
+import importlib
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from . import data
+from .query import vocabulary
+from .sizes import needle_sizes
+
+# Slack's limit on the text of a section block
+MAX_SECTION_TEXT = 3000
+
+Payload = Dict[str,Any]
+
+def payload(text: str) -> Payload:
+    '''
+    Returns: a message payload for mrkdwn text, as one section block per
+        up to MAX_SECTION_TEXT characters, split between lines
+    '''
+    blocks: List[Dict[str,Any]] = []
+    chunk = ''
+    for line in text.splitlines(keepends=True):
+        if chunk and len(chunk) + len(line) > MAX_SECTION_TEXT:
+            blocks.append({'type': 'section', 'text': {'type': 'mrkdwn', 'text': chunk}})
+            chunk = ''
+        chunk += line[:MAX_SECTION_TEXT]
+    if chunk.strip():
+        blocks.append({'type': 'section', 'text': {'type': 'mrkdwn', 'text': chunk}})
+    return {'text': text, 'blocks': blocks}
+
+class StaticReplies:
+    '''
+    Thread-safe memo of rendered replies by normalized command, e.g. 'help'
+    or 'acronym:k2tog'.
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.replies: Dict[str,Optional[Payload]] = {}
+        # Bumped by clear, so a render begun before it isn't kept
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, render: Callable[[], Optional[str]]) -> Optional[Payload]:
+        '''
+        Returns: the payload for `key`, rendering it with `render` the first
+            time. None, if `render` returns None.
+        '''
+        with self.lock:
+            if key in self.replies:
+                self.hits += 1
+                return self.replies[key]
+            generation = self.generation
+
+        text = render()
+        reply = payload(text) if text is not None else None
+
+        with self.lock:
+            self.misses += 1
+            if generation != self.generation:
+                return reply
+            return self.replies.setdefault(key, reply)
+
+    def clear(self):
+        with self.lock:
+            self.replies.clear()
+            self.generation += 1
+
+    def summary(self) -> Dict[str,int]:
+        with self.lock:
+            return {'entries': len(self.replies), 'hits': self.hits, 'misses': self.misses}
+
+def reload_data():
+    '''
+    Re-read `data` and drop everything rendered from the old tables.
+
+    Commands are routed by the keys of the tables at startup, so new
+    acronyms or weights need a restart; changed ones are picked up here.
+    '''
+    importlib.reload(data)
+    needle_sizes.load(data.needle_sizes)
+    vocabulary.load()
+    static_replies.clear()
+    logging.info('Reloaded data tables')
+
+static_replies = StaticReplies()
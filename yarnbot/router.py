@@ -0,0 +1,183 @@
+'''
+Command routing for yarnbot messages.
+
+Handlers are registered against a `Router`, and a message is matched
+against them in this order:
+
+  1. early predicates (cheap substring checks that must win over everything)
+  2. exact keys, via a single dict lookup on the stripped message
+  3. prefixes, via character tries walked over the lowercase and/or
+     the stripped message
+  4. precompiled regular expressions
+  5. late predicates
+  6. the default handler
+
+The cost of steps 2 and 3 does not depend on how many commands are
+registered, so unknown messages no longer have to walk every command.
+'''
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+@dataclass
+class Message:
+    '''
+    A message on its way through the router. The different spellings of the
+    text are computed once, up front, so handlers don't redo them.
+    '''
+    user_id: str
+    channel_id: str
+    text: str
+    orig: str
+    lower: str
+    stripped: str
+    say: Callable[..., Any] = field(repr=False)
+    client: Any = field(repr=False)
+
+Handler = Callable[[Message, Any], Any]
+
+class Route(NamedTuple):
+    name: str
+    handler: Handler
+    match: Any
+
+class PrefixTrie:
+    '''
+    Character trie mapping registered prefixes to values. Lookup returns the
+    value of the longest registered prefix of the given string.
+    '''
+
+    __slots__ = ('root',)
+
+    _VALUE = '\0'
+
+    def __init__(self) -> None:
+        self.root: Dict[str,Any] = {}
+
+    def insert(self, prefix: str, value: Any):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[self._VALUE] = value
+
+    def longest_prefix(self, s: str) -> Optional[Tuple[str,Any]]:
+        node = self.root
+        found = None
+        for (i,c) in enumerate(s):
+            if c not in node:
+                break
+            node = node[c]
+            if self._VALUE in node:
+                found = (s[:i+1], node[self._VALUE])
+        return found
+
+class Router:
+    '''
+    Registry of message handlers. Registration methods are decorators:
+
+        router = Router()
+
+        @router.exact('help')
+        def cmd_help(msg, match):
+            return 'I understand...'
+
+    A handler receives the `Message` and whatever matched (the key, the
+    prefix, or the `re.Match` object) and returns a reply, or None.
+    '''
+
+    def __init__(self) -> None:
+        self.exact_keys: Dict[str,Tuple[str,Handler]] = {}
+        self.prefixes: Dict[str,PrefixTrie] = {}
+        self.patterns: List[Tuple[Pattern[str],str,str,Handler]] = []
+        self.early_predicates: List[Tuple[Callable[[Message],bool],str,Handler]] = []
+        self.predicates: List[Tuple[Callable[[Message],bool],str,Handler]] = []
+        self.default_route: Optional[Tuple[str,Handler]] = None
+
+    def exact(self, *keys: str, name: Optional[str]=None):
+        def register(fn: Handler) -> Handler:
+            for key in keys:
+                self.exact_keys[key] = (name or fn.__name__, fn)
+            return fn
+        return register
+
+    def prefix(self, *prefixes: str, attr: str='lower', name: Optional[str]=None):
+        '''
+        Register a handler for one or more prefixes of the given attribute of
+        the `Message`.
+        '''
+        trie = self.prefixes.setdefault(attr, PrefixTrie())
+        def register(fn: Handler) -> Handler:
+            for p in prefixes:
+                trie.insert(p, (name or fn.__name__, fn))
+            return fn
+        return register
+
+    def regex(self, pattern: str, attr: str='lower', name: Optional[str]=None):
+        '''
+        Register a handler for a regular expression, matched (with `re.match`)
+        against the given attribute of the `Message`.
+        '''
+        compiled = re.compile(pattern)
+        def register(fn: Handler) -> Handler:
+            self.patterns.append( (compiled, attr, name or fn.__name__, fn) )
+            return fn
+        return register
+
+    def predicate(self, test: Callable[[Message],bool], early: bool=False,
+            name: Optional[str]=None):
+        '''
+        Register a handler for an arbitrary test. Early predicates are checked
+        before anything else, so keep them cheap.
+        '''
+        def register(fn: Handler) -> Handler:
+            entry = (test, name or fn.__name__, fn)
+            if early:
+                self.early_predicates.append(entry)
+            else:
+                self.predicates.append(entry)
+            return fn
+        return register
+
+    def default(self, fn: Handler) -> Handler:
+        self.default_route = (fn.__name__, fn)
+        return fn
+
+    def route(self, msg: Message) -> Optional[Route]:
+        '''
+        Find the handler for a message. Returns None only if nothing matches
+        and there is no default handler.
+        '''
+        for (test,name,fn) in self.early_predicates:
+            if test(msg):
+                return Route(name, fn, None)
+
+        entry = self.exact_keys.get(msg.stripped)
+        if entry is not None:
+            return Route(entry[0], entry[1], msg.stripped)
+
+        for (attr,trie) in self.prefixes.items():
+            found = trie.longest_prefix(getattr(msg, attr))
+            if found is not None:
+                (p,(name,fn)) = found
+                return Route(name, fn, p)
+
+        for (compiled,attr,name,fn) in self.patterns:
+            m = compiled.match(getattr(msg, attr))
+            if m:
+                return Route(name, fn, m)
+
+        for (test,name,fn) in self.predicates:
+            if test(msg):
+                return Route(name, fn, None)
+
+        if self.default_route is not None:
+            return Route(self.default_route[0], self.default_route[1], None)
+
+        return None
+
+    def dispatch(self, msg: Message) -> Any:
+        route = self.route(msg)
+        if route is None:
+            return None
+        return route.handler(msg, route.match)
@@ -0,0 +1,155 @@
+'''
+Needle and hook sizes, indexed from `data.needle_sizes`.
+
+The lookups by metric, US, UK and crochet size are all derived from that
+one table when the module is imported, keeping every size a label stands
+for: US 3 is both 3.0 and 3.25 mm, and UK 9 both 3.5 and 3.75 mm. Metric and
+US sizes that aren't in the table are matched to the nearest one, by
+bisecting the sorted sizes.
+
+Replies don't change between requests, so they are rendered once here.
+'''
+
+import bisect
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from . import data
+
+NO_SIZE = '-'
+
+# How far off a standard size a metric size may be, as a fraction of it,
+# and a US size may be, in US sizes, to be matched to it
+METRIC_TOLERANCE = 0.15
+US_TOLERANCE = 1.0
+
+class NeedleSize(NamedTuple):
+    mm: float
+    us: str
+    uk: str
+    crochet: str
+
+    @property
+    def metric(self) -> str:
+        '''
+        The size in mm, with as few decimals as it needs, e.g. 3.0 or 3.25
+        '''
+        text = '{0:.2f}'.format(self.mm).rstrip('0')
+        return text + '0' if text.endswith('.') else text
+
+def parse_number(text: str) -> Optional[float]:
+    '''
+    Parse a decimal or a mixed fraction, like "3.3", "10 1/2" or "1/2".
+
+    Returns: None if it isn't a number
+    '''
+    total = 0.0
+    for part in text.split():
+        try:
+            if '/' in part:
+                (num, den) = part.split('/', 1)
+                total += int(num)/int(den)
+            else:
+                total += float(part)
+        except (ValueError, ZeroDivisionError):
+            return None
+    return total if text.strip() else None
+
+def nearest(keys: List[float], value: float) -> float:
+    '''
+    Returns: the key closest to `value`, the smaller one on a tie. `keys`
+        must be sorted and not empty.
+    '''
+    i = bisect.bisect_left(keys, value)
+    if i == 0:
+        return keys[0]
+    if i == len(keys):
+        return keys[-1]
+    (below, above) = (keys[i-1], keys[i])
+    return above if above - value < value - below else below
+
+class SizeIndex:
+    '''
+    Lookups and rendered replies for a table of sizes.
+    '''
+
+    def __init__(self, rows: Iterable[Tuple[float,str,str,str]]) -> None:
+        self.load(rows)
+
+    def load(self, rows: Iterable[Tuple[float,str,str,str]]):
+        '''
+        (Re)build the indexes and replies from a table of sizes.
+        '''
+        self.sizes = sorted( (NeedleSize(*row) for row in rows), key=lambda s: s.mm )
+
+        by_metric: Dict[float,List[NeedleSize]] = defaultdict(list)
+        by_us: Dict[float,List[NeedleSize]] = defaultdict(list)
+        by_uk: Dict[str,List[NeedleSize]] = defaultdict(list)
+        by_crochet: Dict[str,List[NeedleSize]] = defaultdict(list)
+        for size in self.sizes:
+            by_metric[round(size.mm, 2)].append(size)
+            if size.us != NO_SIZE:
+                by_us[float(size.us)].append(size)
+            if size.uk != NO_SIZE:
+                by_uk[size.uk].append(size)
+            if size.crochet != NO_SIZE:
+                by_crochet[size.crochet].append(size)
+
+        self.metric_keys = sorted(by_metric)
+        self.us_keys = sorted(by_us)
+
+        self.metric_replies = { mm: '\n'.join(self.metric_line(s) for s in sizes)
+            for (mm,sizes) in by_metric.items() }
+        self.us_replies = { us: '*US size {0}* is {1}'.format(sizes[0].us,
+                ', or '.join('{0} mm, UK {1}, Crochet {2}'.format(s.metric, s.uk, s.crochet) for s in sizes))
+            for (us,sizes) in by_us.items() }
+        self.uk_replies = { uk: '*UK size {0}* is {1}'.format(uk,
+                ', or '.join('{0} mm, US {1}, Crochet {2}'.format(s.metric, s.us, s.crochet) for s in sizes))
+            for (uk,sizes) in by_uk.items() }
+        self.crochet_replies = { crochet: '*Crochet {0}* is {1}'.format(crochet,
+                ', or '.join('{0} mm, US {1}, UK {2}'.format(s.metric, s.us, s.uk) for s in sizes))
+            for (crochet,sizes) in by_crochet.items() }
+
+        self.table_reply = "These are all of the needles/hooks I know about:\n" + \
+            ''.join(self.metric_line(s) + '\n' for s in self.sizes)
+
+    @staticmethod
+    def metric_line(size: NeedleSize) -> str:
+        return "*{0:.2f} mm* needles/hooks are US {1}, UK {2}, Crochet {3}".format(size.mm,
+            size.us, size.uk, size.crochet)
+
+    def metric_reply(self, text: str) -> str:
+        mm = parse_number(text)
+        if mm is None:
+            return "{0} mm doesn't seem to be a standard size.".format(text)
+        key = nearest(self.metric_keys, round(mm, 2))
+        if key == round(mm, 2):
+            return self.metric_replies[key]
+        if abs(key - mm) > METRIC_TOLERANCE*key:
+            return "{0:.2f} mm doesn't seem to be a standard size.".format(mm)
+        return "{0:.2f} mm isn't a standard size, the nearest is:\n{1}".format(mm, self.metric_replies[key])
+
+    def us_reply(self, text: str) -> str:
+        us = parse_number(text)
+        if us is None:
+            return "US {0} doesn't seem to be a standard size.".format(text)
+        key = nearest(self.us_keys, us)
+        if key == us:
+            return self.us_replies[key]
+        if abs(key - us) > US_TOLERANCE:
+            return "US {0} doesn't seem to be a standard size.".format(text)
+        return "US {0} isn't a standard size, the nearest is:\n{1}".format(text, self.us_replies[key])
+
+    def uk_reply(self, text: str) -> str:
+        reply = self.uk_replies.get(text)
+        if reply is None:
+            return "UK {0} doesn't seem to be a standard size.".format(text)
+        return reply
+
+    def crochet_reply(self, text: str) -> str:
+        reply = self.crochet_replies.get(text.upper())
+        if reply is None:
+            return "Crochet {0} doesn't seem to be a standard size.".format(text.upper())
+        return reply
+
+needle_sizes = SizeIndex(data.needle_sizes)
@@ -0,0 +1,110 @@
+'''
+Cache of Slack user profiles and direct message channels.
+
+Welcoming a user takes a `users.info` call and a `conversations.open`
+call. Both answers rarely change, so they are kept here with an expiry.
+At startup, the cache is filled a page at a time from `users.list` and
+`conversations.list`. It is updated by `user_change` events.
+'''
+
+import os
+from typing import Any, Dict, Optional
+
+from slack_sdk.errors import SlackApiError
+
+from .cache import ResponseCache
+
+SLACK_USER_TTL = float(os.environ.get('SLACK_USER_TTL', '3600'))
+SLACK_IM_TTL = float(os.environ.get('SLACK_IM_TTL', '86400'))
+SLACK_CACHE_ENTRIES = int(os.environ.get('SLACK_CACHE_ENTRIES', '20000'))
+
+# Page size for users.list and conversations.list
+SLACK_PAGE_SIZE = 200
+
+# Times a page is asked for again after Slack rate limits it
+SLACK_PAGE_RETRIES = 5
+
+class SlackDirectory:
+    '''
+    Thread-safe user id -> profile and user id -> IM channel id caches.
+    Each entry counts as size 1, so the caches are bounded by entry count.
+    '''
+
+    def __init__(self, user_ttl: float=SLACK_USER_TTL, im_ttl: float=SLACK_IM_TTL,
+            max_entries: int=SLACK_CACHE_ENTRIES) -> None:
+        self.user_ttl = user_ttl
+        self.im_ttl = im_ttl
+        self.users = ResponseCache(max_entries, max_entries)
+        self.ims = ResponseCache(max_entries, max_entries)
+
+    def user(self, user_id: str) -> Optional[Dict[str,Any]]:
+        return self.users.get(user_id)
+
+    def put_user(self, user: Dict[str,Any]):
+        if 'id' in user:
+            self.users.put(user['id'], user, 1, self.user_ttl)
+
+    def im_channel(self, user_id: str) -> Optional[str]:
+        return self.ims.get(user_id)
+
+    def put_im(self, user_id: str, channel_id: str):
+        self.ims.put(user_id, channel_id, 1, self.im_ttl)
+
+    def user_changed(self, user: Dict[str,Any]):
+        '''
+        Replace a cached profile with the one from a `user_change` event.
+        A deactivated user's IM channel is dropped too.
+        '''
+        self.users.discard(user.get('id'))
+        if user.get('deleted'):
+            self.ims.discard(user.get('id'))
+        else:
+            self.put_user(user)
+
+    def add_users_page(self, resp: Dict[str,Any]) -> Optional[str]:
+        '''
+        Cache the members from a `users.list` response.
+
+        Returns: the cursor for the next page, or None if this was the last
+        '''
+        for user in resp.get('members', []):
+            if not user.get('deleted'):
+                self.put_user(user)
+        return next_cursor(resp)
+
+    def add_ims_page(self, resp: Dict[str,Any]) -> Optional[str]:
+        '''
+        Cache the IM channels from a `conversations.list(types='im')` response.
+
+        Returns: the cursor for the next page, or None if this was the last
+        '''
+        for channel in resp.get('channels', []):
+            if 'user' in channel and 'id' in channel:
+                self.put_im(channel['user'], channel['id'])
+        return next_cursor(resp)
+
+    def clear(self):
+        self.users.clear()
+        self.ims.clear()
+
+    def summary(self) -> Dict[str,Dict[str,int]]:
+        return {'users': self.users.summary(), 'ims': self.ims.summary()}
+
+def next_cursor(resp: Dict[str,Any]) -> Optional[str]:
+    cursor = (resp.get('response_metadata') or {}).get('next_cursor')
+    return cursor or None
+
+def retry_after(error: Exception) -> Optional[float]:
+    '''
+    Returns: seconds Slack asked to wait before calling again, if `error` is
+        a rate limited (429) response, otherwise None
+    '''
+    if not isinstance(error, SlackApiError) or error.response.status_code != 429:
+        return None
+    headers = error.response.headers or {}
+    try:
+        return float(headers.get('Retry-After', headers.get('retry-after', 1)))
+    except (TypeError, ValueError):
+        return 1.
+
+slack_directory = SlackDirectory()
@@ -1,17 +1,532 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import Dict, List
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
 
-from .conversations import Conversation
+from .conversations import Conversation, dump_conversation, load_conversation
+from .userdb import KnownUsers
+
+if TYPE_CHECKING:
+    from .tasks import TaskQueue
+
+CONVERSATION_TTL = float(os.environ.get('CONVERSATION_TTL', '1800'))
+CONVERSATION_MAX = int(os.environ.get('CONVERSATION_MAX', '1000'))
+CONVERSATION_SWEEP_INTERVAL = float(os.environ.get('CONVERSATION_SWEEP_INTERVAL', '60'))
+
+# Where running conversations are kept: 'memory', 'sqlite:///relative/file.db',
+# 'sqlite:////absolute/file.db', or 'redis://[:password@]host[:port][/db]'
+CONVERSATION_STORE = os.environ.get('CONVERSATION_STORE', 'memory')
+
+class ShardedCounter:
+    '''
+    Counter that many threads can increment without a shared lock. Each
+    thread adds to its own shard, which only it writes; reading sums the
+    shards, so a read is exact once the writers are done. Shards of
+    threads that have exited are folded into a single total.
+    '''
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards: List[Tuple[threading.Thread,List[int]]] = []
+        self.folded = 0
+
+    def _shard(self) -> List[int]:
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = [0]
+            with self.lock:
+                live = []
+                for (thread,old_shard) in self.shards:
+                    if thread.is_alive():
+                        live.append( (thread,old_shard) )
+                    else:
+                        self.folded += old_shard[0]
+                live.append( (threading.current_thread(),shard) )
+                self.shards = live
+            self.local.shard = shard
+        return shard
+
+    def increment(self, amount: int=1):
+        self._shard()[0] += amount
+
+    @property
+    def value(self) -> int:
+        with self.lock:
+            return self.folded + sum(shard[0] for (_thread,shard) in self.shards)
+
+    def __int__(self) -> int:
+        return self.value
+
+    def __format__(self, spec: str) -> str:
+        return format(self.value, spec)
+
+class SessionStore(ABC):
+    '''
+    Running conversations, by user id. A conversation expires once it has
+    been idle for `ttl` seconds, and when there are more than
+    `max_sessions`, the least recently used one is evicted.
+
+    Expired conversations are dropped when looked up, and by a sweeper
+    thread (see `start_sweeper`), so abandoned ones don't accumulate.
+
+    Subclasses decide where conversations are kept. Those shared between
+    processes store them serialized, so a conversation returned by `get`
+    is a copy, and must be `put` back after each step.
+    '''
+
+    # Whether calls may wait on disk or network I/O, so the async app
+    # makes them from a worker thread
+    blocking = True
+
+    def __init__(self, ttl: float=CONVERSATION_TTL, max_sessions: int=CONVERSATION_MAX) -> None:
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        # Counted by this process only
+        self.expired = 0
+        self.evicted = 0
+        self.sweeper: Optional[threading.Thread] = None
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def get(self, user_id: str) -> Optional[Conversation]:
+        ...
+
+    @abstractmethod
+    def put(self, user_id: str, conv: Conversation):
+        '''
+        Store a new or continued conversation, marking it as just used.
+        '''
+
+    @abstractmethod
+    def pop(self, user_id: str) -> Optional[Conversation]:
+        ...
+
+    @abstractmethod
+    def items(self) -> List[Tuple[str,Conversation]]:
+        ...
+
+    @abstractmethod
+    def sweep(self) -> int:
+        '''
+        Drop expired conversations.
+
+        Returns: number dropped
+        '''
+
+    def close(self):
+        pass
+
+    def start_sweeper(self, interval: float=CONVERSATION_SWEEP_INTERVAL):
+        if self.sweeper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+
+        self.sweeper = threading.Thread(target=run, name='conversation-sweeper', daemon=True)
+        self.sweeper.start()
+
+    def summary(self) -> Dict[str,int]:
+        active = len(self)
+        with self.lock:
+            return {'active': active, 'expired': self.expired, 'evicted': self.evicted}
+
+class MemorySessionStore(SessionStore):
+    '''
+    Conversations kept in this process, as objects.
+    '''
+
+    blocking = False
+
+    def __init__(self, ttl: float=CONVERSATION_TTL, max_sessions: int=CONVERSATION_MAX) -> None:
+        super().__init__(ttl, max_sessions)
+        # user id -> (last used time, conversation), least recently used first
+        self.sessions: 'OrderedDict[str,Tuple[float,Conversation]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        expiry = time.monotonic() - self.ttl
+        with self.lock:
+            # Expired ones are least recently used, so they all come first
+            stale = 0
+            for (used,_conv) in self.sessions.values():
+                if used >= expiry:
+                    break
+                stale += 1
+            return len(self.sessions) - stale
+
+    def get(self, user_id: str) -> Optional[Conversation]:
+        with self.lock:
+            entry = self.sessions.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] + self.ttl < time.monotonic():
+                del self.sessions[user_id]
+                self.expired += 1
+                return None
+            return entry[1]
+
+    def put(self, user_id: str, conv: Conversation):
+        with self.lock:
+            self.sessions[user_id] = (time.monotonic(), conv)
+            self.sessions.move_to_end(user_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.evicted += 1
+
+    def pop(self, user_id: str) -> Optional[Conversation]:
+        with self.lock:
+            entry = self.sessions.pop(user_id, None)
+        return entry[1] if entry is not None else None
+
+    def items(self) -> List[Tuple[str,Conversation]]:
+        now = time.monotonic()
+        with self.lock:
+            return [ (user_id, conv) for (user_id,(used,conv)) in self.sessions.items()
+                if used + self.ttl >= now ]
+
+    def sweep(self) -> int:
+        expiry = time.monotonic() - self.ttl
+        count = 0
+        with self.lock:
+            # Least recently used first, so stop at the first live one
+            for (user_id,(used,_conv)) in list(self.sessions.items()):
+                if used >= expiry:
+                    break
+                del self.sessions[user_id]
+                count += 1
+            self.expired += count
+        return count
+
+SESSION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    used REAL NOT NULL,
+    session TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_used ON sessions (used);
+'''
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    Conversations kept in a SQLite database in WAL mode, which can be shared
+    by several processes on the same host.
+    '''
+
+    def __init__(self, filename: str, ttl: float=CONVERSATION_TTL, max_sessions: int=CONVERSATION_MAX) -> None:
+        super().__init__(ttl, max_sessions)
+        self.conn = sqlite3.connect(filename, check_same_thread=False, timeout=5)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SESSION_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM sessions WHERE used >= ?',
+                (time.time()-self.ttl,)).fetchone()[0]
+
+    def get(self, user_id: str) -> Optional[Conversation]:
+        with self.lock:
+            row = self.conn.execute('SELECT used, session FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] + self.ttl < time.time():
+                with self.conn:
+                    self.conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+                self.expired += 1
+                return None
+        return load_conversation(row[1])
+
+    def put(self, user_id: str, conv: Conversation):
+        session = dump_conversation(conv)
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO sessions (user_id, used, session) VALUES (?, ?, ?)',
+                (user_id, time.time(), session))
+            excess = self.conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0] - self.max_sessions
+            if excess > 0:
+                self.conn.execute('''DELETE FROM sessions WHERE user_id IN
+                    (SELECT user_id FROM sessions ORDER BY used LIMIT ?)''', (excess,))
+                self.evicted += excess
+
+    def pop(self, user_id: str) -> Optional[Conversation]:
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT session FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+            self.conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        return load_conversation(row[0]) if row is not None else None
+
+    def items(self) -> List[Tuple[str,Conversation]]:
+        with self.lock:
+            rows = self.conn.execute('SELECT user_id, session FROM sessions WHERE used >= ? ORDER BY used',
+                (time.time()-self.ttl,)).fetchall()
+        return [ (user_id, conv) for (user_id,conv) in
+            ( (user_id, load_conversation(session)) for (user_id,session) in rows ) if conv is not None ]
+
+    def sweep(self) -> int:
+        with self.lock, self.conn:
+            count = self.conn.execute('DELETE FROM sessions WHERE used < ?', (time.time()-self.ttl,)).rowcount
+            self.expired += count
+        return count
+
+class RespError(Exception):
+    '''
+    Error reply from a Redis-protocol server
+    '''
+
+class RespClient:
+    '''
+    Minimal client for the Redis serialization protocol (RESP), enough to
+    talk to Redis or anything speaking its protocol. One connection,
+    shared between threads and serialized with a lock, reconnecting once
+    if a command fails on a dropped connection.
+    '''
+
+    def __init__(self, host: str='localhost', port: int=6379, db: int=0,
+            password: Optional[str]=None, timeout: float=5) -> None:
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock: Optional[socket.socket] = None
+        self.reader: Any = None
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.reader = self.sock.makefile('rb')
+        if self.password is not None:
+            self._call(('AUTH', self.password))
+        if self.db != 0:
+            self._call(('SELECT', self.db))
+
+    def command(self, *args: Any) -> Any:
+        with self.lock:
+            for attempt in (0, 1):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._call(args)
+                except (OSError, EOFError):
+                    self._disconnect()
+                    if attempt > 0:
+                        raise
+
+    @contextmanager
+    def pinned(self) -> Iterator[Callable[..., Any]]:
+        '''
+        Hold the connection for a sequence of commands that depend on each
+        other, like WATCH ... MULTI ... EXEC, yielding a function to send
+        each one. If any fails, the connection is dropped, and with it any
+        WATCH or MULTI state.
+        '''
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                yield lambda *args: self._call(args)
+            except BaseException:
+                self._disconnect()
+                raise
+
+    def transaction(self, *commands: Tuple[Any,...]) -> List[Any]:
+        '''
+        Run commands atomically, with MULTI/EXEC.
+
+        Returns: the reply to each command
+        '''
+        with self.pinned() as call:
+            call('MULTI')
+            for args in commands:
+                call(*args)
+            return call('EXEC')
+
+    def _call(self, args: Tuple[Any,...]) -> Any:
+        assert self.sock is not None
+        parts = [ b'*%d\r\n' % len(args) ]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.sock.sendall(b''.join(parts))
+        return self._read()
+
+    def _read(self) -> Any:
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError('Connection closed')
+        (kind, rest) = (line[:1], line[1:-2])
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RespError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self.reader.read(size+2)
+            if len(data) != size+2:
+                raise EOFError('Connection closed')
+            return data[:-2].decode()
+        if kind == b'*':
+            size = int(rest)
+            if size < 0:
+                return None
+            # Read every element, even after an error in one of them, e.g.
+            # from a command in a transaction, so the connection stays in step
+            items = []
+            error = None
+            for _ in range(size):
+                try:
+                    items.append(self._read())
+                except RespError as e:
+                    error = error or e
+            if error is not None:
+                raise error
+            return items
+        raise RespError('Unexpected reply {0!r}'.format(line))
+
+class RedisSessionStore(SessionStore):
+    '''
+    Conversations kept in Redis, which can be shared by processes on any
+    number of hosts. Each conversation is a key that Redis expires itself;
+    a sorted set of user ids by last use drives LRU eviction and `items`.
+    Both are written together in MULTI/EXEC transactions, so processes
+    writing at once can't leave them out of step.
+    '''
+
+    def __init__(self, client: RespClient, prefix: str='yarnbot:conversation:',
+            ttl: float=CONVERSATION_TTL, max_sessions: int=CONVERSATION_MAX) -> None:
+        super().__init__(ttl, max_sessions)
+        self.client = client
+        self.prefix = prefix
+        self.index = prefix + 'index'
+
+    def close(self):
+        self.client.close()
+
+    def __len__(self) -> int:
+        return self.client.command('ZCOUNT', self.index, time.time()-self.ttl, '+inf')
+
+    def get(self, user_id: str) -> Optional[Conversation]:
+        session = self.client.command('GET', self.prefix + user_id)
+        return load_conversation(session) if session is not None else None
+
+    def put(self, user_id: str, conv: Conversation):
+        '''
+        Write the conversation and evict the least recently used ones beyond
+        max_sessions, session and index entry together, in one transaction.
+        The index is watched while the evictions are picked, so if another
+        process changes it first, the transaction is dropped and redone.
+        '''
+        session = dump_conversation(conv)
+        while True:
+            with self.client.pinned() as call:
+                call('WATCH', self.index)
+                size = call('ZCARD', self.index)
+                if call('ZSCORE', self.index, user_id) is None:
+                    size += 1
+                evicted: List[str] = []
+                if size > self.max_sessions:
+                    # One spare, in case the user being written is among them
+                    oldest = call('ZRANGE', self.index, 0, size - self.max_sessions)
+                    evicted = [ u for u in oldest if u != user_id ][:size - self.max_sessions]
+
+                call('MULTI')
+                call('SET', self.prefix + user_id, session, 'PX', int(self.ttl*1000))
+                call('ZADD', self.index, time.time(), user_id)
+                if len(evicted) > 0:
+                    call('ZREM', self.index, *evicted)
+                    call('DEL', *[ self.prefix + u for u in evicted ])
+                if call('EXEC') is not None:
+                    break
+
+        if len(evicted) > 0:
+            with self.lock:
+                self.evicted += len(evicted)
+
+    def pop(self, user_id: str) -> Optional[Conversation]:
+        (session, _deleted, _removed) = self.client.transaction(
+            ('GET', self.prefix + user_id),
+            ('DEL', self.prefix + user_id),
+            ('ZREM', self.index, user_id))
+        return load_conversation(session) if session is not None else None
+
+    def items(self) -> List[Tuple[str,Conversation]]:
+        user_ids = self.client.command('ZRANGEBYSCORE', self.index, time.time()-self.ttl, '+inf')
+        if len(user_ids) == 0:
+            return []
+        sessions = self.client.command('MGET', *[ self.prefix + u for u in user_ids ])
+        return [ (user_id, conv) for (user_id,conv) in
+            ( (user_id, load_conversation(session)) for (user_id,session) in zip(user_ids, sessions)
+                if session is not None ) if conv is not None ]
+
+    def sweep(self) -> int:
+        '''
+        Redis expires the conversations; this drops them from the index.
+        '''
+        count = self.client.command('ZREMRANGEBYSCORE', self.index, '-inf', '({0}'.format(time.time()-self.ttl))
+        with self.lock:
+            self.expired += count
+        return count
+
+def open_session_store(url: str=CONVERSATION_STORE) -> SessionStore:
+    '''
+    Create the session store described by `url`, see `CONVERSATION_STORE`.
+    '''
+    parts = urlsplit(url)
+
+    if parts.scheme in ('', 'memory'):
+        return MemorySessionStore()
+
+    if parts.scheme == 'sqlite':
+        filename = url.split('://', 1)[1]
+        return SQLiteSessionStore(filename[1:] if filename.startswith('/') else filename)
+
+    if parts.scheme == 'redis':
+        db = int(parts.path.strip('/') or '0')
+        password = unquote(parts.password) if parts.password is not None else None
+        return RedisSessionStore(RespClient(parts.hostname or 'localhost', parts.port or 6379, db, password))
+
+    raise ValueError('Unknown conversation store {0}'.format(url))
 
 @dataclass
 class AppState:
-    known_users: List[str] = field(default_factory=list)
-    conversations: Dict[str,Conversation] = field(default_factory=dict)
-    message_count: int = 0
-    unknown_count: int = 0
+    known_users: KnownUsers = field(default_factory=KnownUsers)
+    conversations: SessionStore = field(default_factory=MemorySessionStore)
+    message_count: ShardedCounter = field(default_factory=ShardedCounter)
+    unknown_count: ShardedCounter = field(default_factory=ShardedCounter)
     start_time: float = 0
     bot_user_id: str = ''
     bot_user_ref: str = ''
+    # Worker threads for the sync app's Ravelry commands, see `app.create_app`
+    ravelry_tasks: Optional['TaskQueue'] = None
 
 app_state = AppState()
-
@@ -0,0 +1,60 @@
+'''
+Background work for slow commands.
+'''
+
+import queue
+import logging
+import threading
+from typing import Any, Callable, List
+
+from .state import ShardedCounter
+
+class TaskQueue:
+    '''
+    A fixed number of worker threads fed from a bounded queue. When the
+    queue is full, `submit` refuses new work instead of blocking, so the
+    caller can tell the user to try again later.
+    '''
+
+    def __init__(self, name: str, workers: int, max_pending: int) -> None:
+        self.name = name
+        self.pending: 'queue.Queue[Any]' = queue.Queue(maxsize=max_pending)
+        self.threads: List[threading.Thread] = []
+        self.rejected = ShardedCounter()
+
+        for i in range(workers):
+            t = threading.Thread(target=self._run, name='{0}-{1}'.format(name, i), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def full(self) -> bool:
+        return self.pending.full()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> bool:
+        '''
+        Queue `fn(*args)` to run on a worker thread.
+
+        Returns: False if the queue is full and the task was not queued
+        '''
+        try:
+            self.pending.put_nowait( (fn, args) )
+        except queue.Full:
+            self.rejected.increment()
+            return False
+        return True
+
+    def join(self):
+        '''
+        Wait until every queued task has finished.
+        '''
+        self.pending.join()
+
+    def _run(self):
+        while True:
+            (fn, args) = self.pending.get()
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception('{0} task failed'.format(self.name))
+            finally:
+                self.pending.task_done()
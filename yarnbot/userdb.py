@@ -0,0 +1,146 @@
+'''
+Persistent set of known user ids.
+'''
+
+import os
+import pickle
+import logging
+import threading
+from typing import IO, Iterator, Optional, Set
+
+def fsync_dir(filename: str):
+    '''
+    Make a rename into `filename`'s directory durable, where the platform
+    allows opening directories.
+    '''
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class KnownUsers:
+    '''
+    Set of user ids, backed by an append-only log file with one id per line.
+    Adding a user costs one small write; the log is rewritten (compacted)
+    only when it has collected enough duplicate or damaged lines.
+
+    Until `open` is called, the set is kept in memory only.
+    '''
+
+    def __init__(self, compact_slack: int=100) -> None:
+        '''
+        Parameters:
+            compact_slack: Number of wasted log lines to tolerate before
+                compacting
+        '''
+        self.compact_slack = compact_slack
+        self.lock = threading.Lock()
+        self.users: Set[str] = set()
+        self.filename: Optional[str] = None
+        self.log: Optional[IO[str]] = None
+        self.log_lines = 0
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self.users
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self.users))
+
+    def open(self, filename: str, legacy_filename: Optional[str]=None):
+        '''
+        Load the log, creating it if needed, and keep it open for appending.
+        Users already in memory are kept. If a legacy pickle file is given
+        and exists, its users are merged in and it is renamed out of the way.
+        '''
+        with self.lock:
+            self.close()
+            self.filename = filename
+
+            try:
+                with open(filename, 'r') as log:
+                    for line in log:
+                        self.log_lines += 1
+                        # A line without a newline is a torn write
+                        user_id = line.strip()
+                        if line.endswith('\n') and user_id.isalnum():
+                            self.users.add(user_id)
+            except FileNotFoundError:
+                pass
+
+            if legacy_filename is not None and not os.path.exists(legacy_filename):
+                legacy_filename = None
+            if legacy_filename is not None and not self._migrate(legacy_filename):
+                legacy_filename = None
+
+            self._compact()
+
+            # Only once the log holds its users, or a crash would lose them
+            if legacy_filename is not None:
+                os.replace(legacy_filename, legacy_filename + '.migrated')
+
+    def _migrate(self, legacy_filename: str) -> bool:
+        '''
+        Returns: True if the pickle's users were merged in
+        '''
+        try:
+            with open(legacy_filename, 'rb') as f:
+                self.users.update(pickle.load(f))
+        except Exception:
+            logging.error('Malformed userdb file {0}'.format(legacy_filename))
+            return False
+        return True
+
+    def add(self, user_id: str) -> bool:
+        '''
+        Returns: True if the user is new
+        '''
+        with self.lock:
+            if user_id in self.users:
+                return False
+            self.users.add(user_id)
+
+            if self.log is not None:
+                self.log.write(user_id + '\n')
+                self.log.flush()
+                os.fsync(self.log.fileno())
+                self.log_lines += 1
+                if self.log_lines - len(self.users) > self.compact_slack:
+                    self._compact()
+
+            return True
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        '''
+        Rewrite the log with one line per user, atomically replacing the old one.
+        '''
+        if self.filename is None:
+            return
+        if self.log is not None:
+            self.log.close()
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as tmp:
+            for user_id in sorted(self.users):
+                tmp.write(user_id + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_filename, self.filename)
+        fsync_dir(self.filename)
+
+        self.log = open(self.filename, 'a')
+        self.log_lines = len(self.users)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None